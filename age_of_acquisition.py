@@ -9,6 +9,7 @@ import pandas as pd
 
 import seaborn as sns
 
+from data_store import load_utterances
 from utils import SPEECH_ACT, CHILD, PATH_NEW_ENGLAND_UTTERANCES, AGES
 from process_contingencies import get_contingency_data
 from utils import COLORS_PLOT_CATEGORICAL, age_bin, SOURCE_SNOW, SOURCE_CRF, TARGET_PRODUCTION, TARGET_COMPREHENSION
@@ -463,7 +464,7 @@ if __name__ == "__main__":
 
     print("Loading data...")
 
-    data = pd.read_pickle(PATH_NEW_ENGLAND_UTTERANCES)
+    data = load_utterances(PATH_NEW_ENGLAND_UTTERANCES)
 
     # map ages to corresponding bins
     data["age_months"] = data["age_months"].apply(age_bin)
@@ -1,23 +1,27 @@
 import os
 import argparse
 import pickle
+import time
 from collections import Counter
+from itertools import chain
 import numpy as np
 import pandas as pd
+import scipy.sparse
 import matplotlib.pyplot as plt
 from sklearn import ensemble, svm
 import pycrfsuite
 from sklearn.model_selection import KFold
 
+from crf_tagger import load_feature_columns
 from crf_train import (
-    add_feature_columns,
     generate_features_vocabs,
-    get_features_from_row,
     bio_classification_report,
     get_n_grams,
 )
-from preprocess import SPEECH_ACT, ADULT
+from feature_cache import FeatureCache
 from utils import (
+    SPEECH_ACT,
+    ADULT,
     SPEECH_ACT_UNINTELLIGIBLE,
     SPEECH_ACT_NO_FUNCTION,
     TRAIN_TEST_SPLIT_RANDOM_STATE,
@@ -90,6 +94,17 @@ def parse_args():
         action="store_true",
         help="Whether to display training iterations output.",
     )
+    argparser.add_argument(
+        "--dense",
+        action="store_true",
+        help="Compute the features as dense array (slower and larger than the default sparse matrix)",
+    )
+    argparser.add_argument(
+        "--feature-cache",
+        type=str,
+        default=None,
+        help="Directory to cache computed features in (e.g. ~/data/speech_acts/feature_cache/)",
+    )
 
     args = argparser.parse_args()
 
@@ -143,24 +158,18 @@ def get_baseline_features_from_row(
             features_sparse.append(features["length_bins"][k])
 
     if use_bi_grams:
-        bi_grams = [
-            "-".join(n_gram)
+        features_sparse += [
+            features["bigrams"][n_gram]
             for n_gram in get_n_grams(tokens, 2)
             if n_gram in features["bigrams"].keys()
         ]
-        features_sparse = [
-            features["bi_grams"][b] for b in bi_grams if b in features["bigrams"].keys()
-        ]  # words
 
     if ("repetitions" in kwargs) and (
         kwargs["repetitions"] is not None
-    ):  # not using words, only ratio+len
-        (_, len_rep, ratio_rep) = kwargs["repetitions"]
-        for k in features["rep_length_bins"].keys():
-            if len_rep <= float(k.split("-")[1]) and len_rep >= float(k.split("-")[0]):
-                features_sparse.append(features["rep_length_bins"][k])
+    ):  # not using words, only ratio
+        (_, ratio_rep) = kwargs["repetitions"]
         for k in features["rep_ratio_bins"].keys():
-            if len_rep <= float(k.split("-")[1]) and len_rep >= float(k.split("-")[0]):
+            if ratio_rep <= float(k.split("-")[1]) and ratio_rep >= float(k.split("-")[0]):
                 features_sparse.append(features["rep_ratio_bins"][k])
 
     if ("pos_tags" in kwargs) and (
@@ -178,6 +187,157 @@ def get_baseline_features_from_row(
     return features_full
 
 
+def _lookup(values, vocab: dict) -> np.ndarray:
+    """Feature index of each value, -1 for values that are not in the vocabulary"""
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+    # Missing values get the code -1, i.e. the last entry
+    ids = np.array([vocab.get(v, -1) for v in uniques] + [-1], dtype=np.int64)
+    return ids[codes]
+
+
+def _bin_rows(values: np.ndarray, bins: dict) -> tuple:
+    """Rows and feature indices of the values that lie in each bin (bounds included)"""
+    rows, cols = [], []
+    for k, feature in bins.items():
+        low, high = float(k.split("-")[0]), float(k.split("-")[1])
+        in_bin = np.flatnonzero((values >= low) & (values <= high))
+        rows.append(in_bin)
+        cols.append(np.full(len(in_bin), feature))
+    return rows, cols
+
+
+def get_baseline_features(
+    data: pd.DataFrame,
+    features: dict,
+    use_bi_grams: bool,
+    use_repetitions: bool = False,
+    use_pos: bool = False,
+) -> scipy.sparse.csr_matrix:
+    """Features of all utterances of the data (with the columns of `add_feature_columns`) as a sparse matrix.
+
+    Row i is the same as `get_baseline_features_from_row` for the i-th utterance, but only the indices of the features
+    that are present are computed, with a single lookup per distinct token.
+    """
+    nb_features = (
+        max([max([int(x) for x in v.values()]) for v in features.values()]) + 1
+    )
+    nb_rows = len(data)
+    rows, cols = [], []
+
+    tokens = data.tokens.tolist()
+    turn_lengths = np.fromiter(map(len, tokens), dtype=np.int64, count=len(tokens))
+    token_rows = np.repeat(np.arange(nb_rows), turn_lengths)
+    flat_tokens = list(chain.from_iterable(tokens))
+
+    # words
+    word_ids = _lookup(flat_tokens, features["words"])
+    rows.append(token_rows[word_ids >= 0])
+    cols.append(word_ids[word_ids >= 0])
+
+    # speakers (index 1 for adults, 0 otherwise)
+    rows += [np.arange(nb_rows), np.arange(nb_rows)]
+    cols.append((data.speaker_code.to_numpy() == ADULT).astype(np.int64))
+    cols.append((data.prev_speaker_code.to_numpy() == ADULT).astype(np.int64))
+
+    length_rows, length_cols = _bin_rows(
+        data.turn_length.to_numpy(dtype=float), features["length_bins"]
+    )
+    rows += length_rows
+    cols += length_cols
+
+    if use_bi_grams:
+        # Same as get_n_grams(tokens, 2): bigrams without the final punctuation
+        ends = np.repeat(np.cumsum(turn_lengths) - 1, turn_lengths)
+        positions = np.flatnonzero(np.arange(len(flat_tokens)) + 2 <= ends)
+        token_codes, token_types = pd.factorize(pd.Series(flat_tokens, dtype=object))
+        type_codes = {t: i for i, t in enumerate(token_types)}
+        bigram_ids = {
+            type_codes[first] * len(token_types) + type_codes[second]: feature
+            for (first, second), feature in features["bigrams"].items()
+            if first in type_codes and second in type_codes
+        }
+        keys = token_codes[positions] * len(token_types) + token_codes[positions + 1]
+        ids = _lookup(keys.tolist(), bigram_ids)
+        rows.append(token_rows[positions][ids >= 0])
+        cols.append(ids[ids >= 0])
+
+    if use_repetitions:
+        rep_rows, rep_cols = _bin_rows(
+            data.ratio_repwords.to_numpy(dtype=float), features["rep_ratio_bins"]
+        )
+        rows += rep_rows
+        cols += rep_cols
+
+    if use_pos:
+        pos_tags = [tags if tags is not None else [] for tags in data.pos.tolist()]
+        pos_rows = np.repeat(
+            np.arange(nb_rows), [len(tags) for tags in pos_tags]
+        ).astype(np.int64)
+        pos_ids = _lookup(list(chain.from_iterable(pos_tags)), features["pos"])
+        rows.append(pos_rows[pos_ids >= 0])
+        cols.append(pos_ids[pos_ids >= 0])
+
+    rows = np.concatenate(rows).astype(np.int64)
+    cols = np.concatenate(cols).astype(np.int64)
+    matrix = scipy.sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.float32), (rows, cols)),
+        shape=(nb_rows, nb_features),
+    )
+    # Features that occur several times in an utterance are set only once
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+    return matrix
+
+
+def get_dense_baseline_features(
+    data: pd.DataFrame,
+    features: dict,
+    use_bi_grams: bool,
+    use_repetitions: bool = False,
+    use_pos: bool = False,
+) -> np.ndarray:
+    """Features of all utterances of the data as dense array, using `get_baseline_features_from_row`"""
+    X = data.apply(
+        lambda x: get_baseline_features_from_row(
+            features,
+            x.tokens,
+            x["speaker_code"],
+            x["prev_speaker_code"],
+            x.turn_length,
+            use_bi_grams=use_bi_grams,
+            repetitions=None
+            if not use_repetitions
+            else (x.repeated_words, x.ratio_repwords),
+            pos_tags=None if not use_pos else x.pos,
+        ),
+        axis=1,
+    )
+    return np.array(X.tolist())
+
+
+def get_features(data: pd.DataFrame, features: dict, args):
+    """Sparse (or dense, with --dense) features of the data, reports time and memory"""
+    start = time.perf_counter()
+    get = get_dense_baseline_features if args.dense else get_baseline_features
+    X = get(
+        data,
+        features,
+        use_bi_grams=args.use_bi_grams,
+        use_repetitions=args.use_repetitions,
+        use_pos=args.use_pos,
+    )
+    duration = time.perf_counter() - start
+    if scipy.sparse.issparse(X):
+        nbytes = X.data.nbytes + X.indices.nbytes + X.indptr.nbytes
+    else:
+        nbytes = X.nbytes
+    print(
+        f"Features of {X.shape[0]} utterances ({X.shape[1]} features, {'dense' if args.dense else 'sparse'}): "
+        f"{duration:.2f}s, {nbytes / 1024 ** 2:.1f} MB"
+    )
+    return X
+
+
 #### MAIN
 if __name__ == "__main__":
     args = parse_args()
@@ -185,12 +345,15 @@ if __name__ == "__main__":
 
     print("### Loading data:".upper())
 
-    data = pd.read_pickle(args.data)
+    feature_cache = (
+        FeatureCache(args.feature_cache) if args.feature_cache is not None else None
+    )
 
-    data = add_feature_columns(
-        data,
+    data = load_feature_columns(
+        args.data,
         check_repetition=args.use_repetitions,
         use_past=args.use_past,
+        feature_cache=feature_cache,
     )
 
     accuracies = []
@@ -220,29 +383,13 @@ if __name__ == "__main__":
         )
 
         # creating features set for train
-        X = data_train.apply(
-            lambda x: get_baseline_features_from_row(
-                feature_vocabs,
-                x.tokens,
-                x["speaker_code"],
-                x["prev_speaker_code"],
-                x.turn_length,
-                use_bi_grams=args.use_bi_grams,
-                repetitions=None
-                if not args.use_repetitions
-                else (x.repeated_words, x.ratio_repwords),
-                past_tokens=None if not args.use_past else x.past,
-                pos_tags=None if not args.use_pos else x.pos,
-            ),
-            axis=1,
-        )
+        X = get_features(data_train, feature_vocabs, args)
 
         y = data_train[SPEECH_ACT].tolist()
         weights = dict(Counter(y))
         # ID from label - bidict
         labels = dataset_labels(add_empty_labels=True)
         # transforming
-        X = np.array(X.tolist())
         y = np.array([labels[lab] for lab in y])  # to ID
         weights = {
             labels[lab]: v / len(y) for lab, v in weights.items()
@@ -253,25 +400,7 @@ if __name__ == "__main__":
         model.fit(X, y)
         # dump(mdl, os.path.join(name, 'baseline.joblib'))
 
-        X_test = data_test.apply(
-            lambda x: get_baseline_features_from_row(
-                feature_vocabs,
-                x.tokens,
-                x["speaker_code"],
-                x["prev_speaker_code"],
-                x.turn_length,
-                use_bi_grams=args.use_bi_grams,
-                repetitions=None
-                if not args.use_repetitions
-                else (x.repeated_words, x.ratio_repwords),
-                past_tokens=None if not args.use_past else x.past,
-                pos_tags=None if not args.use_pos else x.pos,
-            ),
-            axis=1,
-        )
-
-        # transforming
-        X_test = np.array(X_test.tolist())
+        X_test = get_features(data_test, feature_vocabs, args)
 
         y_pred = [labels.inverse[x] for x in model.predict(X_test)]
 
@@ -0,0 +1,93 @@
+"""Benchmark the sparse baseline features (get_baseline_features) against the dense ones
+(get_baseline_features_from_row for each utterance): time and memory to compute the features and to train the baseline
+models on them, checking that both give the same features."""
+
+import argparse
+import time
+from collections import Counter
+
+import numpy as np
+
+from baseline_crossvalidation import (
+    baseline_model,
+    get_baseline_features,
+    get_dense_baseline_features,
+)
+from bench_crf_features import load_data
+from crf_tagger import add_feature_columns
+from crf_train import generate_features_vocabs
+from utils import SPEECH_ACT, dataset_labels
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser(description="Benchmark the baseline features.")
+    argparser.add_argument(
+        "--data",
+        type=str,
+        default="examples/example.csv",
+        help="Path to CSV, Parquet dataset or pickle with preprocessed data",
+    )
+    argparser.add_argument(
+        "--repeat",
+        type=int,
+        default=10,
+        help="Number of times the transcripts of the data are repeated to enlarge it",
+    )
+    argparser.add_argument(
+        "--models",
+        type=str,
+        nargs="*",
+        default=["LSVC", "RF"],
+        help="Baseline models to train on the features",
+    )
+
+    args = argparser.parse_args()
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(args)
+
+    data = load_data(args.data, args.repeat)
+    if SPEECH_ACT not in data.columns:
+        # Arbitrary labels to train on
+        data[SPEECH_ACT] = np.where(data.speaker_code == "CHI", "YY", "YQ")
+    data = add_feature_columns(data, check_repetition=True)
+    feature_vocabs = generate_features_vocabs(
+        data, nb_occ=1, use_bi_grams=True, use_repetitions=True, use_pos=True
+    )
+    flags = dict(use_bi_grams=True, use_repetitions=True, use_pos=True)
+    print()
+
+    start = time.perf_counter()
+    X_dense = get_dense_baseline_features(data, feature_vocabs, **flags)
+    dense_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    X_sparse = get_baseline_features(data, feature_vocabs, **flags)
+    sparse_time = time.perf_counter() - start
+
+    sparse_bytes = X_sparse.data.nbytes + X_sparse.indices.nbytes + X_sparse.indptr.nbytes
+    print(f"{len(data)} utterances, {X_dense.shape[1]} features")
+    print(f"Dense features:  {dense_time:.2f}s, {X_dense.nbytes / 1024 ** 2:.1f} MB")
+    print(f"Sparse features: {sparse_time:.2f}s, {sparse_bytes / 1024 ** 2:.1f} MB")
+
+    identical = np.array_equal(X_dense, X_sparse.toarray())
+    print(f"Identical features: {identical}")
+
+    labels = dataset_labels(add_empty_labels=True)
+    y = np.array([labels[lab] for lab in data[SPEECH_ACT]])
+    weights = {labels[lab]: v / len(y) for lab, v in Counter(data[SPEECH_ACT]).items()}
+    for name in args.models:
+        for kind, X in [("dense", X_dense), ("sparse", X_sparse)]:
+            model = baseline_model(name, weights, True)
+            start = time.perf_counter()
+            model.fit(X, y)
+            fit_time = time.perf_counter() - start
+            accuracy = np.mean(model.predict(X) == y)
+            print(f"{name}, {kind}: fit in {fit_time:.2f}s, train accuracy {accuracy:.3f}")
+
+    if not identical:
+        raise RuntimeError("Sparse baseline features differ from the dense ones")
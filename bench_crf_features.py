@@ -0,0 +1,244 @@
+"""Benchmark loading of feature vocabularies and computation of CRF features: row-wise (get_features_from_row) vs.
+whole data (get_features_from_data), checking that both give the same features as the original row-wise
+implementation (get_features_from_row_original)."""
+
+import os
+import argparse
+import pickle
+import tempfile
+import time
+from collections import Counter
+
+import pandas as pd
+from nltk import ngrams
+
+from crf_tagger import (
+    add_feature_columns,
+    get_features_from_row,
+    get_features_from_data,
+    FeatureVocabs,
+)
+from data_store import load_utterances
+from utils import CHILD, UNKNOWN
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser(description="Benchmark CRF feature computation.")
+    argparser.add_argument(
+        "--model",
+        "-m",
+        type=str,
+        default="checkpoint_full_train",
+        help="folder containing model and features",
+    )
+    argparser.add_argument(
+        "--data",
+        type=str,
+        default="examples/example.csv",
+        help="Path to CSV, Parquet dataset or pickle with preprocessed data",
+    )
+    argparser.add_argument(
+        "--repeat",
+        type=int,
+        default=200,
+        help="Number of times the transcripts of the data are repeated to enlarge it",
+    )
+    argparser.add_argument(
+        "--use-bi-grams",
+        "-bi",
+        action="store_true",
+        help="whether to use bi-gram features to train the algorithm",
+    )
+    argparser.add_argument(
+        "--use-pos",
+        "-pos",
+        action="store_true",
+        help="whether to add POS tags to features",
+    )
+    argparser.add_argument(
+        "--use-past",
+        "-past",
+        action="store_true",
+        help="whether to add previous sentence as features",
+    )
+    argparser.add_argument(
+        "--use-repetitions",
+        "-rep",
+        action="store_true",
+        help="whether to check in data if words were repeated from previous sentence, to train the algorithm",
+    )
+
+    args = argparser.parse_args()
+
+    return args
+
+
+def load_data(path, repeat):
+    data = load_utterances(path)
+
+    # Enlarge the data by repeating its transcripts under new transcript names
+    copies = []
+    for i in range(repeat):
+        copy = data.copy()
+        copy["transcript_file"] = copy.transcript_file.astype(str) + f"_{i}"
+        copies.append(copy)
+    return pd.concat(copies, ignore_index=True)
+
+
+def time_loading(load, path, repeat=100):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        load(path)
+    return (time.perf_counter() - start) / repeat
+
+
+def load_pickle(path):
+    with open(path, "rb") as pickle_file:
+        return pickle.load(pickle_file)
+
+
+def get_features_from_row_original(
+    features: dict,
+    tokens: list,
+    speaker: str,
+    prev_speaker: str,
+    ln: int,
+    use_bi_grams,
+    **kwargs,
+):
+    """Frozen copy of the original get_features_from_row (before FeatureVocabs), as reference for the features"""
+    feat_glob = {}
+
+    feat_glob["words"] = Counter(
+        [w if w in features["words"].keys() else UNKNOWN for w in tokens]
+    )
+
+    feat_glob["speaker_code"] = 1 if speaker == CHILD else 0
+    feat_glob["speaker_changed"] = 1 if speaker != prev_speaker else 0
+
+    feat_glob["length"] = {
+        k: 1
+        for k in features["length_bins"].keys()
+        if float(k.split("-")[1]) > ln >= float(k.split("-")[0])
+    }
+
+    if use_bi_grams:
+        bi_grams = [
+            "-".join(n_gram)
+            for n_gram in ngrams(tokens[:-1], 2)
+            if n_gram in features["bigrams"].keys()
+        ]
+        feat_glob["bigrams"] = Counter(bi_grams)
+
+    if ("repetitions" in kwargs) and (kwargs["repetitions"] is not None):
+        (rep_words, ratio_rep) = kwargs["repetitions"]
+        feat_glob["repeated_words"] = Counter(
+            [w for w in rep_words if (w in features["words"].keys())]
+        )
+        feat_glob["rep_ratio"] = {
+            k: 1
+            for k in features["rep_ratio_bins"].keys()
+            if float(k.split("-")[1]) >= ratio_rep >= float(k.split("-")[0])
+        }
+    if ("prev_tokens" in kwargs) and (kwargs["prev_tokens"] is not None):
+        feat_glob["prev_tokens"] = Counter(
+            [w for w in kwargs["prev_tokens"] if (w in features["words"].keys())]
+        )
+
+    if ("pos_tags" in kwargs) and (kwargs["pos_tags"] is not None):
+        feat_glob["pos"] = Counter(
+            [w for w in kwargs["pos_tags"] if (w in features["pos"].keys())]
+        )
+
+    return feat_glob
+
+
+def features_from_rows(data, feature_vocabs, args, get_features=get_features_from_row):
+    return data.apply(
+        lambda x: get_features(
+            feature_vocabs,
+            x.tokens,
+            x.speaker_code,
+            x.prev_speaker_code,
+            x.turn_length,
+            use_bi_grams=args.use_bi_grams,
+            repetitions=None
+            if not args.use_repetitions
+            else (x.repeated_words, x.ratio_repwords),
+            prev_tokens=None if not args.use_past else x.prev_tokens,
+            pos_tags=None if not args.use_pos else x.pos,
+        ),
+        axis=1,
+    ).tolist()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(args)
+
+    features_path = os.path.join(args.model, "feature_vocabs.p")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        versioned_path = os.path.join(tmp_dir, "feature_vocabs.p")
+        FeatureVocabs.load(features_path).save(versioned_path)
+
+        time_pickle = time_loading(load_pickle, features_path)
+        time_legacy = time_loading(FeatureVocabs.load, features_path)
+        time_versioned = time_loading(FeatureVocabs.load, versioned_path)
+    for name, duration in [
+        ("Loading vocabs as pickled dict", time_pickle),
+        ("Loading legacy file (FeatureVocabs)", time_legacy),
+        ("Loading versioned file (FeatureVocabs)", time_versioned),
+    ]:
+        print(f"{name + ':':<40}{duration * 1000:.2f}ms")
+
+    feature_vocabs = FeatureVocabs.load(features_path)
+
+    data = load_data(args.data, args.repeat)
+    data = add_feature_columns(
+        data, check_repetition=args.use_repetitions, use_past=args.use_past,
+    )
+    print(f"Computing features for {len(data)} utterances")
+
+    start = time.perf_counter()
+    features_original = features_from_rows(
+        data, load_pickle(features_path), args, get_features_from_row_original
+    )
+    time_original = time.perf_counter() - start
+
+    start = time.perf_counter()
+    features_rows_dict = features_from_rows(data, load_pickle(features_path), args)
+    time_rows_dict = time.perf_counter() - start
+
+    start = time.perf_counter()
+    features_rows = features_from_rows(data, feature_vocabs, args)
+    time_rows = time.perf_counter() - start
+
+    start = time.perf_counter()
+    features_data = get_features_from_data(
+        data,
+        feature_vocabs,
+        use_bi_grams=args.use_bi_grams,
+        use_repetitions=args.use_repetitions,
+        use_past=args.use_past,
+        use_pos=args.use_pos,
+    )
+    time_data = time.perf_counter() - start
+
+    # repr also compares the order of the features and the types of their values
+    identical = repr(features_rows) == repr(features_data) == repr(features_rows_dict)
+    equal_to_original = features_original == features_data
+
+    for name, duration in [
+        ("Original get_features_from_row (dict)", time_original),
+        ("get_features_from_row (dict)", time_rows_dict),
+        ("get_features_from_row (FeatureVocabs)", time_rows),
+        ("get_features_from_data (FeatureVocabs)", time_data),
+    ]:
+        print(f"{name + ':':<40}{duration:.3f}s ({len(data) / duration:.0f} utterances/s)")
+    print(f"Speedup: {time_original / time_data:.1f}x")
+    print(f"Identical features: {identical}")
+    print(f"Same features as the original implementation: {equal_to_original}")
+    if not identical:
+        raise RuntimeError("Features computed on whole data differ from row-wise features")
+    if not equal_to_original:
+        raise RuntimeError("Features differ from those of the original get_features_from_row")
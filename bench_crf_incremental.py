@@ -0,0 +1,129 @@
+"""Benchmark incremental tagging (IncrementalTagger) against re-tagging the whole transcript after each new utterance,
+and check that it gives the same labels and marginals as tagging whole transcripts."""
+
+import os
+import argparse
+import time
+
+import numpy as np
+import pycrfsuite
+
+from bench_crf_features import load_data
+from crf_tagger import (
+    add_feature_columns,
+    get_features_from_data,
+    get_label_mask,
+    CRFWeights,
+    FeatureVocabs,
+    IncrementalTagger,
+    OOL_LABELS,
+)
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser(description="Benchmark incremental CRF tagging.")
+    argparser.add_argument(
+        "--model",
+        "-m",
+        type=str,
+        default="checkpoint_full_train",
+        help="folder containing model and features",
+    )
+    argparser.add_argument(
+        "--data",
+        type=str,
+        default="examples/example.csv",
+        help="Path to CSV, Parquet dataset or pickle with preprocessed data",
+    )
+    argparser.add_argument(
+        "--repeat",
+        type=int,
+        default=20,
+        help="Number of times the transcripts of the data are repeated to enlarge it",
+    )
+
+    args = argparser.parse_args()
+
+    return args
+
+
+def incremental_tagger(crf_weights, feature_vocabs, label_mask=None):
+    return IncrementalTagger(
+        crf_weights,
+        feature_vocabs,
+        use_bi_grams=True,
+        use_repetitions=True,
+        use_pos=True,
+        label_mask=label_mask,
+    )
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(args)
+
+    feature_vocabs = FeatureVocabs.load(os.path.join(args.model, "feature_vocabs.p"))
+    tagger = pycrfsuite.Tagger()
+    tagger.open(os.path.join(args.model, "model.pycrfsuite"))
+    crf_weights = CRFWeights(tagger)
+    label_mask = get_label_mask(tagger.labels(), OOL_LABELS)
+
+    data = load_data(args.data, args.repeat)
+    data = add_feature_columns(data, check_repetition=True)
+    data = data.assign(
+        features=get_features_from_data(
+            data, feature_vocabs, use_bi_grams=True, use_repetitions=True, use_pos=True
+        )
+    )
+
+    # Correctness: same labels as tagging whole transcripts
+    identical = True
+    for _, transcript in data.groupby("transcript_file", sort=False):
+        xseq = transcript.features.tolist()
+        incremental = incremental_tagger(crf_weights, feature_vocabs)
+        incremental_ool = incremental_tagger(crf_weights, feature_vocabs, label_mask)
+        for tokens, speaker_code, pos in zip(
+            transcript.tokens, transcript.speaker_code, transcript.pos
+        ):
+            last_label = incremental.append(tokens, speaker_code, pos)
+            incremental_ool.append(tokens, speaker_code, pos)
+
+        y_pred = tagger.tag(xseq)
+        identical &= incremental.decode() == y_pred
+        identical &= last_label == y_pred[-1]
+        identical &= incremental_ool.decode() == crf_weights.viterbi(xseq, label_mask)
+        # Marginals of the last utterance only depend on the utterances so far
+        identical &= np.allclose(
+            incremental.marginals(),
+            [tagger.marginal(label, len(xseq) - 1) for label in tagger.labels()],
+            atol=1e-6,
+        )
+    print(f"Identical labels and marginals: {identical}")
+
+    # Timing: all utterances as a single long transcript
+    utterances = list(zip(data.tokens, data.speaker_code, data.pos))
+    incremental = incremental_tagger(crf_weights, feature_vocabs)
+    append_times = []
+    for tokens, speaker_code, pos in utterances:
+        start = time.perf_counter()
+        incremental.append(tokens, speaker_code, pos)
+        append_times.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    incremental.decode()
+    decode_time = time.perf_counter() - start
+
+    xseq = data.features.tolist()
+    start = time.perf_counter()
+    tagger.tag(xseq)
+    tag_time = time.perf_counter() - start
+
+    nb = max(len(utterances) // 10, 1)
+    print(f"Transcript of {len(utterances)} utterances")
+    print(f"append(), first {nb} utterances: {np.mean(append_times[:nb]) * 1e6:.0f}us per utterance")
+    print(f"append(), last {nb} utterances: {np.mean(append_times[-nb:]) * 1e6:.0f}us per utterance")
+    print(f"decode() of the whole transcript: {decode_time * 1000:.2f}ms")
+    print(f"Re-tagging the whole transcript (tagger.tag): {tag_time * 1000:.2f}ms")
+
+    if not identical:
+        raise RuntimeError("Incremental tagging differs from tagging whole transcripts")
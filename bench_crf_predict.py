@@ -0,0 +1,109 @@
+"""Benchmark CRF predictions (crf_predict) in different prediction modes and with an increasing number of worker
+processes."""
+
+import os
+import argparse
+import time
+
+import pycrfsuite
+
+from bench_crf_features import load_data
+from crf_tagger import (
+    add_feature_columns,
+    get_features_from_data,
+    crf_predict,
+    FeatureVocabs,
+    PREDICTION_MODES,
+)
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser(description="Benchmark CRF predictions.")
+    argparser.add_argument(
+        "--model",
+        "-m",
+        type=str,
+        default="checkpoint_full_train",
+        help="folder containing model and features",
+    )
+    argparser.add_argument(
+        "--data",
+        type=str,
+        default="examples/example.csv",
+        help="Path to CSV, Parquet dataset or pickle with preprocessed data",
+    )
+    argparser.add_argument(
+        "--repeat",
+        type=int,
+        default=200,
+        help="Number of times the transcripts of the data are repeated to enlarge it",
+    )
+    argparser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, 8, 16, 32],
+        help="Numbers of worker processes to benchmark",
+    )
+    argparser.add_argument(
+        "--prediction-modes",
+        choices=PREDICTION_MODES,
+        nargs="+",
+        default=["raw"],
+        type=str,
+        help="Prediction modes to benchmark",
+    )
+
+    args = argparser.parse_args()
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(args)
+    print(f"{os.cpu_count()} CPUs available")
+
+    model_path = os.path.join(args.model, "model.pycrfsuite")
+    feature_vocabs = FeatureVocabs.load(os.path.join(args.model, "feature_vocabs.p"))
+
+    data = load_data(args.data, args.repeat)
+    data = add_feature_columns(data, check_repetition=True)
+    data = data.assign(
+        features=get_features_from_data(
+            data,
+            feature_vocabs,
+            use_bi_grams=True,
+            use_repetitions=True,
+            use_pos=True,
+        )
+    )
+    print(f"Tagging {len(data)} utterances")
+
+    tagger = pycrfsuite.Tagger()
+    tagger.open(model_path)
+
+    time_reference = None
+    for mode in args.prediction_modes:
+        y_pred_serial = None
+        for workers in args.workers:
+            start = time.perf_counter()
+            y_pred = crf_predict(
+                tagger,
+                data,
+                mode=mode,
+                workers=workers,
+                model_path=model_path,
+            )
+            duration = time.perf_counter() - start
+            if time_reference is None:
+                time_reference = duration
+            print(
+                f"{mode}, {workers} workers: {duration:.3f}s ({len(data) / duration:.0f} utterances/s, "
+                f"speedup: {time_reference / duration:.1f}x)"
+            )
+
+            if y_pred_serial is None:
+                y_pred_serial = y_pred
+            elif y_pred != y_pred_serial:
+                raise RuntimeError(f"Predictions with {workers} workers differ")
@@ -0,0 +1,174 @@
+"""Benchmark the annotation server (crf_server.py): latency of single requests and throughput of many concurrent
+requests, checking that the speech acts are the same as the ones predicted by crf_predict."""
+
+import os
+import argparse
+import json
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import pycrfsuite
+
+from bench_crf_features import load_data
+from crf_tagger import add_feature_columns, get_features_from_data, crf_predict, FeatureVocabs
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser(description="Benchmark the annotation server.")
+    argparser.add_argument(
+        "--model",
+        "-m",
+        type=str,
+        default="checkpoint_full_train",
+        help="folder containing model and features",
+    )
+    argparser.add_argument(
+        "--data",
+        type=str,
+        default="examples/example.csv",
+        help="Path to CSV, Parquet dataset or pickle with preprocessed data",
+    )
+    argparser.add_argument(
+        "--repeat",
+        type=int,
+        default=50,
+        help="Number of times the transcripts of the data are repeated to enlarge it",
+    )
+    argparser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes of the server",
+    )
+
+    args = argparser.parse_args()
+
+    return args
+
+
+def get_requests(data) -> list:
+    requests = []
+    for i, (transcript_file, transcript) in enumerate(
+        data.groupby("transcript_file", sort=False)
+    ):
+        transcript = transcript.sort_values("utterance_id")
+        requests.append(
+            {
+                "id": i,
+                "tokens": transcript.tokens.tolist(),
+                "pos": transcript.pos.tolist(),
+                "speaker_code": transcript.speaker_code.tolist(),
+            }
+        )
+    return requests
+
+
+def expected_speech_acts(data, args) -> list:
+    feature_vocabs = FeatureVocabs.load(os.path.join(args.model, "feature_vocabs.p"))
+    tagger = pycrfsuite.Tagger()
+    tagger.open(os.path.join(args.model, "model.pycrfsuite"))
+
+    data = add_feature_columns(data, check_repetition=True)
+    data = data.assign(
+        features=get_features_from_data(
+            data, feature_vocabs, use_bi_grams=True, use_repetitions=True, use_pos=True
+        )
+    )
+    data = data.assign(speech_act=crf_predict(tagger, data))
+    return [
+        transcript.speech_act.tolist()
+        for _, transcript in data.groupby("transcript_file", sort=False)
+    ]
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(args)
+
+    data = load_data(args.data, args.repeat)
+    requests = get_requests(data)
+    expected = expected_speech_acts(data, args)
+    nb_utterances = sum(len(request["tokens"]) for request in requests)
+    print(f"{len(requests)} transcripts, {nb_utterances} utterances")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        socket_path = os.path.join(tmp_dir, "crf_server.sock")
+        start = time.perf_counter()
+        server = subprocess.Popen(
+            [
+                sys.executable,
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), "crf_server.py"),
+                "--model",
+                args.model,
+                "--socket",
+                socket_path,
+                "--workers",
+                str(args.workers),
+                "--use-bi-grams",
+                "--use-pos",
+                "--use-repetitions",
+            ],
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        try:
+            for line in server.stderr:
+                if line.startswith("Listening"):
+                    break
+            print(f"Server startup: {time.perf_counter() - start:.2f}s")
+
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(socket_path)
+            stream = client.makefile("rwb")
+
+            # Latency: one request at a time
+            latencies = []
+            responses = {}
+            for request in requests:
+                start = time.perf_counter()
+                stream.write((json.dumps(request) + "\n").encode())
+                stream.flush()
+                response = json.loads(stream.readline())
+                latencies.append(
+                    (time.perf_counter() - start) / len(request["tokens"])
+                )
+                responses[response["id"]] = response["speech_acts"]
+            latencies.sort()
+            print(
+                f"Sequential requests: {sum(latencies) / len(latencies) * 1000:.3f}ms per utterance "
+                f"(median {latencies[len(latencies) // 2] * 1000:.3f}ms)"
+            )
+            identical = all(responses[i] == speech_acts for i, speech_acts in enumerate(expected))
+
+            # Throughput: all requests sent at once, and batched by the server
+            start = time.perf_counter()
+            stream.write(b"".join((json.dumps(request) + "\n").encode() for request in requests))
+            stream.flush()
+            responses = {}
+            for _ in requests:
+                response = json.loads(stream.readline())
+                responses[response["id"]] = response["speech_acts"]
+            duration = time.perf_counter() - start
+            print(
+                f"Concurrent requests: {duration:.3f}s ({nb_utterances / duration:.0f} utterances/s, "
+                f"{duration / nb_utterances * 1000:.3f}ms per utterance)"
+            )
+            identical &= all(responses[i] == speech_acts for i, speech_acts in enumerate(expected))
+
+            # Marginals
+            stream.write((json.dumps(dict(requests[0], marginals=True)) + "\n").encode())
+            stream.flush()
+            response = json.loads(stream.readline())
+            identical &= len(response["marginals"]) == len(requests[0]["tokens"])
+
+            client.close()
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(f"Identical speech acts: {identical}")
+    if not identical:
+        raise RuntimeError("Speech acts of the server differ from crf_predict")
@@ -0,0 +1,116 @@
+"""Benchmark loading utterances from the Parquet data store (data_store.py) vs. pickled data frames: whole data, and
+children's utterances at the ages of AGES only (column projection and predicate pushdown), checking that the loaded
+utterances are the same."""
+
+import os
+import argparse
+import tempfile
+import time
+
+import pandas as pd
+
+from bench_crf_features import load_data
+from data_store import load_utterances, save_utterances
+from utils import AGES, AGES_LONG, CHILD, SPEECH_ACT
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser(description="Benchmark the Parquet data store.")
+    argparser.add_argument(
+        "--data",
+        type=str,
+        default="examples/example.csv",
+        help="Path to CSV, Parquet dataset or pickle with preprocessed data",
+    )
+    argparser.add_argument(
+        "--repeat",
+        type=int,
+        default=2000,
+        help="Number of times the transcripts of the data are repeated to enlarge it",
+    )
+    argparser.add_argument(
+        "--runs",
+        type=int,
+        default=5,
+        help="Number of runs, the median duration is reported",
+    )
+
+    args = argparser.parse_args()
+
+    return args
+
+
+def time_load(load, runs: int) -> tuple:
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        data = load()
+        durations.append(time.perf_counter() - start)
+    return sorted(durations)[len(durations) // 2], data
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(args)
+
+    data = load_data(args.data, args.repeat)
+    # Spread the copies of the transcripts over several corpora and ages
+    copy_ids = data.transcript_file.str.rsplit("_", n=1).str[-1].astype(int)
+    data["corpus"] = "corpus_" + (copy_ids % 4).astype(str)
+    data["age"] = [AGES_LONG[i % len(AGES_LONG)] for i in copy_ids]
+    if SPEECH_ACT not in data.columns:
+        data[SPEECH_ACT] = "YQ"
+    data = data.drop(columns=["age_months"], errors="ignore")
+    # Copies of the transcripts share their lists of tokens, which pickle would only store once
+    for column in ["tokens", "pos"]:
+        data[column] = [list(values) for values in data[column]]
+    print(f"{len(data)} utterances")
+
+    columns = ["transcript_file", "utterance_id", "age", "tokens", SPEECH_ACT]
+    filters = [("speaker_code", "==", CHILD), ("age", "in", AGES)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pickle_path = os.path.join(tmp_dir, "utterances.p")
+        parquet_path = os.path.join(tmp_dir, "utterances.parquet")
+
+        start = time.perf_counter()
+        save_utterances(data, pickle_path)
+        print(f"Store pickle: {time.perf_counter() - start:.2f}s")
+        start = time.perf_counter()
+        save_utterances(data, parquet_path)
+        print(f"Store Parquet: {time.perf_counter() - start:.2f}s")
+
+        def load_pickle_filtered():
+            pickled = pd.read_pickle(pickle_path)
+            return pickled[
+                (pickled.speaker_code == CHILD) & pickled.age.isin(AGES)
+            ][columns]
+
+        runs = [
+            ("Load pickle", lambda: pd.read_pickle(pickle_path)),
+            ("Load Parquet", lambda: load_utterances(parquet_path)),
+            ("Load pickle, then filter", load_pickle_filtered),
+            (
+                "Load Parquet, projection and pushdown",
+                lambda: load_utterances(parquet_path, columns=columns, filters=filters),
+            ),
+        ]
+        loaded = {}
+        for name, load in runs:
+            duration, loaded[name] = time_load(load, args.runs)
+            print(f"{name + ':':<45}{duration:.3f}s ({len(loaded[name])} utterances)")
+
+    identical = True
+    for expected, result in [
+        ("Load pickle", "Load Parquet"),
+        ("Load pickle, then filter", "Load Parquet, projection and pushdown"),
+    ]:
+        try:
+            pd.testing.assert_frame_equal(loaded[expected], loaded[result], check_dtype=False)
+        except AssertionError as e:
+            print(e)
+            identical = False
+    print(f"Identical utterances: {identical}")
+
+    if not identical:
+        raise RuntimeError("Utterances loaded from Parquet differ from the pickled ones")
@@ -0,0 +1,211 @@
+"""Benchmark the batching of transcripts for the LSTM (nn_dataset.py) on synthetic transcripts:
+- collate: time to collate all training batches with one tensor per utterance (pad_sequence) vs. the flat tensors of
+  SpeechActsDataset (pad_flat), checking that both give the same batches;
+- batching: training throughput, padding efficiency and accuracy with one transcript per batch, random batches of
+  transcripts and length-bucketed batches (BucketBatchSampler), checking that batched decoding gives the same labels as
+  decoding each transcript on its own."""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+from torch import optim
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import BatchSampler, DataLoader, RandomSampler
+
+from bench_nn_training import synthetic_transcripts
+from nn_dataset import (
+    BucketBatchSampler,
+    SpeechActsDataset,
+    collate_transcripts,
+    sort_transcripts,
+)
+from nn_models import SpeechActLSTM
+from nn_train import LR_SCALINGS, evaluate, learning_rate, train_epoch
+
+VOCAB_SIZE = 200
+NB_LABELS = 10
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser(description="Benchmark the batching of transcripts.")
+    argparser.add_argument(
+        "--nb-transcripts",
+        type=int,
+        default=100,
+        help="Number of synthetic transcripts (a tenth of them are used for evaluation)",
+    )
+    argparser.add_argument(
+        "--max-transcript-length",
+        type=int,
+        default=1000,
+        help="Maximum number of utterances of the synthetic transcripts",
+    )
+    argparser.add_argument("--epochs", type=int, default=5, help="Number of training epochs")
+    argparser.add_argument(
+        "--batch-size", type=int, default=16, help="Maximum number of transcripts per batch"
+    )
+    argparser.add_argument(
+        "--max-tokens",
+        type=int,
+        default=100000,
+        help="Maximum number of (padded) tokens per bucketed batch",
+    )
+    argparser.add_argument(
+        "--lr", type=float, default=0.005, help="learning rate for one transcript per batch"
+    )
+    argparser.add_argument(
+        "--lr-scaling",
+        choices=LR_SCALINGS,
+        default="none",
+        help="scaling of the learning rate with the number of transcripts per batch",
+    )
+    argparser.add_argument("--seed", type=int, default=1111, help="random seed")
+
+    args = argparser.parse_args()
+
+    return args
+
+
+def collate_lists(transcripts):
+    """Collate transcripts given as lists of utterances and labels, with one tensor per utterance"""
+    utterances = [
+        torch.LongTensor(utterance) for transcript in transcripts for utterance in transcript[0]
+    ]
+    return (
+        pad_sequence(utterances),
+        torch.LongTensor([len(utterance) for utterance in utterances]),
+        pad_sequence([torch.LongTensor(transcript[1]) for transcript in transcripts]),
+        torch.LongTensor([len(transcript[1]) for transcript in transcripts]),
+    )
+
+
+def timed(function) -> tuple:
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def training_args(args):
+    return argparse.Namespace(
+        clip=0.25,
+        log_interval=10 ** 9,
+        dry_run=False,
+        window_size=None,
+        window_overlap=0,
+        accumulation_steps=1,
+        bf16=False,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(args)
+
+    data = synthetic_transcripts(
+        args.nb_transcripts, args.max_transcript_length, VOCAB_SIZE, NB_LABELS, args.seed
+    )
+    nb_train = int(len(data) * 0.9)
+    data_train, data_test = data.iloc[:nb_train], data.iloc[nb_train:]
+    dataset_train = SpeechActsDataset(data_train)
+    dataset_test = SpeechActsDataset(data_test)
+    bucketed = BucketBatchSampler(
+        dataset_train, args.max_tokens, args.batch_size, shuffle=True, seed=args.seed
+    )
+    print(
+        f"{len(dataset_train)} training transcripts, {len(dataset_train.utterance_lengths)} utterances, "
+        f"{len(dataset_train.tokens)} tokens"
+    )
+
+    # Collate
+    batches = bucketed.batches
+    list_time, list_batches = timed(
+        lambda: [
+            collate_lists(
+                sort_transcripts(
+                    [(data_train.utterances.iloc[i], data_train.labels.iloc[i]) for i in batch]
+                )
+            )
+            for batch in batches
+        ]
+    )
+    flat_time, flat_batches = timed(
+        lambda: [collate_transcripts([dataset_train[i] for i in batch]) for batch in batches]
+    )
+    identical = all(
+        all(torch.equal(a, b) for a, b in zip(expected, result[:4]))
+        for expected, result in zip(list_batches, flat_batches)
+    )
+    print(f"\nCollate {len(batches)} batches:")
+    print(f"One tensor per utterance: {list_time:.3f}s")
+    print(f"Flat tensors:             {flat_time:.3f}s")
+    print(f"Identical batches: {identical}")
+
+    # Batching
+    random_batches = BatchSampler(
+        RandomSampler(dataset_train, generator=torch.Generator().manual_seed(args.seed)),
+        args.batch_size,
+        drop_last=False,
+    )
+    # Name, batch sampler and maximum number of transcripts per batch (to scale the learning rate)
+    configurations = [
+        ("1 transcript per batch", BatchSampler(RandomSampler(dataset_train), 1, False), 1),
+        (f"random batches of {args.batch_size}", random_batches, args.batch_size),
+        (f"bucketed, <= {args.max_tokens} tokens", bucketed, args.batch_size),
+    ]
+    test_loader = DataLoader(
+        dataset_test,
+        batch_sampler=BucketBatchSampler(dataset_test, args.max_tokens, args.batch_size),
+        collate_fn=collate_transcripts,
+    )
+    print(f"\n{'':<32}{'lr':>10}{'utt./s':>10}{'tokens':>10}{'utt.':>10}{'accuracy':>10}")
+    for name, batch_sampler, batch_size in configurations:
+        torch.manual_seed(args.seed)
+        model = SpeechActLSTM(VOCAB_SIZE, 100, 100, 50, 1, 0.0, NB_LABELS)
+        lr = learning_rate(
+            argparse.Namespace(lr=args.lr, lr_scaling=args.lr_scaling, batch_size=batch_size)
+        )
+        optimizer = optim.Adam(model.parameters(), lr=lr)
+
+        duration = 0
+        efficiencies = []
+        for epoch in range(1, args.epochs + 1):
+            epoch_batches = list(batch_sampler)
+            efficiencies.append(bucketed.padding_efficiency(epoch_batches))
+            train_loader = DataLoader(
+                dataset_train, batch_sampler=epoch_batches, collate_fn=collate_transcripts
+            )
+            epoch_time, _ = timed(
+                lambda: train_epoch(model, optimizer, train_loader, epoch, training_args(args))
+            )
+            duration += epoch_time
+        _, accuracy = evaluate(model, test_loader, training_args(args))
+
+        nb_utterances = len(dataset_train.utterance_lengths) * args.epochs
+        print(
+            f"{name:<32}{lr:>10.4f}{nb_utterances / duration:>10.0f}"
+            f"{np.mean([e['tokens'] for e in efficiencies]):>10.2f}"
+            f"{np.mean([e['utterances'] for e in efficiencies]):>10.2f}{accuracy:>10.3f}"
+        )
+
+    # Decoding a batch of transcripts gives the same labels as decoding each transcript on its own
+    model.eval()
+    with torch.no_grad():
+        utterances, utterance_lengths, _, sequence_lengths, _ = collate_transcripts(
+            [dataset_test[i] for i in range(len(dataset_test))]
+        )
+        batched = model.forward_decode(utterances, utterance_lengths, sequence_lengths)
+        single = []
+        for i in sorted(
+            range(len(dataset_test)), key=lambda i: len(dataset_test[i][1]), reverse=True
+        ):
+            utterances, utterance_lengths, _, sequence_lengths, _ = collate_transcripts(
+                [dataset_test[i]]
+            )
+            single += model.forward_decode(utterances, utterance_lengths, sequence_lengths)
+    print(f"\nBatched decoding identical to decoding single transcripts: {batched == single}")
+
+    if not identical or batched != single:
+        raise RuntimeError("Batching changed the batches or the predicted labels")
@@ -0,0 +1,183 @@
+"""Benchmark the training options of nn_train.py on CPU: bfloat16 autocast, gradient accumulation, number of threads,
+torch.compile and windowed training. The LSTM model is trained for the same number of epochs on synthetic transcripts with each set of
+options, reporting the training throughput (utterances per second) and the accuracy on held-out transcripts.
+
+Each configuration runs in a new process, as the number of inter-op threads can only be set once per process.
+
+torch.compile: when compiled for static shapes, the model was recompiled for almost every bucketed batch. With 30
+short transcripts on CPU, 2 epochs did not finish within about 5 minutes, against 1s without compiling. The model
+is now compiled for dynamic shapes (see nn_train.compile_model). Only use --compile if this benchmark shows a gain
+over fp32, including the compilation time."""
+
+import argparse
+import multiprocessing
+import time
+
+import numpy as np
+import pandas as pd
+
+NB_SPECIAL_TOKENS = 4
+SPEAKER_TOKENS = [1, 2]
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser(description="Benchmark the training options of the LSTM.")
+    argparser.add_argument(
+        "--nb-transcripts",
+        type=int,
+        default=200,
+        help="Number of synthetic transcripts (a tenth of them are used for evaluation)",
+    )
+    argparser.add_argument(
+        "--max-transcript-length",
+        type=int,
+        default=500,
+        help="Maximum number of utterances of the synthetic transcripts",
+    )
+    argparser.add_argument("--epochs", type=int, default=3, help="Number of training epochs")
+    argparser.add_argument(
+        "--batch-size", type=int, default=8, help="Maximum number of transcripts per batch"
+    )
+    argparser.add_argument(
+        "--threads",
+        type=int,
+        nargs="*",
+        default=[1, 4],
+        help="Numbers of intra-op threads to compare",
+    )
+
+    args = argparser.parse_args()
+
+    return args
+
+
+def synthetic_transcripts(nb_transcripts, max_transcript_length, vocab_size, nb_labels, seed):
+    """Transcripts of random tokens (as in nn_train.prepare_data), in which the label of an utterance is determined by
+    its last token and the speaker"""
+    random = np.random.RandomState(seed)
+    transcripts = []
+    for _ in range(nb_transcripts):
+        nb_utterances = random.randint(20, max_transcript_length + 1)
+        utterances = [
+            [int(random.choice(SPEAKER_TOKENS))]
+            + random.randint(NB_SPECIAL_TOKENS, vocab_size, random.randint(1, 15)).tolist()
+            for _ in range(nb_utterances)
+        ]
+        labels = [
+            (utterance[-1] + utterance[0] * 7) % nb_labels for utterance in utterances
+        ]
+        transcripts.append(
+            {"utterances": utterances, "labels": labels, "age_months": 30}
+        )
+    return pd.DataFrame(transcripts)
+
+
+def run_configuration(configuration):
+    """Train the model with the options of the configuration, return utterances per second and accuracy"""
+    import torch
+    from torch import optim
+    from torch.utils.data import DataLoader
+
+    from nn_dataset import BucketBatchSampler, SpeechActsDataset, collate_transcripts
+    from nn_models import SpeechActLSTM
+    from nn_train import compile_model, evaluate, set_num_threads, train_epoch
+
+    args = argparse.Namespace(**configuration)
+    set_num_threads(args)
+    torch.manual_seed(args.seed)
+
+    data = synthetic_transcripts(
+        args.nb_transcripts, args.max_transcript_length, args.vocab_size, args.nb_labels, args.seed
+    )
+    nb_train = int(len(data) * 0.9)
+    loaders = []
+    for dataset, shuffle in [
+        (SpeechActsDataset(data.iloc[:nb_train]), True),
+        (SpeechActsDataset(data.iloc[nb_train:]), False),
+    ]:
+        sampler = BucketBatchSampler(
+            dataset, args.max_tokens, args.batch_size, shuffle=shuffle, seed=args.seed
+        )
+        loaders.append(
+            DataLoader(dataset, batch_sampler=sampler, collate_fn=collate_transcripts)
+        )
+    train_loader, test_loader = loaders
+    nb_utterances = len(train_loader.dataset.utterance_lengths)
+
+    model = SpeechActLSTM(args.vocab_size, 100, 100, 50, 1, 0.1, args.nb_labels)
+    optimizer = optim.Adam(model.parameters(), lr=args.lr)
+    forward = compile_model(model) if args.compile else model
+
+    start = time.perf_counter()
+    for epoch in range(1, args.epochs + 1):
+        train_epoch(model, optimizer, train_loader, epoch, args, forward)
+    duration = time.perf_counter() - start
+
+    _, accuracy = evaluate(model, test_loader, args)
+    return {
+        "utterances/s": nb_utterances * args.epochs / duration,
+        "accuracy": accuracy,
+    }
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(args)
+
+    defaults = dict(
+        nb_transcripts=args.nb_transcripts,
+        max_transcript_length=args.max_transcript_length,
+        epochs=args.epochs,
+        batch_size=args.batch_size,
+        vocab_size=200,
+        nb_labels=10,
+        seed=1111,
+        lr=0.005,
+        max_tokens=100000,
+        clip=0.25,
+        log_interval=10 ** 9,
+        dry_run=False,
+        window_size=None,
+        window_overlap=0,
+        accumulation_steps=1,
+        bf16=False,
+        compile=False,
+        num_threads=args.threads[-1],
+        num_interop_threads=1,
+    )
+    configurations = [("fp32", {})]
+    configurations += [("bf16 autocast", dict(bf16=True))]
+    # Batches of a quarter of the size, with the gradients of 4 batches per update
+    configurations += [
+        (
+            "accumulation x4",
+            dict(batch_size=max(args.batch_size // 4, 1), accumulation_steps=4),
+        )
+    ]
+    configurations += [
+        (f"{threads} threads", dict(num_threads=threads)) for threads in args.threads[:-1]
+    ]
+    configurations += [("torch.compile", dict(compile=True))]
+    # Truncated backpropagation through time (nn_train.backward_windows)
+    configurations += [
+        ("windows of 50 utterances", dict(window_size=50, window_overlap=10)),
+        (
+            "windows of 50 utterances, accumulation x4",
+            dict(
+                window_size=50,
+                window_overlap=10,
+                batch_size=max(args.batch_size // 4, 1),
+                accumulation_steps=4,
+            ),
+        ),
+    ]
+
+    results = []
+    for name, options in configurations:
+        print(f"\n{name}")
+        with multiprocessing.get_context("spawn").Pool(1) as pool:
+            result = pool.apply(run_configuration, ({**defaults, **options},))
+        results.append(dict(configuration=name, **result))
+
+    print()
+    print(pd.DataFrame(results).set_index("configuration").round(3).to_string())
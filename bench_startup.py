@@ -0,0 +1,84 @@
+"""Measure the startup time of crf_annotate.py (--help and annotation of the example data) and check that it stays
+within a time budget. Runs are started from a temporary directory, to make sure that the script does not depend on the
+working directory."""
+
+import os
+import argparse
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser(description="Benchmark the startup time of crf_annotate.py.")
+    argparser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="Number of runs, the median duration is compared to the budget",
+    )
+    argparser.add_argument(
+        "--help-budget",
+        type=float,
+        default=1.5,
+        help="Maximum time in seconds for crf_annotate.py --help",
+    )
+    argparser.add_argument(
+        "--example-budget",
+        type=float,
+        default=2.5,
+        help="Maximum time in seconds to annotate examples/example.csv",
+    )
+
+    args = argparser.parse_args()
+
+    return args
+
+
+def time_command(command: list, cwd: str, repeat: int) -> float:
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    script = os.path.join(REPO_DIR, "crf_annotate.py")
+    within_budget = True
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        runs = [
+            ("crf_annotate.py --help", [sys.executable, script, "--help"], args.help_budget),
+            (
+                "crf_annotate.py on examples/example.csv",
+                [
+                    sys.executable,
+                    script,
+                    "--model",
+                    os.path.join(REPO_DIR, "checkpoint_full_train"),
+                    "--data",
+                    os.path.join(REPO_DIR, "examples", "example.csv"),
+                    "--out",
+                    os.path.join(tmp_dir, "out", "example.csv"),
+                    "--use-pos",
+                    "--use-bi-grams",
+                    "--use-repetitions",
+                ],
+                args.example_budget,
+            ),
+        ]
+        for name, command, budget in runs:
+            duration = time_command(command, tmp_dir, args.repeat)
+            ok = duration <= budget
+            within_budget &= ok
+            print(f"{name + ':':<45}{duration:.2f}s (budget: {budget:.2f}s) {'OK' if ok else 'OVER BUDGET'}")
+
+    if not within_budget:
+        sys.exit(1)
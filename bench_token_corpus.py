@@ -0,0 +1,159 @@
+"""Benchmark analyses on the integer-encoded token corpus (token_corpus.py) vs. the data frame of utterances: memory of
+the loaded data, token and bigram counts, speech act frequencies and CRF features, checking that the results are the
+same."""
+
+import os
+import argparse
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from itertools import chain
+
+from bench_crf_features import load_data
+from crf_tagger import (
+    add_feature_columns,
+    get_features_from_data,
+    get_features_from_corpus,
+    FeatureVocabs,
+)
+from crf_train import get_n_grams_counter
+from data_store import load_utterances, save_utterances
+from token_corpus import TokenCorpus
+from utils import calculate_frequencies, CHILD, SPEECH_ACT
+
+COLUMNS = ["transcript_file", "utterance_id", "speaker_code", "age", "tokens", "pos", SPEECH_ACT]
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser(description="Benchmark the token corpus.")
+    argparser.add_argument(
+        "--model",
+        "-m",
+        type=str,
+        default="checkpoint_full_train",
+        help="folder containing model and features",
+    )
+    argparser.add_argument(
+        "--data",
+        type=str,
+        default="examples/example.csv",
+        help="Path to CSV, Parquet dataset or pickle with preprocessed data",
+    )
+    argparser.add_argument(
+        "--repeat",
+        type=int,
+        default=1000,
+        help="Number of times the transcripts of the data are repeated to enlarge it",
+    )
+
+    args = argparser.parse_args()
+
+    return args
+
+
+def measure(function) -> tuple:
+    """Duration, memory allocated (and still in use) by the function, and its result"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function()
+    duration = time.perf_counter() - start
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return duration, memory, result
+
+
+def timed(function) -> tuple:
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(args)
+
+    feature_vocabs = FeatureVocabs.load(os.path.join(args.model, "feature_vocabs.p"))
+
+    data = load_data(args.data, args.repeat)
+    if SPEECH_ACT not in data.columns:
+        data[SPEECH_ACT] = "YQ"
+    # Copies of the transcripts share their lists of tokens
+    for column in ["tokens", "pos"]:
+        data[column] = [list(values) for values in data[column]]
+    data = data[[column for column in COLUMNS if column in data.columns]]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        parquet_path = os.path.join(tmp_dir, "utterances.parquet")
+        corpus_path = os.path.join(tmp_dir, "corpus")
+        save_utterances(data, parquet_path)
+        start = time.perf_counter()
+        TokenCorpus.from_data(data).save(corpus_path)
+        print(f"Create corpus: {time.perf_counter() - start:.2f}s")
+        del data
+
+        load_time, data_memory, data = measure(lambda: load_utterances(parquet_path))
+        print(
+            f"Data frame of {len(data)} utterances: loaded in {load_time:.2f}s, "
+            f"{data_memory / 1024 ** 2:.1f} MB allocated"
+        )
+        load_time, corpus_memory, corpus = measure(lambda: TokenCorpus.load(corpus_path))
+        print(
+            f"Token corpus ({len(corpus.tokens)} tokens, {len(corpus.strings)} strings): loaded in "
+            f"{load_time:.3f}s, {corpus_memory / 1024 ** 2:.1f} MB allocated "
+            f"(+ {corpus.nbytes() / 1024 ** 2:.1f} MB of memory-mapped arrays)"
+        )
+
+        identical = True
+        data = data.sort_values(["transcript_file", "utterance_id"])
+        speech_acts_children = data[data.speaker_code == CHILD][SPEECH_ACT]
+        children = corpus.speaker_codes == corpus.interner.get(CHILD)
+        analyses = [
+            (
+                "Token counts",
+                lambda: Counter(chain.from_iterable(data.tokens)),
+                lambda: corpus.counter(corpus.tokens),
+            ),
+            (
+                "Bigram counts",
+                lambda: get_n_grams_counter(data.tokens.tolist(), 2),
+                lambda: get_n_grams_counter(corpus, 2),
+            ),
+            (
+                "Speech act frequencies of children",
+                lambda: calculate_frequencies(speech_acts_children),
+                lambda: corpus.frequencies(corpus.speech_acts[children]),
+            ),
+            (
+                "CRF features",
+                lambda: get_features_from_data(
+                    add_feature_columns(data, check_repetition=True),
+                    feature_vocabs,
+                    use_bi_grams=True,
+                    use_repetitions=True,
+                    use_pos=True,
+                ),
+                lambda: get_features_from_corpus(
+                    corpus, feature_vocabs, use_bi_grams=True, use_repetitions=True, use_pos=True
+                ),
+            ),
+            (
+                "CRF features (previous tokens)",
+                lambda: get_features_from_data(
+                    add_feature_columns(data, use_past=True), feature_vocabs, use_bi_grams=False, use_past=True
+                ),
+                lambda: get_features_from_corpus(
+                    corpus, feature_vocabs, use_bi_grams=False, use_past=True
+                ),
+            ),
+        ]
+        print(f"{'':<36}{'Data frame':>12}{'Corpus':>12}")
+        for name, on_data, on_corpus in analyses:
+            data_time, expected = timed(on_data)
+            corpus_time, result = timed(on_corpus)
+            identical &= expected == result
+            print(f"{name + ':':<36}{data_time:>11.3f}s{corpus_time:>11.3f}s")
+        print(f"Identical results: {identical}")
+
+    if not identical:
+        raise RuntimeError("Analyses on the token corpus differ from the ones on the data frame")
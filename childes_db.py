@@ -0,0 +1,192 @@
+"""Extraction of transcripts and utterances from childes-db.
+
+Data is read either from a live childes-db server (through childespy), or from a local SQLite or DuckDB mirror of the
+childes-db schema (tables `corpus`, `transcript` and `utterance`). From a mirror, the utterances of all corpora are
+read with a single query, joined with the transcripts to skip transcripts without age of the child.
+
+Query results are cached on disk per version of the database and corpus (`cache_dir/<version>/<corpus>.*.parquet`),
+each corpus being stored as soon as it has been read: an interrupted extraction resumes with the corpora that are
+missing, and repeated runs do not query the database again.
+"""
+
+import os
+from itertools import chain, groupby
+from operator import itemgetter
+from urllib.parse import quote
+
+import pandas as pd
+
+# Number of rows fetched at once from a mirror
+FETCH_SIZE = 100000
+
+CORPORA_SQL = """
+SELECT id AS corpus_id, name AS corpus_name, collection_name
+FROM corpus
+ORDER BY id
+"""
+
+TRANSCRIPTS_SQL = """
+SELECT corpus_id, id AS transcript_id, target_child_age
+FROM transcript
+WHERE corpus_id IN ({corpus_ids})
+ORDER BY corpus_id, id
+"""
+
+UTTERANCES_SQL = """
+SELECT u.corpus_id, u.transcript_id, u.utterance_order, u.gloss, u.type, u.part_of_speech, u.speaker_role,
+    u.target_child_id
+FROM utterance AS u
+JOIN transcript AS t ON t.id = u.transcript_id
+WHERE u.language = ? AND u.corpus_id IN ({corpus_ids}) AND t.target_child_age IS NOT NULL
+ORDER BY u.corpus_id
+"""
+
+
+class LiveChildesDB:
+    """childes-db server, queried corpus by corpus with childespy"""
+
+    def __init__(self, db_args: dict = None):
+        self.db_args = db_args
+
+    @property
+    def version(self):
+        """Name of the database, None for the current version of childes-db (which is then not cached)"""
+        return self.db_args["db_name"] if self.db_args else None
+
+    def corpora(self) -> pd.DataFrame:
+        from childespy.childespy import get_corpora
+
+        return get_corpora(db_args=self.db_args)
+
+    def corpus_tables(self, corpora: list, language: str):
+        from childespy.childespy import get_transcripts, get_utterances
+
+        for corpus_name in corpora:
+            transcripts = get_transcripts(corpus=corpus_name, db_args=self.db_args)
+            utts = get_utterances(corpus=corpus_name, language=language, db_args=self.db_args)
+            yield corpus_name, transcripts, utts
+
+
+class MirrorChildesDB:
+    """Local SQLite (or DuckDB, for paths ending in .duckdb) copy of childes-db, opened read-only"""
+
+    def __init__(self, path: str, version: str = None):
+        self.path = os.path.expanduser(path)
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(f"childes-db mirror not found: {self.path}")
+        if self.path.endswith(".duckdb"):
+            import duckdb
+
+            self.connection = duckdb.connect(self.path, read_only=True)
+        else:
+            import sqlite3
+
+            self.connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+
+        if version is None:
+            # Changes whenever the mirror is replaced
+            stat = os.stat(self.path)
+            version = f"{os.path.basename(self.path)}-{stat.st_size}-{stat.st_mtime_ns}"
+        self.version = version
+        self.corpus_ids = None
+
+    def query(self, sql: str, params: list = ()) -> pd.DataFrame:
+        cursor = self.connection.execute(sql, list(params))
+        return pd.DataFrame(
+            cursor.fetchall(), columns=[column[0] for column in cursor.description]
+        )
+
+    def corpora(self) -> pd.DataFrame:
+        corpora = self.query(CORPORA_SQL)
+        self.corpus_ids = dict(zip(corpora.corpus_name, corpora.corpus_id))
+        return corpora
+
+    def corpus_tables(self, corpora: list, language: str):
+        """Transcripts and utterances of the corpora (in the order of their ids), read with a single query per table"""
+        if self.corpus_ids is None:
+            self.corpora()
+        corpora = sorted(corpora, key=self.corpus_ids.get)
+        corpus_ids = [self.corpus_ids[corpus_name] for corpus_name in corpora]
+        placeholders = ", ".join("?" * len(corpus_ids))
+
+        transcripts = self.query(TRANSCRIPTS_SQL.format(corpus_ids=placeholders), corpus_ids)
+        transcripts_by_corpus = dict(tuple(transcripts.groupby("corpus_id", sort=False)))
+
+        cursor = self.connection.execute(
+            UTTERANCES_SQL.format(corpus_ids=placeholders), [language] + corpus_ids
+        )
+        columns = [column[0] for column in cursor.description]
+        rows = chain.from_iterable(iter(lambda: cursor.fetchmany(FETCH_SIZE), []))
+        # Utterances are ordered by corpus: consume them corpus by corpus
+        groups = groupby(rows, key=itemgetter(0))
+        group = next(groups, None)
+        for corpus_name, corpus_id in zip(corpora, corpus_ids):
+            utt_rows = []
+            if group is not None and group[0] == corpus_id:
+                utt_rows = list(group[1])
+                group = next(groups, None)
+
+            corpus_transcripts = transcripts_by_corpus.get(corpus_id, transcripts.iloc[:0])
+            yield (
+                corpus_name,
+                corpus_transcripts.drop(columns="corpus_id").reset_index(drop=True),
+                pd.DataFrame(utt_rows, columns=columns).drop(columns="corpus_id"),
+            )
+
+
+class QueryCache:
+    """Transcripts and utterances of each corpus, stored as Parquet files per database version"""
+
+    def __init__(self, cache_dir: str, version: str):
+        self.dir = os.path.join(os.path.expanduser(cache_dir), quote(version, safe=""))
+
+    def path(self, corpus_name: str, table: str) -> str:
+        return os.path.join(self.dir, f"{quote(corpus_name, safe='')}.{table}.parquet")
+
+    def has(self, corpus_name: str) -> bool:
+        return all(
+            os.path.exists(self.path(corpus_name, table)) for table in ["utterances", "transcripts"]
+        )
+
+    def load(self, corpus_name: str) -> tuple:
+        return (
+            pd.read_parquet(self.path(corpus_name, "transcripts")),
+            pd.read_parquet(self.path(corpus_name, "utterances")),
+        )
+
+    def store(self, corpus_name: str, transcripts: pd.DataFrame, utts: pd.DataFrame):
+        os.makedirs(self.dir, exist_ok=True)
+        # The transcripts are stored last: a corpus is only considered cached once both files are complete
+        for table, data in [("utterances", utts), ("transcripts", transcripts)]:
+            tmp_path = self.path(corpus_name, table) + ".tmp"
+            data.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, self.path(corpus_name, table))
+
+
+def load_corpus_tables(db, corpora: list, language: str = "eng", cache: QueryCache = None):
+    """Transcripts and utterances of the corpora, in the order of the corpora.
+
+    Corpora found in the cache are read from it, the others are queried (with a single query for all of them from a
+    mirror) and added to the cache.
+
+    Yields:
+        (corpus name, transcripts, utterances) for each corpus, with childespy's column names
+    """
+    missing = [
+        corpus_name for corpus_name in corpora if cache is None or not cache.has(corpus_name)
+    ]
+    queried = {}
+    results = db.corpus_tables(missing, language) if missing else iter(())
+    for corpus_name in corpora:
+        if corpus_name not in missing:
+            print(f"{corpus_name} (cached)")
+            yield (corpus_name,) + cache.load(corpus_name)
+            continue
+        # Queries can return corpora in a different order: keep the ones that come before
+        while corpus_name not in queried:
+            queried_name, transcripts, utts = next(results)
+            if cache is not None:
+                cache.store(queried_name, transcripts, utts)
+            queried[queried_name] = (transcripts, utts)
+        print(corpus_name)
+        yield (corpus_name,) + queried.pop(corpus_name)
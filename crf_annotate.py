@@ -2,17 +2,21 @@ import os
 import pickle
 import argparse
 from ast import literal_eval
-
-import seaborn as sns
+from collections import Counter
 
 import pandas as pd
-import matplotlib.pyplot as plt
-from scipy.stats import entropy
 import pycrfsuite
 
-from crf_test import crf_predict
-from crf_train import get_features_from_row, add_feature_columns
-from utils import CHILD
+from crf_tagger import (
+    add_feature_columns,
+    load_feature_columns,
+    get_cached_features_from_data,
+    crf_predict,
+    FeatureVocabs,
+)
+from data_store import is_parquet, save_utterances
+from feature_cache import FeatureCache
+from utils import CHILD, SPEECH_ACT
 from utils import calculate_frequencies
 
 
@@ -29,14 +33,41 @@ def parse_args():
         "--data",
         type=str,
         required=True,
-        help="Path to CSV with preprocessed data to annotate",
+        help="Path to CSV (or Parquet dataset, pickle) with preprocessed data to annotate",
     )
     argparser.add_argument(
-        "--out", type=str, required=True, help="Path to store output file."
+        "--out",
+        type=str,
+        required=True,
+        help="Path to store output file (CSV, or Parquet dataset if it ends in .parquet, else pickle).",
     )
     argparser.add_argument(
         "--compare", type=str, help="Path to frequencies to compare to"
     )
+    argparser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Read the CSV in chunks and append the annotations of each complete transcript to the output "
+        "(utterances of a transcript need to be in consecutive rows)",
+    )
+    argparser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=100000,
+        help="Number of CSV rows read at once in --stream mode",
+    )
+    argparser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes tagging transcripts in parallel",
+    )
+    argparser.add_argument(
+        "--feature-cache",
+        type=str,
+        default=None,
+        help="Directory to cache computed features in (e.g. ~/data/speech_acts/feature_cache/)",
+    )
     argparser.add_argument(
         "--use-bi-grams",
         "-bi",
@@ -68,6 +99,11 @@ def parse_args():
 
 
 def compare_frequencies(frequencies, args):
+    # Plotting libraries are slow to import and only needed here
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+    from scipy.stats import entropy
+
     gold_frequencies = pickle.load(open(args.compare, "rb"))
     frequencies = {k: frequencies[k] for k in gold_frequencies.keys()}
     kl_divergence = entropy(
@@ -88,53 +124,75 @@ def compare_frequencies(frequencies, args):
     plt.show()
 
 
-if __name__ == "__main__":
-    args = parse_args()
-    print(args)
+def read_transcripts(data_path: str, chunk_size: int):
+    """Read a CSV in chunks of rows and yield data frames that only contain complete transcripts.
 
-    if args.data.endswith(".csv"):
-        # Loading data
-        data = pd.read_csv(args.data, converters={"pos": literal_eval, "tokens": literal_eval})
-    else:
-        # Loading data
-        data = pd.read_pickle(args.data)
+    The utterances of each transcript need to be stored in consecutive rows of the CSV, so that a transcript is
+    complete as soon as the next one starts. Memory usage is thus bounded by the chunk size and the largest transcript.
+    """
+    completed_transcripts = set()
+    pending = None
+    for chunk in pd.read_csv(
+        data_path,
+        converters={"pos": literal_eval, "tokens": literal_eval},
+        chunksize=chunk_size,
+    ):
+        if pending is not None:
+            chunk = pd.concat([pending, chunk], ignore_index=True)
 
-    # Loading model
-    model_path = os.path.join(args.model, "model.pycrfsuite")
-    features_path = os.path.join(args.model, "feature_vocabs.p")
+        # Transcripts in order of appearance, one entry per run of consecutive rows
+        transcript_starts = chunk.transcript_file != chunk.transcript_file.shift(1)
+        transcripts = chunk.transcript_file[transcript_starts]
+        if (
+            transcripts.duplicated().any()
+            or transcripts.isin(completed_transcripts).any()
+        ):
+            raise ValueError(
+                "Utterances of a transcript are not stored in consecutive rows, sort the data by transcript_file or "
+                "annotate it without --stream"
+            )
 
-    # Loading features
-    with open(features_path, "rb") as pickle_file:
-        feature_vocabs = pickle.load(pickle_file)
+        # The last transcript of the chunk may continue in the next chunk
+        last_transcript = chunk.transcript_file == transcripts.iloc[-1]
+        pending = chunk[last_transcript]
+        complete = chunk[~last_transcript]
+        if len(complete) > 0:
+            completed_transcripts.update(transcripts.iloc[:-1])
+            yield complete
+
+    if pending is not None:
+        yield pending
 
-    data = add_feature_columns(
-        data, check_repetition=args.use_repetitions, use_past=args.use_past,
-    )
 
+def annotate(
+    data: pd.DataFrame,
+    feature_vocabs: FeatureVocabs,
+    tagger: pycrfsuite.Tagger,
+    args,
+    feature_cache: FeatureCache = None,
+) -> pd.DataFrame:
+    """Predict the speech acts of the data (with feature columns, see `add_feature_columns`), returns the data with
+    an additional speech_act column"""
     data = data.assign(
-        features=data.apply(
-            lambda x: get_features_from_row(
-                feature_vocabs,
-                x.tokens,
-                x.speaker_code,
-                x.prev_speaker_code,
-                x.turn_length,
-                use_bi_grams=args.use_bi_grams,
-                repetitions=None
-                if not args.use_repetitions
-                else (x.repeated_words, x.ratio_repwords),
-                prev_tokens=None if not args.use_past else x.past,
-                pos_tags=None if not args.use_pos else x.pos,
-            ),
-            axis=1,
+        features=get_cached_features_from_data(
+            feature_cache,
+            args.data,
+            data,
+            feature_vocabs,
+            use_bi_grams=args.use_bi_grams,
+            use_repetitions=args.use_repetitions,
+            use_past=args.use_past,
+            use_pos=args.use_pos,
         )
     )
 
     # Predictions
-    tagger = pycrfsuite.Tagger()
-    tagger.open(model_path)
-
-    y_pred = crf_predict(tagger, data)
+    y_pred = crf_predict(
+        tagger,
+        data,
+        workers=args.workers,
+        model_path=os.path.join(args.model, "model.pycrfsuite"),
+    )
     data = data.assign(speech_act=y_pred)
 
     # Filter for important columns
@@ -147,17 +205,76 @@ if __name__ == "__main__":
             "ratio_repwords",
             "turn_length",
             "features",
-        ]
+        ],
+        errors="ignore",
+    )
+
+    return data_filtered
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(args)
+
+    if args.stream and not (args.data.endswith(".csv") and (args.out.endswith(".csv") or is_parquet(args.out))):
+        raise ValueError("--stream is only supported for CSV input and CSV or Parquet output files")
+
+    # Loading model
+    model_path = os.path.join(args.model, "model.pycrfsuite")
+    features_path = os.path.join(args.model, "feature_vocabs.p")
+
+    # Loading features
+    feature_vocabs = FeatureVocabs.load(features_path)
+
+    tagger = pycrfsuite.Tagger()
+    tagger.open(model_path)
+
+    feature_cache = (
+        FeatureCache(args.feature_cache) if args.feature_cache is not None else None
     )
 
     os.makedirs(os.path.dirname(args.out), exist_ok=True)
 
-    if args.data.endswith(".csv"):
-        data_filtered.to_csv(args.out, index=False)
+    if args.stream:
+        # Counts of the children's speech acts, so that memory usage does not grow with the number of chunks
+        speech_acts_children = Counter()
+        for i, data in enumerate(read_transcripts(args.data, args.chunk_size)):
+            data = add_feature_columns(
+                data, check_repetition=args.use_repetitions, use_past=args.use_past,
+            )
+            data_filtered = annotate(data, feature_vocabs, tagger, args, feature_cache)
+            # Append to the output file
+            save_utterances(data_filtered, args.out, append=(i > 0))
+            if args.compare:
+                speech_acts_children.update(
+                    data_filtered[data_filtered.speaker_code == CHILD][SPEECH_ACT]
+                )
     else:
-        data_filtered.to_pickle(args.out)
+        # Loading data
+        data = load_feature_columns(
+            args.data,
+            check_repetition=args.use_repetitions,
+            use_past=args.use_past,
+            feature_cache=feature_cache,
+        )
+
+        data_filtered = annotate(data, feature_vocabs, tagger, args, feature_cache)
+
+        save_utterances(data_filtered, args.out)
+
+        speech_acts_children = data_filtered[
+            data_filtered.speaker_code == CHILD
+        ][SPEECH_ACT].tolist()
 
     if args.compare:
-        data_children = data_filtered[data.speaker_code == CHILD]
-        frequencies_children = calculate_frequencies(data_children["y_pred"].tolist())
+        if args.stream:
+            nb_speech_acts_children = sum(speech_acts_children.values())
+            frequencies_children = Counter(
+                {
+                    speech_act: count / nb_speech_acts_children
+                    for speech_act, count in speech_acts_children.items()
+                }
+            )
+        else:
+            frequencies_children = calculate_frequencies(speech_acts_children)
         compare_frequencies(frequencies_children, args)
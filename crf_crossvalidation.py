@@ -1,6 +1,6 @@
 import os
-import pickle
 import argparse
+import multiprocessing
 
 import numpy as np
 import pandas as pd
@@ -11,17 +11,20 @@ from sklearn.metrics import accuracy_score
 
 from sklearn.model_selection import KFold
 
+from data_store import save_utterances
+from feature_cache import FeatureCache
 from utils import (
     TRAIN_TEST_SPLIT_RANDOM_STATE,
     SPEECH_ACT,
     PATH_NEW_ENGLAND_UTTERANCES_ANNOTATED,
 )
-from crf_train import (
-    add_feature_columns,
-    get_features_from_row,
-    generate_features_vocabs,
+from crf_tagger import (
+    load_feature_columns,
+    get_cached_features_from_data,
     crf_predict,
+    PREDICTION_MODES,
 )
+from crf_train import generate_features_vocabs, CRF_TRAINER_PARAMS
 
 
 def argparser():
@@ -75,30 +78,192 @@ def argparser():
     )
     argparser.add_argument(
         "--prediction-mode",
-        choices=["raw", "exclude_ool"],
+        choices=PREDICTION_MODES,
         default="raw",
         type=str,
-        help="Whether to predict with NOL/NAT/NEE labels or not.",
+        help="Whether to predict with NOL/NAT/NEE labels or not (excluding them for each utterance or using "
+        "Viterbi decoding over the whole transcript).",
+    )
+    argparser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes tagging transcripts in parallel",
+    )
+    argparser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of folds trained and tested in parallel (each in its own process)",
+    )
+    argparser.add_argument(
+        "--feature-cache",
+        type=str,
+        default=None,
+        help="Directory to cache computed features in (e.g. ~/data/speech_acts/feature_cache/)",
     )
 
     args = argparser.parse_args()
     return args
 
 
+# Location for weight save
+checkpoint_path = "checkpoints/crf_cross_validation/"
+
+_fold_data = None
+_fold_args = None
+_fold_feature_cache = None
+
+
+def _init_fold_worker(args, feature_cache: FeatureCache, data: pd.DataFrame = None):
+    """Set the state of the process running folds. Without data, it is loaded from args.data (from the feature cache,
+    if any), so that the data is not sent to each worker process."""
+    global _fold_data, _fold_args, _fold_feature_cache
+    if data is None:
+        data = load_feature_columns(
+            args.data,
+            check_repetition=args.use_repetitions,
+            use_past=args.use_past,
+            feature_cache=feature_cache,
+        )
+    _fold_data = data
+    _fold_args = args
+    _fold_feature_cache = feature_cache
+
+
+def run_fold(fold: tuple) -> tuple:
+    """Train and test the CRF on a fold, returns the accuracy and the test data with predictions"""
+    i, train_files, test_files = fold
+    data, args, feature_cache = _fold_data, _fold_args, _fold_feature_cache
+
+    data_train = data[data["transcript_file"].isin(train_files)]
+    data_test = data[data["transcript_file"].isin(test_files)]
+
+    print(
+        f"\n### Training on permutation {i} - {len(data_train)} utterances in train,  {len(data_test)} utterances in test set: "
+    )
+    nm = os.path.join(checkpoint_path, f"permutation_{i}")
+
+    # generating features
+    features_idx = generate_features_vocabs(
+        data_train,
+        args.nb_occurrences,
+        args.use_bi_grams,
+        args.use_repetitions,
+        args.use_pos,
+    )
+
+    # creating crf features set for train
+    data_train = data_train.assign(
+        features=get_cached_features_from_data(
+            feature_cache,
+            args.data,
+            data_train,
+            features_idx,
+            use_bi_grams=args.use_bi_grams,
+            use_repetitions=args.use_repetitions,
+            use_past=args.use_past,
+            use_pos=args.use_pos,
+        )
+    )
+
+    # Once the features are done, groupby name and extract a list of lists
+    grouped_train = data_train.groupby(by=["transcript_file"]).agg(
+        {
+            "features": lambda x: [y for y in x],
+            SPEECH_ACT: lambda x: [y for y in x],
+        }
+    )  # listed by apparition order
+    # Seeded per fold, so that the folds are shuffled the same way whether they run serially or in parallel (--jobs)
+    grouped_train = sklearn.utils.shuffle(
+        grouped_train, random_state=TRAIN_TEST_SPLIT_RANDOM_STATE + i
+    )
+
+    ### Training
+    trainer = pycrfsuite.Trainer(verbose=args.verbose)
+    # Adding data
+    for idx, file_data in grouped_train.iterrows():
+        trainer.append(
+            file_data["features"], file_data[SPEECH_ACT]
+        )  # X_train, y_train
+    # Parameters
+    trainer.set_params(CRF_TRAINER_PARAMS)
+    print("Saving model at: {}".format(nm))
+
+    trainer.train(nm + "_model.pycrfsuite")
+    features_idx.save(nm + "_features.p")  # dumping features
+
+    ### Testing
+    tagger = pycrfsuite.Tagger()
+    tagger.open(nm + "_model.pycrfsuite")
+
+    data_test = data_test.assign(
+        features=get_cached_features_from_data(
+            feature_cache,
+            args.data,
+            data_test,
+            features_idx,
+            use_bi_grams=args.use_bi_grams,
+            use_repetitions=args.use_repetitions,
+            use_past=args.use_past,
+            use_pos=args.use_pos,
+        )
+    )
+
+    data_test["y_pred"] = crf_predict(
+        tagger,
+        data_test,
+        mode=args.prediction_mode,
+        workers=args.workers,
+        model_path=nm + "_model.pycrfsuite",
+    )
+    data_test["pred_OK"] = data_test.apply(
+        lambda x: (x.y_pred == x[SPEECH_ACT]), axis=1
+    )
+
+    # Remove uninformative tags before doing analysis
+    data_crf = data_test[~data_test[SPEECH_ACT].isin(["NAT", "NEE"])]
+
+    acc = accuracy_score(data_crf[SPEECH_ACT].tolist(), data_crf["y_pred"].tolist())
+
+    return (
+        acc,
+        data_crf[
+            [
+                "utterance_id",
+                "transcript_file",
+                "speaker_code",
+                "age",
+                "tokens",
+                SPEECH_ACT,
+                "y_pred",
+            ]
+        ],
+    )
+
+
 if __name__ == "__main__":
     args = argparser()
     print(args)
 
+    if args.jobs > 1 and args.workers > 1:
+        raise ValueError(
+            "--workers can not be used with --jobs, as folds running in parallel can not start worker processes"
+        )
+
     print("### Loading data:".upper())
 
-    data = pd.read_pickle(args.data)
+    feature_cache = (
+        FeatureCache(args.feature_cache) if args.feature_cache is not None else None
+    )
 
-    data = add_feature_columns(
-        data, check_repetition=args.use_repetitions, use_past=args.use_past,
+    data = load_feature_columns(
+        args.data,
+        check_repetition=args.use_repetitions,
+        use_past=args.use_past,
+        feature_cache=feature_cache,
     )
 
-    # Location for weight save
-    checkpoint_path = "checkpoints/crf_cross_validation/"
     print("Saving model at: {}".format(checkpoint_path))
     if not os.path.exists(checkpoint_path):
         os.makedirs(checkpoint_path)
@@ -110,134 +275,32 @@ if __name__ == "__main__":
         random_state=TRAIN_TEST_SPLIT_RANDOM_STATE,
     )
 
-    accuracies = []
-    result_dataframes = []
-
     file_names = data["transcript_file"].unique().tolist()
-    for i, (train_indices, test_indices) in enumerate(kf.split(file_names)):
-        train_files = [file_names[i] for i in train_indices]
-        test_files = [file_names[i] for i in test_indices]
-
-        data_train = data[data["transcript_file"].isin(train_files)]
-        data_test = data[data["transcript_file"].isin(test_files)]
-
-        print(
-            f"\n### Training on permutation {i} - {len(data_train)} utterances in train,  {len(data_test)} utterances in test set: "
-        )
-        nm = os.path.join(checkpoint_path, f"permutation_{i}")
-
-        # generating features
-        features_idx = generate_features_vocabs(
-            data_train,
-            args.nb_occurrences,
-            args.use_bi_grams,
-            args.use_repetitions,
-            args.use_pos,
-        )
-
-        # creating crf features set for train
-        data_train = data_train.assign(
-            features=data_train.apply(
-                lambda x: get_features_from_row(
-                    features_idx,
-                    x.tokens,
-                    x["speaker_code"],
-                    x["prev_speaker_code"],
-                    x.turn_length,
-                    use_bi_grams=args.use_bi_grams,
-                    repetitions=None
-                    if not args.use_repetitions
-                    else (x.repeated_words, x.ratio_repwords),
-                    prev_tokens=None if not args.use_past else x.past,
-                    pos_tags=None if not args.use_pos else x.pos,
-                ),
-                axis=1,
-            )
+    folds = [
+        (
+            i,
+            [file_names[j] for j in train_indices],
+            [file_names[j] for j in test_indices],
         )
+        for i, (train_indices, test_indices) in enumerate(kf.split(file_names))
+    ]
 
-        # Once the features are done, groupby name and extract a list of lists
-        grouped_train = data_train.groupby(by=["transcript_file"]).agg(
-            {
-                "features": lambda x: [y for y in x],
-                SPEECH_ACT: lambda x: [y for y in x],
-            }
-        )  # listed by apparition order
-        grouped_train = sklearn.utils.shuffle(grouped_train)
-
-        ### Training
-        trainer = pycrfsuite.Trainer(verbose=args.verbose)
-        # Adding data
-        for idx, file_data in grouped_train.iterrows():
-            trainer.append(
-                file_data["features"], file_data[SPEECH_ACT]
-            )  # X_train, y_train
-        # Parameters
-        trainer.set_params(
-            {
-                "c1": 1,  # coefficient for L1 penalty
-                "c2": 1e-3,  # coefficient for L2 penalty
-                "max_iterations": 50,  # stop earlier
-                "feature.possible_transitions": True,  # include transitions that are possible, but not observed
-            }
-        )
-        print("Saving model at: {}".format(nm))
-
-        trainer.train(nm + "_model.pycrfsuite")
-        with open(nm + "_features.p", "wb") as pickle_file:  # dumping features
-            pickle.dump(features_idx, pickle_file)
-
-        ### Testing
-        tagger = pycrfsuite.Tagger()
-        tagger.open(nm + "_model.pycrfsuite")
-
-        data_test = data_test.assign(
-            features=data_test.apply(
-                lambda x: get_features_from_row(
-                    features_idx,
-                    x.tokens,
-                    x["speaker_code"],
-                    x["prev_speaker_code"],
-                    x.turn_length,
-                    use_bi_grams=args.use_bi_grams,
-                    repetitions=None
-                    if not args.use_repetitions
-                    else (x.repeated_words, x.ratio_repwords),
-                    prev_tokens=None if not args.use_past else x.past,
-                    pos_tags=None if not args.use_pos else x.pos,
-                ),
-                axis=1,
-            )
-        )
-
-        data_test["y_pred"] = crf_predict(tagger, data_test, mode=args.prediction_mode)
-        data_test["pred_OK"] = data_test.apply(
-            lambda x: (x.y_pred == x[SPEECH_ACT]), axis=1
-        )
-
-        # Remove uninformative tags before doing analysis
-        data_crf = data_test[~data_test[SPEECH_ACT].isin(["NAT", "NEE"])]
-
-        acc = accuracy_score(data_crf[SPEECH_ACT].tolist(), data_crf["y_pred"].tolist())
-
-        accuracies.append(acc)
-        result_dataframes.append(
-            data_crf[
-                [
-                    "utterance_id",
-                    "transcript_file",
-                    "speaker_code",
-                    "age",
-                    "tokens",
-                    SPEECH_ACT,
-                    "y_pred",
-                ]
-            ]
-        )
+    if args.jobs > 1:
+        # Workers load the data themselves (from the feature cache, if any) and only receive the transcripts of folds
+        with multiprocessing.Pool(
+            min(args.jobs, len(folds)),
+            initializer=_init_fold_worker,
+            initargs=(args, feature_cache),
+        ) as pool:
+            # map returns the results in the order of the folds
+            results = pool.map(run_fold, folds, chunksize=1)
+    else:
+        _init_fold_worker(args, feature_cache, data)
+        results = [run_fold(fold) for fold in folds]
 
+    accuracies = [acc for acc, _ in results]
     print(f"mean accuracy over all splits: {np.average(accuracies):.3f}")
     print(f"std accuracy over all splits: {np.std(accuracies):.3f}")
 
-    result_dataframe = result_dataframes[0]
-    for df in result_dataframes[1:]:
-        result_dataframe = result_dataframe.append(df)
-    pickle.dump(result_dataframe, open(PATH_NEW_ENGLAND_UTTERANCES_ANNOTATED, "wb"))
+    result_dataframe = pd.concat([result for _, result in results])
+    save_utterances(result_dataframe, PATH_NEW_ENGLAND_UTTERANCES_ANNOTATED)
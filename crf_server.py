@@ -0,0 +1,490 @@
+"""Annotation server: keeps a CRF model loaded and annotates transcripts sent as JSON lines.
+
+Each request is a JSON object on a single line, containing a whole transcript:
+    {"id": 1, "tokens": [["what", "is", "that", "?"], ["a", "ball", "."]], "pos": [["pro:int", ...], ...],
+     "speaker_code": ["MOT", "CHI"], "marginals": false}
+("pos" is only required if the model uses POS features, "id" and "marginals" are optional). The response contains the
+speech act of each utterance, and (if "marginals" is true) the probability of each label for each utterance:
+    {"id": 1, "speech_acts": ["QN", "ST"], "marginals": [{"AA": 0.01, ...}, ...]}
+Invalid requests are answered with {"id": 1, "error": "..."}.
+
+Requests are read from stdin and answered on stdout, or sent through a Unix socket (--socket) or TCP (--port).
+Requests that arrive together are tagged in batches by a pool of workers, and a bounded queue makes clients wait when
+the workers can not keep up.
+"""
+
+import os
+import sys
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import signal
+import time
+
+import pandas as pd
+import pycrfsuite
+
+from crf_tagger import (
+    add_feature_columns,
+    get_features_from_data,
+    get_label_mask,
+    crf_tag,
+    CRFWeights,
+    FeatureVocabs,
+    PREDICTION_MODES,
+    OOL_LABELS,
+)
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser(
+        description="Annotation server, annotates transcripts sent as JSON lines."
+    )
+    argparser.add_argument(
+        "--model",
+        "-m",
+        required=True,
+        type=str,
+        help="folder containing model and features",
+    )
+    argparser.add_argument(
+        "--socket",
+        type=str,
+        default=None,
+        help="Path of a Unix socket to listen on (by default, requests are read from stdin)",
+    )
+    argparser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="Host to listen on with --port",
+    )
+    argparser.add_argument(
+        "--port",
+        type=int,
+        default=None,
+        help="TCP port to listen on (by default, requests are read from stdin)",
+    )
+    argparser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes tagging batches of transcripts in parallel",
+    )
+    argparser.add_argument(
+        "--batch-size",
+        type=int,
+        default=64,
+        help="Maximum number of transcripts tagged together",
+    )
+    argparser.add_argument(
+        "--batch-delay",
+        type=float,
+        default=0.001,
+        help="Maximum time (in seconds) to wait for further requests before tagging a batch",
+    )
+    argparser.add_argument(
+        "--queue-size",
+        type=int,
+        default=1024,
+        help="Maximum number of transcripts waiting to be tagged",
+    )
+    argparser.add_argument(
+        "--prediction-mode",
+        choices=PREDICTION_MODES,
+        default="raw",
+        type=str,
+        help="Whether to predict with NOL/NAT/NEE labels or not (excluding them for each utterance or using "
+        "Viterbi decoding over the whole transcript).",
+    )
+    argparser.add_argument(
+        "--use-bi-grams",
+        "-bi",
+        action="store_true",
+        help="whether to use bi-gram features to train the algorithm",
+    )
+    argparser.add_argument(
+        "--use-pos",
+        "-pos",
+        action="store_true",
+        help="whether to add POS tags to features",
+    )
+    argparser.add_argument(
+        "--use-past",
+        "-past",
+        action="store_true",
+        help="whether to add previous sentence as features",
+    )
+    argparser.add_argument(
+        "--use-repetitions",
+        "-rep",
+        action="store_true",
+        help="whether to check in data if words were repeated from previous sentence, to train the algorithm",
+    )
+
+    args = argparser.parse_args()
+
+    return args
+
+
+def _is_list_of_lists_of_strings(value) -> bool:
+    return isinstance(value, list) and all(
+        isinstance(values, list) and all(isinstance(v, str) for v in values)
+        for values in value
+    )
+
+
+class Annotator:
+    """CRF model and feature vocabularies, loaded once to annotate any number of transcripts"""
+
+    def __init__(
+        self,
+        model_dir: str,
+        use_bi_grams: bool = False,
+        use_repetitions: bool = False,
+        use_past: bool = False,
+        use_pos: bool = False,
+        mode: str = "raw",
+    ):
+        self.feature_vocabs = FeatureVocabs.load(
+            os.path.join(model_dir, "feature_vocabs.p")
+        )
+        self.tagger = pycrfsuite.Tagger()
+        self.tagger.open(os.path.join(model_dir, "model.pycrfsuite"))
+        self.labels = self.tagger.labels()
+        self.label_mask = get_label_mask(self.labels, OOL_LABELS)
+        self.crf_weights = (
+            CRFWeights(self.tagger) if mode == "exclude_ool_viterbi" else None
+        )
+        self.mode = mode
+        self.use_bi_grams = use_bi_grams
+        self.use_repetitions = use_repetitions
+        self.use_past = use_past
+        self.use_pos = use_pos
+
+    def validate(self, transcript: dict):
+        """Raise a ValueError if the transcript can not be annotated"""
+        if not _is_list_of_lists_of_strings(transcript.get("tokens")):
+            raise ValueError("tokens must be a list of lists of tokens (one per utterance)")
+        nb_utterances = len(transcript["tokens"])
+        speaker_codes = transcript.get("speaker_code")
+        if (
+            not isinstance(speaker_codes, list)
+            or len(speaker_codes) != nb_utterances
+            or not all(isinstance(code, str) for code in speaker_codes)
+        ):
+            raise ValueError("speaker_code must be a list with one speaker code per utterance")
+        if (self.use_pos or "pos" in transcript) and (
+            not _is_list_of_lists_of_strings(transcript.get("pos"))
+            or len(transcript["pos"]) != nb_utterances
+        ):
+            raise ValueError("pos must be a list of lists of POS tags (one per utterance)")
+
+    def annotate(self, transcripts: list, return_marginals: list) -> list:
+        """Return the speech acts of the utterances of each transcript, with their marginals if requested"""
+        nb_utterances = [len(transcript["tokens"]) for transcript in transcripts]
+        if sum(nb_utterances) == 0:
+            return [([], []) if marginals else [] for marginals in return_marginals]
+
+        data = pd.DataFrame(
+            {
+                "transcript_file": [
+                    i for i, nb in enumerate(nb_utterances) for _ in range(nb)
+                ],
+                "utterance_id": [j for nb in nb_utterances for j in range(nb)],
+                "tokens": [t for transcript in transcripts for t in transcript["tokens"]],
+                "pos": [
+                    p
+                    for transcript, nb in zip(transcripts, nb_utterances)
+                    for p in transcript.get("pos", [None] * nb)
+                ],
+                "speaker_code": [
+                    s for transcript in transcripts for s in transcript["speaker_code"]
+                ],
+            }
+        )
+        # Rows stay in order: transcripts are numbered in order and utterances are numbered within transcripts
+        data = add_feature_columns(
+            data, check_repetition=self.use_repetitions, use_past=self.use_past
+        )
+        features = get_features_from_data(
+            data,
+            self.feature_vocabs,
+            use_bi_grams=self.use_bi_grams,
+            use_repetitions=self.use_repetitions,
+            use_past=self.use_past,
+            use_pos=self.use_pos,
+        )
+
+        results = []
+        start = 0
+        for nb, marginals in zip(nb_utterances, return_marginals):
+            xseq = features[start:start + nb]
+            start += nb
+            if nb == 0:
+                results.append(([], []) if marginals else [])
+                continue
+            result = crf_tag(
+                self.tagger,
+                xseq,
+                self.mode,
+                self.label_mask,
+                marginals,
+                self.crf_weights,
+            )
+            if marginals:
+                y_pred, probabilities = result
+                result = (
+                    y_pred,
+                    [dict(zip(self.labels, p)) for p in probabilities.tolist()],
+                )
+            results.append(result)
+        return results
+
+
+# Annotator of the worker processes (or of the worker thread, with a single worker)
+_server_annotator = None
+
+
+def _init_server_worker(annotator_args: tuple):
+    global _server_annotator
+    _server_annotator = Annotator(*annotator_args)
+
+
+def _annotate_batch(batch: tuple) -> list:
+    transcripts, return_marginals = batch
+    return _server_annotator.annotate(transcripts, return_marginals)
+
+
+class AnnotationServer:
+    """Collects requests in a bounded queue and annotates them in batches using a pool of workers"""
+
+    def __init__(
+        self,
+        annotator: Annotator,
+        annotator_args: tuple,
+        workers: int = 1,
+        batch_size: int = 64,
+        batch_delay: float = 0.001,
+        queue_size: int = 1024,
+    ):
+        # Used for validation of the requests, the workers have their own annotators
+        self.annotator = annotator
+        if workers > 1:
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                workers, initializer=_init_server_worker, initargs=(annotator_args,)
+            )
+        else:
+            # A single worker thread, so that the event loop keeps accepting requests while tagging
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                1, initializer=_init_server_worker, initargs=(annotator_args,)
+            )
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.batchers = []
+
+    def start(self):
+        # One batch per worker can be tagged at the same time
+        self.batchers = [
+            asyncio.create_task(self.process_batches()) for _ in range(self.workers)
+        ]
+
+    async def stop(self):
+        for batcher in self.batchers:
+            batcher.cancel()
+        await asyncio.gather(*self.batchers, return_exceptions=True)
+        self.executor.shutdown()
+
+    async def annotate(self, request: dict) -> dict:
+        """Return the response to a request"""
+        response = {"id": request.get("id")} if "id" in request else {}
+        try:
+            self.annotator.validate(request)
+        except ValueError as e:
+            response["error"] = str(e)
+            return response
+
+        return_marginals = bool(request.get("marginals", False))
+        future = asyncio.get_running_loop().create_future()
+        # Waits if the queue is full
+        await self.queue.put((request, return_marginals, future))
+        try:
+            result = await future
+        except Exception as e:
+            response["error"] = f"{type(e).__name__}: {e}"
+            return response
+
+        if return_marginals:
+            response["speech_acts"], response["marginals"] = result
+        else:
+            response["speech_acts"] = result
+        return response
+
+    async def process_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            # Wait a short time for further requests to tag them together
+            deadline = loop.time() + self.batch_delay
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Take everything that is already waiting, even after the deadline
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            requests, return_marginals, futures = zip(*batch)
+            try:
+                results = await loop.run_in_executor(
+                    self.executor, _annotate_batch, (list(requests), list(return_marginals))
+                )
+            except Exception as e:
+                if len(batch) == 1:
+                    if not futures[0].done():
+                        futures[0].set_exception(e)
+                    continue
+                # Tag the transcripts one by one, so that the error only reaches the request that caused it
+                for request, marginals, future in batch:
+                    try:
+                        (result,) = await loop.run_in_executor(
+                            self.executor, _annotate_batch, ([request], [marginals])
+                        )
+                    except Exception as e:
+                        if not future.done():
+                            future.set_exception(e)
+                    else:
+                        if not future.done():
+                            future.set_result(result)
+            else:
+                for future, result in zip(futures, results):
+                    if not future.done():
+                        future.set_result(result)
+
+    async def handle_line(self, line: bytes, write):
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("Request must be a JSON object")
+        except ValueError as e:
+            response = {"error": f"Invalid request: {e}"}
+        else:
+            response = await self.annotate(request)
+        write((json.dumps(response) + "\n").encode())
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Answer the requests of a client, responses are sent as soon as they are ready (not necessarily in order)"""
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                task = asyncio.create_task(self.handle_line(line, writer.write))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve_stdio(self):
+        """Answer requests read from stdin on stdout"""
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader(limit=2 ** 26)
+        await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), sys.stdin
+        )
+
+        def write(data: bytes):
+            sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+
+        tasks = set()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            task = asyncio.create_task(self.handle_line(line, write))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+
+
+async def serve(server: AnnotationServer, args, start: float):
+    if args.socket is not None or args.port is not None:
+        if args.socket is not None:
+            listener = await asyncio.start_unix_server(
+                server.handle_connection, args.socket, limit=2 ** 26
+            )
+            address = args.socket
+        else:
+            listener = await asyncio.start_server(
+                server.handle_connection, args.host, args.port, limit=2 ** 26
+            )
+            address = f"{args.host}:{args.port}"
+        print(
+            f"Listening on {address} (model loaded in {time.perf_counter() - start:.2f}s)",
+            file=sys.stderr,
+            flush=True,
+        )
+        async with listener:
+            await listener.serve_forever()
+    else:
+        await server.serve_stdio()
+
+
+async def main(args):
+    annotator_args = (
+        args.model,
+        args.use_bi_grams,
+        args.use_repetitions,
+        args.use_past,
+        args.use_pos,
+        args.prediction_mode,
+    )
+    start = time.perf_counter()
+    server = AnnotationServer(
+        Annotator(*annotator_args),
+        annotator_args,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        batch_delay=args.batch_delay,
+        queue_size=args.queue_size,
+    )
+    server.start()
+
+    serving = asyncio.create_task(serve(server, args, start))
+    # Stop gracefully, so that the worker processes are shut down as well
+    loop = asyncio.get_running_loop()
+    for sig in [signal.SIGINT, signal.SIGTERM]:
+        loop.add_signal_handler(sig, serving.cancel)
+    try:
+        await serving
+    except asyncio.CancelledError:
+        pass
+    finally:
+        await server.stop()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(args, file=sys.stderr)
+
+    if args.socket is not None and args.port is not None:
+        raise ValueError("Use either --socket or --port")
+
+    asyncio.run(main(args))
@@ -0,0 +1,416 @@
+"""Hyperparameter sweep for the CRF: trains and tests a CRF for each configuration of a grid (or a random sample of it)
+of trainer parameters and feature flags, and stores a table with the results of all configurations."""
+
+import os
+import argparse
+import itertools
+import multiprocessing
+import pickle
+import random
+import time
+
+import pandas as pd
+import pycrfsuite
+import sklearn
+from sklearn.metrics import accuracy_score, cohen_kappa_score
+
+from crf_tagger import (
+    load_feature_columns,
+    get_cached_features_from_data,
+    encode_sequences,
+    decode_sequences,
+)
+from crf_train import generate_features_vocabs, CRF_TRAINER_PARAMS
+from feature_cache import FeatureCache
+from utils import (
+    SPEECH_ACT,
+    SPEECH_ACT_UNINTELLIGIBLE,
+    SPEECH_ACT_NO_FUNCTION,
+    TRAIN_TEST_SPLIT_RANDOM_STATE,
+    make_train_test_splits,
+    PATH_NEW_ENGLAND_UTTERANCES,
+)
+
+ALGORITHMS = ["lbfgs", "l2sgd", "ap", "pa", "arow"]
+
+# Regularization parameters supported by each training algorithm
+ALGORITHM_PARAMS = {
+    "lbfgs": ["c1", "c2"],
+    "l2sgd": ["c2"],
+    "ap": [],
+    "pa": [],
+    "arow": [],
+}
+
+FEATURE_FLAGS = ["use_bi_grams", "use_repetitions", "use_past", "use_pos"]
+
+# Labels that are not taken into account for the evaluation (as in crf_train.py)
+EXCLUDED_LABELS = ["NAT", "NEE", SPEECH_ACT_UNINTELLIGIBLE, SPEECH_ACT_NO_FUNCTION]
+
+
+def parse_bool(value: str) -> bool:
+    if value.lower() in ["1", "true", "yes"]:
+        return True
+    if value.lower() in ["0", "false", "no"]:
+        return False
+    raise argparse.ArgumentTypeError(f"Boolean value expected, got {value}")
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser(
+        description="Hyperparameter sweep for the CRF. Each hyperparameter takes a list of values, all combinations "
+        "are evaluated (or a random sample of them, with --random-search)."
+    )
+    argparser.add_argument(
+        "--data",
+        type=str,
+        default=PATH_NEW_ENGLAND_UTTERANCES,
+        help="file listing train dialogs",
+    )
+    argparser.add_argument(
+        "--out",
+        type=str,
+        default="checkpoints/crf_sweep/",
+        help="Directory to store the models and the results table (results.csv)",
+    )
+    argparser.add_argument(
+        "--test-ratio",
+        type=float,
+        default=0.2,
+        help="Ratio of dataset to be used to testing",
+    )
+    argparser.add_argument(
+        "--nb-occurrences",
+        "-noc",
+        type=int,
+        default=5,
+        help="number of minimum occurrences for word to appear in features",
+    )
+    # Trainer parameters
+    argparser.add_argument(
+        "--c1",
+        type=float,
+        nargs="+",
+        default=[CRF_TRAINER_PARAMS["c1"]],
+        help="coefficients for L1 penalty (lbfgs only)",
+    )
+    argparser.add_argument(
+        "--c2",
+        type=float,
+        nargs="+",
+        default=[CRF_TRAINER_PARAMS["c2"]],
+        help="coefficients for L2 penalty (lbfgs and l2sgd only)",
+    )
+    argparser.add_argument(
+        "--max-iterations",
+        type=int,
+        nargs="+",
+        default=[CRF_TRAINER_PARAMS["max_iterations"]],
+        help="maximum numbers of training iterations",
+    )
+    argparser.add_argument(
+        "--algorithm",
+        type=str,
+        nargs="+",
+        choices=ALGORITHMS,
+        default=["lbfgs"],
+        help="training algorithms",
+    )
+    argparser.add_argument(
+        "--possible-transitions",
+        type=parse_bool,
+        nargs="+",
+        default=[CRF_TRAINER_PARAMS["feature.possible_transitions"]],
+        help="whether to include transitions that are possible, but not observed",
+    )
+    argparser.add_argument(
+        "--possible-states",
+        type=parse_bool,
+        nargs="+",
+        default=[False],
+        help="whether to include state features that are possible, but not observed",
+    )
+    # Feature flags
+    argparser.add_argument(
+        "--use-bi-grams",
+        type=parse_bool,
+        nargs="+",
+        default=[True],
+        help="whether to use bi-gram features",
+    )
+    argparser.add_argument(
+        "--use-repetitions",
+        type=parse_bool,
+        nargs="+",
+        default=[True],
+        help="whether to use repetitions from the previous utterance as features",
+    )
+    argparser.add_argument(
+        "--use-past",
+        type=parse_bool,
+        nargs="+",
+        default=[False],
+        help="whether to add previous sentence as features",
+    )
+    argparser.add_argument(
+        "--use-pos",
+        type=parse_bool,
+        nargs="+",
+        default=[True],
+        help="whether to add POS tags to features",
+    )
+    # Sweep
+    argparser.add_argument(
+        "--random-search",
+        type=int,
+        default=None,
+        help="Evaluate only this number of configurations, sampled randomly from the grid",
+    )
+    argparser.add_argument(
+        "--seed",
+        type=int,
+        default=TRAIN_TEST_SPLIT_RANDOM_STATE,
+        help="Random seed for the random search and the order of the training transcripts",
+    )
+    argparser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of configurations trained in parallel",
+    )
+    argparser.add_argument(
+        "--feature-cache",
+        type=str,
+        default=None,
+        help="Directory to cache computed features in (e.g. ~/data/speech_acts/feature_cache/)",
+    )
+
+    args = argparser.parse_args()
+
+    return args
+
+
+def get_configurations(args) -> list:
+    """Return all (feature flags, trainer params) configurations of the grid, or a random sample of them"""
+    flag_combinations = [
+        dict(zip(FEATURE_FLAGS, values))
+        for values in itertools.product(*[getattr(args, flag) for flag in FEATURE_FLAGS])
+    ]
+
+    trainer_params = []
+    for algorithm, c1, c2, max_iterations, possible_transitions, possible_states in itertools.product(
+        args.algorithm,
+        args.c1,
+        args.c2,
+        args.max_iterations,
+        args.possible_transitions,
+        args.possible_states,
+    ):
+        params = {"algorithm": algorithm}
+        params.update(
+            {
+                name: value
+                for name, value in [("c1", c1), ("c2", c2)]
+                if name in ALGORITHM_PARAMS[algorithm]
+            }
+        )
+        params.update(
+            {
+                "max_iterations": max_iterations,
+                "feature.possible_transitions": possible_transitions,
+                "feature.possible_states": possible_states,
+            }
+        )
+        # Regularization values are not used by some algorithms, which would lead to duplicate configurations
+        if params not in trainer_params:
+            trainer_params.append(params)
+
+    configurations = list(itertools.product(flag_combinations, trainer_params))
+    if args.random_search is not None and args.random_search < len(configurations):
+        configurations = random.Random(args.seed).sample(
+            configurations, args.random_search
+        )
+    return configurations
+
+
+def get_sequences(data: pd.DataFrame) -> tuple:
+    """Group features and labels of the data by transcript"""
+    grouped = data.groupby(by=["transcript_file"], sort=False).agg(
+        {"features": lambda x: [y for y in x], SPEECH_ACT: lambda x: [y for y in x]}
+    )
+    return grouped["features"].tolist(), grouped[SPEECH_ACT].tolist()
+
+
+def save_sequences(path: str, x_train, y_train, x_test, y_test):
+    """Store the sequences of a combination of feature flags, with features in compact form (see
+    `crf_tagger.encode_sequences`)"""
+    with open(path, "wb") as sequences_file:
+        pickle.dump(
+            (encode_sequences(x_train), y_train, encode_sequences(x_test), y_test),
+            sequences_file,
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+
+
+def load_sequences(path: str) -> tuple:
+    with open(path, "rb") as sequences_file:
+        x_train, y_train, x_test, y_test = pickle.load(sequences_file)
+    return decode_sequences(x_train), y_train, decode_sequences(x_test), y_test
+
+
+# Sequences loaded by the process, by path
+_sweep_sequences = {}
+
+
+def get_sweep_sequences(path: str) -> tuple:
+    """Sequences stored at path with `save_sequences`, only loaded once per process"""
+    if path not in _sweep_sequences:
+        _sweep_sequences[path] = load_sequences(path)
+    return _sweep_sequences[path]
+
+
+def run_configuration(configuration: tuple) -> dict:
+    """Train and test a CRF for a configuration, returns a row of the results table"""
+    index, flags, params, model_path, sequences_path = configuration
+    x_train, y_train, x_test, y_test = get_sweep_sequences(sequences_path)
+
+    trainer = pycrfsuite.Trainer(verbose=False)
+    for xseq, yseq in zip(x_train, y_train):
+        trainer.append(xseq, yseq)
+    trainer.select(params["algorithm"])
+    trainer.set_params({k: v for k, v in params.items() if k != "algorithm"})
+
+    start = time.perf_counter()
+    trainer.train(model_path)
+    train_time = time.perf_counter() - start
+
+    tagger = pycrfsuite.Tagger()
+    tagger.open(model_path)
+    start = time.perf_counter()
+    y_pred = [y for xseq in x_test for y in tagger.tag(xseq)]
+    tagging_time = time.perf_counter() - start
+    nb_tagged = len(y_pred)
+
+    y_true = [y for yseq in y_test for y in yseq]
+    evaluated = [
+        (label, pred)
+        for label, pred in zip(y_true, y_pred)
+        if label not in EXCLUDED_LABELS
+    ]
+    if evaluated:
+        y_true, y_pred = zip(*evaluated)
+        accuracy = accuracy_score(y_true, y_pred)
+        kappa = cohen_kappa_score(y_true, y_pred)
+    else:
+        # All test labels are excluded from the evaluation
+        accuracy = kappa = float("nan")
+
+    return {
+        "configuration": index,
+        **flags,
+        **params,
+        "accuracy": accuracy,
+        "kappa": kappa,
+        "train_time": train_time,
+        "model_size": os.path.getsize(model_path),
+        "utterances_per_second": nb_tagged / tagging_time,
+    }
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(args)
+
+    configurations = get_configurations(args)
+    print(f"Evaluating {len(configurations)} configurations")
+
+    feature_cache = (
+        FeatureCache(args.feature_cache) if args.feature_cache is not None else None
+    )
+
+    print("### Loading data:".upper())
+    data = load_feature_columns(
+        args.data,
+        check_repetition=any(args.use_repetitions),
+        use_past=any(args.use_past),
+        feature_cache=feature_cache,
+    )
+    data_train, data_test = make_train_test_splits(data, args.test_ratio)
+    print("Number of samples in train split: ", len(data_train))
+    print("Number of samples in test split: ", len(data_test))
+
+    os.makedirs(args.out, exist_ok=True)
+
+    print("### Creating features:")
+    # Features are computed once for each combination of feature flags that is used, and stored so that workers only
+    # load the ones they need
+    sequences_paths = {}
+    for flags, _ in configurations:
+        if tuple(flags.values()) in sequences_paths:
+            continue
+        feature_vocabs = generate_features_vocabs(
+            data_train,
+            args.nb_occurrences,
+            flags["use_bi_grams"],
+            flags["use_repetitions"],
+            flags["use_pos"],
+        )
+        x_train, y_train = get_sequences(
+            data_train.assign(
+                features=get_cached_features_from_data(
+                    feature_cache, args.data, data_train, feature_vocabs, **flags
+                )
+            )
+        )
+        # Same shuffled order of the training transcripts for all configurations
+        x_train, y_train = sklearn.utils.shuffle(
+            x_train, y_train, random_state=args.seed
+        )
+        x_test, y_test = get_sequences(
+            data_test.assign(
+                features=get_cached_features_from_data(
+                    feature_cache, args.data, data_test, feature_vocabs, **flags
+                )
+            )
+        )
+        sequences_path = os.path.join(
+            args.out, f"sequences_{len(sequences_paths)}.p"
+        )
+        save_sequences(sequences_path, x_train, y_train, x_test, y_test)
+        sequences_paths[tuple(flags.values())] = sequences_path
+
+    tasks = [
+        (
+            i,
+            flags,
+            params,
+            os.path.join(args.out, f"configuration_{i}_model.pycrfsuite"),
+            sequences_paths[tuple(flags.values())],
+        )
+        for i, (flags, params) in enumerate(configurations)
+    ]
+
+    print("\n### Training starts.".upper())
+    if args.jobs > 1:
+        # Tasks only contain the path of their sequences, which each worker loads once
+        with multiprocessing.Pool(args.jobs) as pool:
+            results = []
+            for result in pool.imap_unordered(run_configuration, tasks):
+                print(
+                    f"Configuration {result['configuration']}: accuracy {result['accuracy']:.3f}"
+                )
+                results.append(result)
+    else:
+        results = []
+        for task in tasks:
+            result = run_configuration(task)
+            print(
+                f"Configuration {result['configuration']}: accuracy {result['accuracy']:.3f}"
+            )
+            results.append(result)
+
+    results = pd.DataFrame(results).sort_values("configuration")
+    results.to_csv(os.path.join(args.out, "results.csv"), index=False)
+
+    pd.set_option("display.width", 200)
+    print(results.sort_values("accuracy", ascending=False).to_string(index=False))
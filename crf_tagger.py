@@ -0,0 +1,1053 @@
+"""Computation of the CRF features and tagging with a trained CRF.
+
+Only contains what is needed to annotate data with a trained model, training and reporting are in crf_train.py and
+crf_test.py, so that annotation does not need to import their plotting and evaluation dependencies.
+"""
+
+import atexit
+import hashlib
+import multiprocessing
+import multiprocessing.pool
+import os
+import pickle
+from bisect import bisect_right
+from collections import Counter
+from collections.abc import Mapping
+from itertools import chain, compress
+from typing import Union, Tuple
+
+import numpy as np
+import pandas as pd
+import pycrfsuite
+from tqdm import tqdm
+
+from data_store import load_utterances
+from digests import rows_digest
+from feature_cache import FeatureCache, decode_features, encode_features
+from token_corpus import TokenCorpus, MISSING
+from utils import PUNCTUATION_TOKENS, UNKNOWN, CHILD
+
+FEATURE_VOCABS_VERSION = 1
+
+PREDICTION_MODES = ["raw", "exclude_ool", "exclude_ool_viterbi"]
+
+# Labels that are not predicted in the exclude_ool modes
+OOL_LABELS = ["NOL", "NAT", "NEE"]
+
+
+def add_feature_columns(
+    data: pd.DataFrame, use_past: bool = False, check_repetition: bool = False,
+):
+    """Function adding features to the data:
+    * turn_length
+    * tags (if necessary): extract interchange/illocutionary from general tag
+    * repeated_words:
+    * number of repeated words
+    * ratio of words that were repeated from previous sentence over sentence length
+    """
+    data = data.sort_values(["transcript_file", "utterance_id"])
+
+    tokens = data.tokens.tolist()
+    turn_length = np.fromiter(map(len, tokens), dtype=np.int64, count=len(tokens))
+    data["turn_length"] = turn_length
+
+    # Rows that start a new transcript (except the first one)
+    new_transcript = (
+        data.transcript_file
+        != data.transcript_file.shift(1, fill_value=data.transcript_file.iloc[0])
+    ).to_numpy()
+
+    data["prev_speaker_code"] = data["speaker_code"].shift(1)
+    data.loc[new_transcript, "prev_speaker_code"] = None
+
+    # repetition features
+    if check_repetition or use_past:
+        data["prev_tokens"] = [
+            list(prev) if not new else []
+            for prev, new in zip([[]] + tokens[:-1], new_transcript)
+        ]
+
+    if check_repetition:
+        speaker_changed = (data.prev_speaker_code != data.speaker_code).to_numpy()
+
+        # Flat arrays of all tokens, with the (positional) index of their utterance
+        utterance_idx = np.repeat(np.arange(len(tokens)), turn_length)
+        token_codes, token_types = pd.factorize(
+            np.fromiter(chain.from_iterable(tokens), dtype=object, count=len(utterance_idx))
+        )
+        is_punctuation = np.array(
+            [t in PUNCTUATION_TOKENS for t in token_types], dtype=bool
+        )
+
+        # A token is repeated if the same token occurs in the previous utterance of the same transcript
+        nb_types = max(len(token_types), 1)
+        keys = utterance_idx * nb_types + token_codes
+        next_utterance_idx = utterance_idx + 1
+        follows = next_utterance_idx < len(tokens)
+        follows[follows] = ~new_transcript[next_utterance_idx[follows]]
+        prev_keys = next_utterance_idx[follows] * nb_types + token_codes[follows]
+
+        is_repeated = (
+            np.isin(keys, prev_keys)
+            & ~is_punctuation[token_codes]
+            & speaker_changed[utterance_idx]
+        )
+
+        repeated_tokens = list(
+            compress(chain.from_iterable(tokens), is_repeated.tolist())
+        )
+        nb_repwords = np.bincount(utterance_idx[is_repeated], minlength=len(tokens))
+        ends = np.cumsum(nb_repwords).tolist()
+        data["repeated_words"] = [
+            repeated_tokens[end - nb:end] for end, nb in zip(ends, nb_repwords.tolist())
+        ]
+        data["nb_repwords"] = nb_repwords
+        data["ratio_repwords"] = data.nb_repwords / data.turn_length
+
+    # return Dataframe
+    return data
+
+
+def get_features_from_row(
+    features: Union[dict, "FeatureVocabs"],
+    tokens: list,
+    speaker: str,
+    prev_speaker: str,
+    ln: int,
+    use_bi_grams,
+    **kwargs,
+):
+    """Replacing input list tokens with feature index
+
+
+    Input:
+    -------
+    features: `dict` or `FeatureVocabs`
+            dictionary of all features used, by type: {'words':Counter(), ...}
+
+    spoken_tokens: `list`
+            data sentence
+
+    speaker: `str`
+            MOT/CHI
+
+    ln: `int`
+            sentence length
+
+    Kwargs:
+    --------
+    prev_tokens: `list`
+
+    repetitions: `Tuple[list, float, float]`
+            contains the list of repeated words, number of words repeated, ratio of repeated words over sequence
+
+    Output:
+    -------
+    feat_glob: `dict`
+            dictionary of same shape as feature, but only containing features relevant to data line
+    """
+    features = as_feature_vocabs(features)
+
+    feat_glob = {}
+
+    feat_glob["words"] = Counter([features.word_feature(w) for w in tokens])
+
+    feat_glob["speaker_code"] = 1 if speaker == CHILD else 0
+    feat_glob["speaker_changed"] = 1 if speaker != prev_speaker else 0
+
+    feat_glob["length"] = features.length_features(ln)
+
+    if use_bi_grams:
+        # Same as crf_train.get_n_grams(tokens, 2): bigrams without the final punctuation
+        bi_grams = [
+            "-".join(n_gram)
+            for n_gram in zip(tokens, tokens[1:-1])
+            if n_gram in features.bigrams
+        ]
+        feat_glob["bigrams"] = Counter(bi_grams)
+
+    if ("repetitions" in kwargs) and (kwargs["repetitions"] is not None):
+        (rep_words, ratio_rep) = kwargs["repetitions"]
+        feat_glob["repeated_words"] = Counter(
+            [w for w in rep_words if (w in features.words)]
+        )
+        feat_glob["rep_ratio"] = features.rep_ratio_features(ratio_rep)
+    if ("prev_tokens" in kwargs) and (kwargs["prev_tokens"] is not None):
+        feat_glob["prev_tokens"] = Counter(
+            [w for w in kwargs["prev_tokens"] if (w in features.words)]
+        )
+
+    if ("pos_tags" in kwargs) and (kwargs["pos_tags"] is not None):
+        feat_glob["pos"] = Counter(
+            [w for w in kwargs["pos_tags"] if (w in features.pos)]
+        )
+
+    return feat_glob
+
+
+def parse_bins(bins: dict) -> Tuple[list, np.ndarray]:
+    """Parse the string keys of a bins vocabulary ("{low}-{high}") into bin edges.
+
+    Input:
+    -------
+    bins: `dict`
+            bins vocabulary as generated by `generate_features_vocabs`, e.g. {"1.0-2.0": 1124, ...}
+
+    Output:
+    -------
+    keys: `list`
+            bin keys, in order of the bins
+
+    edges: `np.array`
+            numeric bin edges, of length len(keys) + 1
+    """
+    keys = list(bins.keys())
+    bounds = [(float(k.split("-")[0]), float(k.split("-")[1])) for k in keys]
+    for (_, high), (low, _) in zip(bounds[:-1], bounds[1:]):
+        if high != low:
+            raise ValueError(f"Bins are not contiguous: {keys}")
+    edges = np.array([low for low, _ in bounds] + [bounds[-1][1]], dtype=float)
+
+    return keys, edges
+
+
+def get_bin_feature(value, keys: list, edges, closed: bool = False) -> dict:
+    """Assign a single value to bins using their numeric edges (see `get_bin_features`)."""
+    idx = bisect_right(edges, value) - 1
+    feat = {}
+    if closed and 1 <= idx <= len(keys) and value == edges[idx]:
+        feat[keys[idx - 1]] = 1
+    if 0 <= idx < len(keys):
+        feat[keys[idx]] = 1
+
+    return feat
+
+
+def get_bin_features(values, keys: list, edges: np.ndarray, closed: bool = False) -> list:
+    """Assign values to bins using their numeric edges, returns a bin feature dict for each value.
+
+    With closed=False, a value belongs to the bins with low <= value < high, with closed=True to the bins with
+    low <= value <= high (a value lying exactly on an inner edge then belongs to both adjacent bins).
+    """
+    values = np.asarray(values, dtype=float)
+    nb_bins = len(keys)
+    bin_idx = np.digitize(values, edges) - 1
+    on_edge = np.zeros(len(values), dtype=bool)
+    if closed:
+        # Values on the upper edge of a bin also belong to it
+        inner = (bin_idx >= 1) & (bin_idx <= nb_bins)
+        on_edge[inner] = values[inner] == edges[bin_idx[inner]]
+
+    bin_features = []
+    for idx, edge in zip(bin_idx.tolist(), on_edge.tolist()):
+        feat = {}
+        if edge:
+            feat[keys[idx - 1]] = 1
+        if 0 <= idx < nb_bins:
+            feat[keys[idx]] = 1
+        bin_features.append(feat)
+
+    return bin_features
+
+
+class FeatureVocabs(Mapping):
+    """Feature vocabularies of a CRF, as generated by `generate_features_vocabs`.
+
+    Can be used as the dict of vocabularies {'words': {...}, 'length_bins': {...}, ...}, but additionally holds the
+    bins as numeric edges and caches the word feature of each token that was looked up.
+    """
+
+    VOCAB_NAMES = ("words", "length_bins", "length", "bigrams", "rep_ratio_bins", "pos")
+
+    __slots__ = VOCAB_NAMES + (
+        "length_bin_keys",
+        "length_edges",
+        "rep_ratio_bin_keys",
+        "rep_ratio_edges",
+        "word_features",
+    )
+
+    def __init__(self, vocabs: dict):
+        for name in self.VOCAB_NAMES:
+            setattr(self, name, vocabs.get(name))
+
+        self.length_bin_keys, self.length_edges = parse_bins(self.length_bins)
+        if self.rep_ratio_bins is not None:
+            self.rep_ratio_bin_keys, self.rep_ratio_edges = parse_bins(
+                self.rep_ratio_bins
+            )
+        else:
+            self.rep_ratio_bin_keys, self.rep_ratio_edges = None, None
+
+        self.word_features = {}
+
+    def __getitem__(self, name):
+        if name not in self.VOCAB_NAMES or getattr(self, name) is None:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __iter__(self):
+        return (name for name in self.VOCAB_NAMES if getattr(self, name) is not None)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def word_feature(self, word: str) -> str:
+        """Return the word if it is part of the vocabulary, UNKNOWN otherwise"""
+        try:
+            return self.word_features[word]
+        except KeyError:
+            feature = word if word in self.words else UNKNOWN
+            self.word_features[word] = feature
+            return feature
+
+    def length_features(self, length: int) -> dict:
+        return get_bin_feature(length, self.length_bin_keys, self.length_edges)
+
+    def rep_ratio_features(self, ratio: float) -> dict:
+        return get_bin_feature(
+            ratio, self.rep_ratio_bin_keys, self.rep_ratio_edges, closed=True
+        )
+
+    def save(self, path: str):
+        """Store the vocabularies, along with the version of the file format"""
+        with open(path, "wb") as pickle_file:
+            pickle.dump(
+                {"version": FEATURE_VOCABS_VERSION, "vocabs": dict(self)},
+                pickle_file,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+
+    def digest(self) -> str:
+        """Hash of the vocabularies, identifies features computed with them in the feature cache"""
+        return hashlib.sha256(repr(dict(self)).encode()).hexdigest()
+
+    @classmethod
+    def load(cls, path: str):
+        """Load vocabularies stored with `save` or as a plain pickled dict (e.g. checkpoint/feature_vocabs.p)"""
+        with open(path, "rb") as pickle_file:
+            stored = pickle.load(pickle_file)
+
+        if "version" not in stored:
+            # Legacy format: dict of vocabularies
+            return cls(stored)
+        if stored["version"] > FEATURE_VOCABS_VERSION:
+            raise ValueError(
+                f"Feature vocabularies in {path} have version {stored['version']}, "
+                f"only versions up to {FEATURE_VOCABS_VERSION} are supported"
+            )
+        return cls(stored["vocabs"])
+
+
+# Last dict of vocabularies converted by `as_feature_vocabs`, and its conversion
+_converted_vocabs = (None, None)
+
+
+def as_feature_vocabs(vocabs: Union[dict, FeatureVocabs]) -> FeatureVocabs:
+    """Return vocabularies as `FeatureVocabs`. The conversion of the last dict is reused as long as the same dict is
+    passed, so that calling `get_features_from_row` on each row with a dict only converts it once (the dict must not
+    be modified in the meantime)."""
+    global _converted_vocabs
+    if isinstance(vocabs, FeatureVocabs):
+        return vocabs
+    if _converted_vocabs[0] is not vocabs:
+        _converted_vocabs = (vocabs, FeatureVocabs(vocabs))
+    return _converted_vocabs[1]
+
+
+def get_features_from_data(
+    data: pd.DataFrame,
+    features: Union[dict, FeatureVocabs],
+    use_bi_grams: bool,
+    use_repetitions: bool = False,
+    use_past: bool = False,
+    use_pos: bool = False,
+) -> list:
+    """Compute the features of all utterances in the data at once.
+
+    Gives the same result as applying `get_features_from_row` to each row, but bins are assigned using np.digitize
+    and vocabulary lookups are shared between rows.
+
+    Input:
+    -------
+    data: `pd.DataFrame`
+            data with the feature columns created by `add_feature_columns`
+
+    features: `dict` or `FeatureVocabs`
+            dictionary of all features used, by type: {'words':Counter(), ...}
+
+    Output:
+    -------
+    feat_data: `list`
+            list of feature dicts (as returned by `get_features_from_row`), in the order of the rows of the data
+    """
+    if not isinstance(features, FeatureVocabs):
+        features = FeatureVocabs(features)
+    words = features.words
+    word_feature = features.word_feature
+
+    tokens = data.tokens.tolist()
+    speakers = data.speaker_code.to_numpy()
+    prev_speakers = data.prev_speaker_code.to_numpy()
+
+    speaker_codes = (speakers == CHILD).astype(int).tolist()
+    speakers_changed = (speakers != prev_speakers).astype(int).tolist()
+
+    length_features = get_bin_features(
+        data.turn_length.to_numpy(), features.length_bin_keys, features.length_edges
+    )
+
+    if use_repetitions:
+        rep_ratio_features = get_bin_features(
+            data.ratio_repwords.to_numpy(),
+            features.rep_ratio_bin_keys,
+            features.rep_ratio_edges,
+            closed=True,
+        )
+        repeated_words = data.repeated_words.tolist()
+    if use_past:
+        prev_tokens = data.prev_tokens.tolist()
+    if use_pos:
+        pos_vocab = features.pos
+        pos_tags = data.pos.tolist()
+    if use_bi_grams:
+        bigrams = features.bigrams
+
+    feat_data = []
+    for i, utt_tokens in enumerate(tokens):
+        feat_glob = {}
+        feat_glob["words"] = Counter([word_feature(w) for w in utt_tokens])
+        feat_glob["speaker_code"] = speaker_codes[i]
+        feat_glob["speaker_changed"] = speakers_changed[i]
+        feat_glob["length"] = length_features[i]
+
+        if use_bi_grams:
+            # Same as get_n_grams(utt_tokens, 2): bigrams without the final punctuation
+            feat_glob["bigrams"] = Counter(
+                [
+                    "-".join(n_gram)
+                    for n_gram in zip(utt_tokens, utt_tokens[1:-1])
+                    if n_gram in bigrams
+                ]
+            )
+        if use_repetitions:
+            feat_glob["repeated_words"] = Counter(
+                [w for w in repeated_words[i] if w in words]
+            )
+            feat_glob["rep_ratio"] = rep_ratio_features[i]
+        if use_past:
+            feat_glob["prev_tokens"] = Counter(
+                [w for w in prev_tokens[i] if w in words]
+            )
+        if use_pos and pos_tags[i] is not None:
+            feat_glob["pos"] = Counter([w for w in pos_tags[i] if w in pos_vocab])
+
+        feat_data.append(feat_glob)
+
+    return feat_data
+
+
+def _split(values: list, counts: np.ndarray) -> list:
+    """Split a flat list into consecutive lists of the given lengths"""
+    ends = np.cumsum(counts).tolist()
+    return [values[end - nb:end] for end, nb in zip(ends, counts.tolist())]
+
+
+def get_features_from_corpus(
+    corpus: TokenCorpus,
+    features: Union[dict, FeatureVocabs],
+    use_bi_grams: bool,
+    use_repetitions: bool = False,
+    use_past: bool = False,
+    use_pos: bool = False,
+) -> list:
+    """Compute the features of all utterances of a `TokenCorpus`, in the order of its utterances.
+
+    Gives the same result as `get_features_from_data` on the data the corpus was created from, but vocabulary lookups,
+    bigrams and repetitions are computed on the integer ids, each distinct string being looked up only once.
+    (Utterances without POS tags get an empty POS feature, which makes no difference to the CRF.)
+    """
+    if not isinstance(features, FeatureVocabs):
+        features = FeatureVocabs(features)
+    strings = corpus.strings
+    tokens = np.asarray(corpus.tokens)
+    turn_lengths = corpus.turn_lengths()
+    first_utterances = corpus.transcript_offsets[:-1]
+
+    in_words = np.array([s in features.words for s in strings], dtype=bool)
+    word_features = np.array(
+        [s if in_vocab else UNKNOWN for s, in_vocab in zip(strings, in_words)], dtype=object
+    )
+    utterance_words = _split(word_features[tokens].tolist(), turn_lengths)
+
+    child = corpus.interner.get(CHILD)
+    speakers = np.asarray(corpus.speaker_codes)
+    speaker_codes = ((speakers == child) & (child != MISSING)).astype(int).tolist()
+    speakers_changed = (speakers != corpus.previous_speaker_codes()).astype(int).tolist()
+
+    length_features = get_bin_features(
+        turn_lengths, features.length_bin_keys, features.length_edges
+    )
+
+    if use_bi_grams or use_repetitions or use_past:
+        token_utterances = corpus.token_utterances()
+    if use_bi_grams:
+        bigram_ids = [
+            (corpus.interner.get(first), corpus.interner.get(second))
+            for first, second in features.bigrams
+        ]
+        bigram_keys = np.array(
+            [first * len(strings) + second for first, second in bigram_ids if MISSING not in (first, second)],
+            dtype=np.int64,
+        )
+        positions = corpus.n_gram_positions(2)
+        positions = positions[
+            np.isin(tokens[positions].astype(np.int64) * len(strings) + tokens[positions + 1], bigram_keys)
+        ]
+        bigram_names = [
+            f"{strings[first]}-{strings[second]}"
+            for first, second in zip(tokens[positions].tolist(), tokens[positions + 1].tolist())
+        ]
+        utterance_bigrams = _split(
+            bigram_names, np.bincount(token_utterances[positions], minlength=len(corpus))
+        )
+    if use_repetitions:
+        is_repeated = corpus.repeated_tokens()
+        nb_repwords = np.bincount(token_utterances[is_repeated], minlength=len(corpus))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio_repwords = nb_repwords / turn_lengths
+        rep_ratio_features = get_bin_features(
+            ratio_repwords,
+            features.rep_ratio_bin_keys,
+            features.rep_ratio_edges,
+            closed=True,
+        )
+        is_repeated &= in_words[tokens]
+        repeated_words = _split(
+            word_features[tokens[is_repeated]].tolist(),
+            np.bincount(token_utterances[is_repeated], minlength=len(corpus)),
+        )
+    if use_past:
+        known = in_words[tokens]
+        known_words = _split(
+            word_features[tokens[known]].tolist(),
+            np.bincount(token_utterances[known], minlength=len(corpus)),
+        )
+        prev_tokens = [[]] + known_words[:-1]
+        for i in first_utterances.tolist():
+            prev_tokens[i] = []
+    if use_pos:
+        in_pos = np.array([s in features.pos for s in strings], dtype=bool)
+        pos = np.asarray(corpus.pos)
+        pos_utterances = np.repeat(np.arange(len(corpus)), np.diff(corpus.pos_offsets))
+        kept = in_pos[pos]
+        pos_tags = _split(
+            np.array(strings, dtype=object)[pos[kept]].tolist(),
+            np.bincount(pos_utterances[kept], minlength=len(corpus)),
+        )
+
+    feat_data = []
+    for i, words in enumerate(utterance_words):
+        feat_glob = {}
+        feat_glob["words"] = Counter(words)
+        feat_glob["speaker_code"] = speaker_codes[i]
+        feat_glob["speaker_changed"] = speakers_changed[i]
+        feat_glob["length"] = length_features[i]
+
+        if use_bi_grams:
+            feat_glob["bigrams"] = Counter(utterance_bigrams[i])
+        if use_repetitions:
+            feat_glob["repeated_words"] = Counter(repeated_words[i])
+            feat_glob["rep_ratio"] = rep_ratio_features[i]
+        if use_past:
+            feat_glob["prev_tokens"] = Counter(prev_tokens[i])
+        if use_pos:
+            feat_glob["pos"] = Counter(pos_tags[i])
+
+        feat_data.append(feat_glob)
+
+    return feat_data
+
+
+def encode_sequences(sequences: list) -> dict:
+    """Compact form of feature sequences (one per transcript), to send them to other processes. The features are
+    flattened as by pycrfsuite, which is equivalent for training and tagging."""
+    items = [
+        item for xseq in sequences for item in pycrfsuite.ItemSequence(xseq).items()
+    ]
+    return dict(
+        encode_features(items),
+        sequence_lengths=np.array([len(xseq) for xseq in sequences], dtype=np.int64),
+    )
+
+
+def decode_sequences(encoded: dict) -> list:
+    """Feature sequences from their compact form (see `encode_sequences`)"""
+    return _split(decode_features(encoded), encoded["sequence_lengths"])
+
+
+def load_feature_columns(
+    data_file: str,
+    check_repetition: bool = False,
+    use_past: bool = False,
+    feature_cache: FeatureCache = None,
+    read_data=load_utterances,
+) -> pd.DataFrame:
+    """Read the data and add the feature columns (see `add_feature_columns`).
+
+    With a feature cache, the resulting data frame is reused as long as the data file and the flags do not change.
+    """
+    def compute():
+        return add_feature_columns(
+            read_data(data_file), check_repetition=check_repetition, use_past=use_past
+        )
+
+    if feature_cache is None:
+        return compute()
+
+    key = (
+        "feature_columns",
+        feature_cache.file_digest(data_file),
+        check_repetition,
+        use_past,
+    )
+    return feature_cache.data_frame(key, compute)
+
+
+def get_cached_features_from_data(
+    feature_cache: FeatureCache,
+    data_file: str,
+    data: pd.DataFrame,
+    features: FeatureVocabs,
+    use_bi_grams: bool,
+    use_repetitions: bool = False,
+    use_past: bool = False,
+    use_pos: bool = False,
+) -> list:
+    """`get_features_from_data` for a subset of the utterances of data_file, reusing features from the cache.
+
+    Without a feature cache, this is the same as `get_features_from_data`.
+    """
+    def compute():
+        return get_features_from_data(
+            data,
+            features,
+            use_bi_grams=use_bi_grams,
+            use_repetitions=use_repetitions,
+            use_past=use_past,
+            use_pos=use_pos,
+        )
+
+    if feature_cache is None:
+        return compute()
+
+    key = (
+        "crf_features",
+        feature_cache.file_digest(data_file),
+        rows_digest(data),
+        features.digest(),
+        use_bi_grams,
+        use_repetitions,
+        use_past,
+        use_pos,
+    )
+    return feature_cache.features(key, compute)
+
+
+#### Prediction functions
+def get_label_mask(labels: list, exclude_labels: list) -> np.ndarray:
+    """Boolean vector indicating which of the labels are valid predictions"""
+    return np.array([label not in exclude_labels for label in labels])
+
+
+def crf_marginals(tagger: pycrfsuite.Tagger, xseq: list, labels: list) -> np.ndarray:
+    """Return the marginal probabilities of the labels (columns) for each utterance (rows) of a single transcript"""
+    tagger.set(xseq)
+    marginal = tagger.marginal
+    marginals = np.empty((len(xseq), len(labels)))
+    for j, label in enumerate(labels):
+        marginals[:, j] = [marginal(label, i) for i in range(len(xseq))]
+
+    return marginals
+
+
+class CRFWeights:
+    """State and transition weights of a trained CRF, as exported by tagger.info() (see also crf_test.features_report).
+
+    Allows to decode transcripts with NumPy, e.g. using Viterbi with some labels excluded.
+    """
+
+    __slots__ = ("labels", "attribute_index", "state_weights", "transition_weights")
+
+    def __init__(self, tagger: pycrfsuite.Tagger):
+        info = tagger.info()
+        self.labels = tagger.labels()
+        label_index = {label: i for i, label in enumerate(self.labels)}
+
+        self.attribute_index = {}
+        for attr, _ in info.state_features.keys():
+            self.attribute_index.setdefault(attr, len(self.attribute_index))
+
+        self.state_weights = np.zeros((len(self.attribute_index), len(self.labels)))
+        for (attr, label), weight in info.state_features.items():
+            self.state_weights[self.attribute_index[attr], label_index[label]] = weight
+
+        self.transition_weights = np.zeros((len(self.labels), len(self.labels)))
+        for (label_from, label_to), weight in info.transitions.items():
+            self.transition_weights[label_index[label_from], label_index[label_to]] = weight
+
+    def state_scores(self, xseq: list) -> np.ndarray:
+        """Return the state scores of the labels (columns) for each utterance (rows) of a single transcript"""
+        # Attributes as named by pycrfsuite, e.g. {"words:ball": 1.0, "speaker_code": 1.0, ...}
+        items = pycrfsuite.ItemSequence(xseq).items()
+        attribute_index = self.attribute_index
+        attributes = np.array(
+            [attribute_index.get(attr, -1) for item in items for attr in item],
+            dtype=int,
+        )
+        values = np.array([v for item in items for v in item.values()], dtype=float)
+        positions = np.repeat(np.arange(len(items)), [len(item) for item in items])
+
+        # Ignore attributes without weights
+        known = attributes >= 0
+        positions = positions[known]
+        weights = self.state_weights[attributes[known]] * values[known, None]
+
+        # Positions are sorted: sum the weights of each utterance
+        scores = np.zeros((len(xseq), len(self.labels)))
+        if len(positions) > 0:
+            starts = np.flatnonzero(np.r_[True, positions[1:] != positions[:-1]])
+            scores[positions[starts]] = np.add.reduceat(weights, starts, axis=0)
+        return scores
+
+    def viterbi(self, xseq: list, label_mask: np.ndarray = None) -> list:
+        """Return the best sequence of labels for a single transcript, using only the labels in label_mask"""
+        scores = self.state_scores(xseq)
+        if label_mask is not None:
+            scores[:, ~label_mask] = -np.inf
+
+        label_range = np.arange(len(self.labels))
+        backpointers = np.empty(scores.shape, dtype=int)
+        best_scores = scores[0]
+        for i in range(1, len(xseq)):
+            # Scores of all transitions (previous label: rows, current label: columns)
+            candidates = best_scores[:, None] + self.transition_weights
+            backpointers[i] = candidates.argmax(axis=0)
+            best_scores = candidates[backpointers[i], label_range] + scores[i]
+
+        path = [int(best_scores.argmax())]
+        for i in range(len(xseq) - 1, 0, -1):
+            path.append(backpointers[i, path[-1]])
+
+        return [self.labels[label_idx] for label_idx in reversed(path)]
+
+
+def crf_tag(
+    tagger: pycrfsuite.Tagger,
+    xseq: list,
+    mode: str = "raw",
+    label_mask: np.ndarray = None,
+    return_marginals: bool = False,
+    crf_weights: CRFWeights = None,
+) -> Union[list, Tuple[list, np.ndarray]]:
+    """Return predictions for the utterances of a single transcript (see `crf_predict` for the modes).
+
+    label_mask: valid labels in exclude_ool modes, in the order of tagger.labels() (see `get_label_mask`), all labels
+    but OOL_LABELS by default
+    crf_weights: weights of the tagger's model, used in exclude_ool_viterbi mode (loaded from the tagger if not given,
+    pass them when tagging several transcripts to load them only once)
+    """
+    if mode not in PREDICTION_MODES:
+        raise ValueError(
+            f"mode must be one of {'|'.join(PREDICTION_MODES)}; currently {mode}"
+        )
+    labels = tagger.labels()
+    if label_mask is None:
+        label_mask = get_label_mask(labels, OOL_LABELS)
+    if mode in ["raw", "exclude_ool_viterbi"]:
+        if mode == "raw":
+            y_pred = tagger.tag(xseq)
+        else:
+            if crf_weights is None:
+                crf_weights = CRFWeights(tagger)
+            y_pred = crf_weights.viterbi(xseq, label_mask)
+        if not return_marginals:
+            return y_pred
+        marginals = crf_marginals(tagger, xseq, labels)
+    else:
+        marginals = crf_marginals(tagger, xseq, labels)
+        # Most probable valid label for each utterance
+        y_pred_idx = np.where(label_mask, marginals, -np.inf).argmax(axis=1)
+        y_pred = [labels[i] for i in y_pred_idx]
+
+    if return_marginals:
+        return y_pred, marginals
+    return y_pred
+
+
+class IncrementalTagger:
+    """Tags a transcript utterance by utterance, e.g. while it is being transcribed.
+
+    Keeps the previous utterance (for the speaker_changed, repetition and past features) and the frontier of the
+    Viterbi and forward algorithms, so that appending an utterance takes O(labels^2) time, independently of the length
+    of the transcript. Gives the same labels as tagging the whole transcript (in raw or exclude_ool_viterbi mode).
+    """
+
+    def __init__(
+        self,
+        crf_weights: CRFWeights,
+        feature_vocabs: FeatureVocabs,
+        use_bi_grams: bool = False,
+        use_repetitions: bool = False,
+        use_past: bool = False,
+        use_pos: bool = False,
+        label_mask: np.ndarray = None,
+    ):
+        """crf_weights can be shared by the taggers of several transcripts. With a label_mask (see `get_label_mask`),
+        only valid labels are predicted."""
+        self.crf_weights = crf_weights
+        self.feature_vocabs = feature_vocabs
+        self.use_bi_grams = use_bi_grams
+        self.use_repetitions = use_repetitions
+        self.use_past = use_past
+        self.use_pos = use_pos
+        self.label_mask = label_mask
+
+        self.prev_tokens = []
+        self.prev_speaker = None
+        # Viterbi: best score of a sequence ending with each label, and best previous label for each utterance
+        self.best_scores = None
+        self.backpointers = []
+        # Forward algorithm: log of the summed scores of all sequences ending with each label
+        self.log_alphas = None
+
+    def __len__(self):
+        return len(self.backpointers)
+
+    def utterance_features(self, tokens: list, speaker_code: str, pos: list = None) -> dict:
+        """Features of the next utterance, as computed by `add_feature_columns` and `get_features_from_data`"""
+        repetitions = None
+        if self.use_repetitions:
+            if speaker_code != self.prev_speaker:
+                prev_tokens = set(self.prev_tokens)
+                repeated_words = [
+                    t for t in tokens if t in prev_tokens and t not in PUNCTUATION_TOKENS
+                ]
+            else:
+                repeated_words = []
+            ratio = len(repeated_words) / len(tokens) if len(tokens) > 0 else np.nan
+            repetitions = (repeated_words, ratio)
+
+        return get_features_from_row(
+            self.feature_vocabs,
+            tokens,
+            speaker_code,
+            self.prev_speaker,
+            len(tokens),
+            use_bi_grams=self.use_bi_grams,
+            repetitions=repetitions,
+            prev_tokens=list(self.prev_tokens) if self.use_past else None,
+            pos_tags=pos if self.use_pos else None,
+        )
+
+    def append(self, tokens: list, speaker_code: str, pos: list = None) -> str:
+        """Add the next utterance of the transcript, returns its most probable label given the utterances so far"""
+        scores = self.crf_weights.state_scores(
+            [self.utterance_features(tokens, speaker_code, pos)]
+        )[0]
+        if self.label_mask is not None:
+            scores[~self.label_mask] = -np.inf
+
+        transitions = self.crf_weights.transition_weights
+        if self.best_scores is None:
+            self.backpointers.append(None)
+            self.best_scores = scores
+            self.log_alphas = scores
+        else:
+            # Scores of all transitions (previous label: rows, current label: columns)
+            candidates = self.best_scores[:, None] + transitions
+            backpointers = candidates.argmax(axis=0)
+            self.backpointers.append(backpointers)
+            self.best_scores = (
+                candidates[backpointers, np.arange(len(scores))] + scores
+            )
+            self.log_alphas = (
+                np.logaddexp.reduce(self.log_alphas[:, None] + transitions, axis=0)
+                + scores
+            )
+
+        self.prev_tokens = tokens
+        self.prev_speaker = speaker_code
+
+        return self.crf_weights.labels[int(self.best_scores.argmax())]
+
+    def marginals(self) -> np.ndarray:
+        """Probabilities of the labels (in the order of tagger.labels()) for the last utterance, given the
+        utterances so far"""
+        return np.exp(self.log_alphas - np.logaddexp.reduce(self.log_alphas))
+
+    def decode(self) -> list:
+        """Return the best sequence of labels for all utterances so far (as `CRFWeights.viterbi`)"""
+        if len(self) == 0:
+            return []
+        path = [int(self.best_scores.argmax())]
+        for backpointers in reversed(self.backpointers[1:]):
+            path.append(backpointers[path[-1]])
+        return [self.crf_weights.labels[label_idx] for label_idx in reversed(path)]
+
+
+# State of crf_predict worker processes: Tagger and its weights (loaded when needed)
+_worker_tagger = None
+_worker_crf_weights = None
+
+# Pool of crf_predict worker processes, reused across calls as long as the model and the number of workers are the same
+_predict_pool = None
+_predict_pool_key = None
+
+
+def _init_predict_worker(model_path: str):
+    global _worker_tagger
+    _worker_tagger = pycrfsuite.Tagger()
+    _worker_tagger.open(model_path)
+
+
+def _predict_batch(args: tuple) -> list:
+    global _worker_crf_weights
+    encoded_sequences, mode, exclude_labels, return_marginals = args
+    sequences = decode_sequences(encoded_sequences)
+    label_mask = get_label_mask(_worker_tagger.labels(), exclude_labels)
+    if mode == "exclude_ool_viterbi" and _worker_crf_weights is None:
+        _worker_crf_weights = CRFWeights(_worker_tagger)
+    return [
+        crf_tag(
+            _worker_tagger,
+            xseq,
+            mode,
+            label_mask,
+            return_marginals,
+            _worker_crf_weights,
+        )
+        for xseq in sequences
+    ]
+
+
+def get_predict_pool(model_path: str, workers: int) -> multiprocessing.pool.Pool:
+    """Return a pool of `workers` processes with a Tagger opened on model_path.
+
+    The pool is reused by subsequent calls with the same model file (same path and modification time) and number of
+    workers, e.g. for each chunk of `crf_annotate.py --stream`; otherwise the previous pool is closed.
+    """
+    global _predict_pool, _predict_pool_key
+    key = (os.path.abspath(model_path), os.stat(model_path).st_mtime_ns, workers)
+    if _predict_pool_key != key:
+        close_predict_pool()
+        _predict_pool = multiprocessing.Pool(
+            workers, initializer=_init_predict_worker, initargs=(model_path,)
+        )
+        _predict_pool_key = key
+    return _predict_pool
+
+
+@atexit.register
+def close_predict_pool():
+    """Close the pool of crf_predict worker processes, if any"""
+    global _predict_pool, _predict_pool_key
+    if _predict_pool is not None:
+        _predict_pool.close()
+        _predict_pool.join()
+    _predict_pool = None
+    _predict_pool_key = None
+
+
+def split_batches(sequence_lengths: list, nb_batches: int) -> list:
+    """Split sequences into consecutive batches of about the same total length, returns (start, end) indices"""
+    if len(sequence_lengths) == 0:
+        return []
+    cumulative_lengths = np.cumsum(sequence_lengths)
+    targets = np.linspace(0, cumulative_lengths[-1], nb_batches + 1)[1:-1]
+    boundaries = np.unique(np.searchsorted(cumulative_lengths, targets, side="right"))
+    boundaries = (
+        [0]
+        + [b for b in boundaries.tolist() if 0 < b < len(sequence_lengths)]
+        + [len(sequence_lengths)]
+    )
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def crf_predict(
+    tagger: pycrfsuite.Tagger,
+    data: pd.DataFrame,
+    mode: str = "raw",
+    exclude_labels: list = OOL_LABELS,
+    workers: int = 1,
+    model_path: str = None,
+    return_marginals: bool = False,
+) -> Union[list, Tuple[list, pd.DataFrame]]:
+    """Return predictions for the test data, grouped by file. 3 modes for return:
+            * Return raw predictions (raw)
+            * Return predictions with only valid tags (exclude_ool), most probable valid tag for each utterance
+            * Return predictions with only valid tags (exclude_ool_viterbi), best sequence of valid tags
+
+    Predictions are returned unflattened
+
+    With return_marginals, the marginal probabilities of all labels are returned as well, as a DataFrame with one
+    column per label and one row per prediction.
+
+    With workers > 1, transcripts are tagged in parallel by worker processes, which each open their own Tagger on
+    model_path (see `get_predict_pool`). Each task sends a worker only its own batch of transcripts, in compact form
+    (see `encode_sequences`), so that the data is not copied to every worker whatever the start method of the
+    processes.
+
+    https://python-crfsuite.readthedocs.io/en/latest/pycrfsuite.html
+    """
+    grouped_data = data.groupby(by=["transcript_file"], sort=False).agg(
+        {"features": lambda x: [y for y in x]}
+    )["features"]
+
+    if mode not in PREDICTION_MODES:
+        raise ValueError(
+            f"mode must be one of {'|'.join(PREDICTION_MODES)}; currently {mode}"
+        )
+    if workers > 1:
+        if model_path is None:
+            raise ValueError("model_path is required to predict with several workers")
+        sequences = grouped_data.tolist()
+        # Several batches per worker, to balance the load
+        batches = split_batches([len(xseq) for xseq in sequences], workers * 4)
+        pool = get_predict_pool(model_path, workers)
+        y_pred = [
+            y
+            for batch_pred in tqdm(
+                pool.imap(
+                    _predict_batch,
+                    (
+                        (
+                            encode_sequences(sequences[start:end]),
+                            mode,
+                            exclude_labels,
+                            return_marginals,
+                        )
+                        for start, end in batches
+                    ),
+                ),
+                total=len(batches),
+            )
+            for y in batch_pred
+        ]
+    else:
+        label_mask = get_label_mask(tagger.labels(), exclude_labels)
+        crf_weights = CRFWeights(tagger) if mode == "exclude_ool_viterbi" else None
+        y_pred = [
+            crf_tag(tagger, xseq, mode, label_mask, return_marginals, crf_weights)
+            for xseq in tqdm(grouped_data)
+        ]
+
+    if return_marginals:
+        y_pred, marginals = zip(*y_pred) if y_pred else ([], [])
+        marginals = pd.DataFrame(
+            np.concatenate(marginals) if marginals else None,
+            columns=tagger.labels(),
+        )
+        return [y for x in y_pred for y in x], marginals
+
+    return [y for x in y_pred for y in x]  # flatten
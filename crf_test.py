@@ -16,18 +16,22 @@ from scipy.stats import spearmanr
 
 import pycrfsuite
 
+from data_store import save_utterances
+from feature_cache import FeatureCache
 from preprocess import SPEECH_ACT
-from crf_train import (
-    add_feature_columns,
-    get_features_from_row,
+from crf_tagger import (
+    load_feature_columns,
+    get_cached_features_from_data,
     crf_predict,
-    bio_classification_report,
+    PREDICTION_MODES,
+    FeatureVocabs,
 )
+from crf_train import bio_classification_report
 from utils import (
     SPEECH_ACT_UNINTELLIGIBLE,
     SPEECH_ACT_NO_FUNCTION,
     make_train_test_splits,
-    SPEECH_ACT_DESCRIPTIONS,
+    get_speech_act_descriptions,
     calculate_frequencies,
     PATH_NEW_ENGLAND_UTTERANCES, ADULT,
 )
@@ -77,10 +81,23 @@ def parse_args():
     )
     argparser.add_argument(
         "--prediction_mode",
-        choices=["raw", "exclude_ool"],
+        choices=PREDICTION_MODES,
         default="raw",
         type=str,
-        help="Whether to predict with NOL/NAT/NEE labels or not.",
+        help="Whether to predict with NOL/NAT/NEE labels or not (excluding them for each utterance or using "
+        "Viterbi decoding over the whole transcript).",
+    )
+    argparser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes tagging transcripts in parallel",
+    )
+    argparser.add_argument(
+        "--feature-cache",
+        type=str,
+        default=None,
+        help="Directory to cache computed features in (e.g. ~/data/speech_acts/feature_cache/)",
     )
     argparser.add_argument(
         "--use-bi-grams",
@@ -206,36 +223,34 @@ if __name__ == "__main__":
     classification_scores_path = os.path.join(args.model, "classification_scores.p")
     classification_scores_adult_path = os.path.join(args.model, "classification_scores_adult.p")
 
-    # Loading data
-    data = pd.read_pickle(args.data)
+    feature_cache = (
+        FeatureCache(args.feature_cache) if args.feature_cache is not None else None
+    )
 
-    data = add_feature_columns(
-        data, check_repetition=args.use_repetitions, use_past=args.use_past,
+    # Loading data
+    data = load_feature_columns(
+        args.data,
+        check_repetition=args.use_repetitions,
+        use_past=args.use_past,
+        feature_cache=feature_cache,
     )
 
     data_train, data_test = make_train_test_splits(data, args.test_ratio)
     print(f"Testing on {len(data_test)} utterances")
 
     # Loading features
-    with open(features_path, "rb") as pickle_file:
-        feature_vocabs = pickle.load(pickle_file)
+    feature_vocabs = FeatureVocabs.load(features_path)
 
     data_test = data_test.assign(
-        features=data_test.apply(
-            lambda x: get_features_from_row(
-                feature_vocabs,
-                x.tokens,
-                x.speaker_code,
-                x.prev_speaker_code,
-                x.turn_length,
-                use_bi_grams=args.use_bi_grams,
-                repetitions=None
-                if not args.use_repetitions
-                else (x.repeated_words, x.ratio_repwords),
-                prev_tokens=None if not args.use_past else x.past,
-                pos_tags=None if not args.use_pos else x.pos,
-            ),
-            axis=1,
+        features=get_cached_features_from_data(
+            feature_cache,
+            args.data,
+            data_test,
+            feature_vocabs,
+            use_bi_grams=args.use_bi_grams,
+            use_repetitions=args.use_repetitions,
+            use_past=args.use_past,
+            use_pos=args.use_pos,
         )
     )
 
@@ -243,7 +258,13 @@ if __name__ == "__main__":
     tagger = pycrfsuite.Tagger()
     tagger.open(model_path)
 
-    y_pred = crf_predict(tagger, data_test, mode=args.prediction_mode,)
+    y_pred = crf_predict(
+        tagger,
+        data_test,
+        mode=args.prediction_mode,
+        workers=args.workers,
+        model_path=model_path,
+    )
     data_test = data_test.assign(speech_act_predicted=y_pred)
 
     data_filtered = data_test.drop(
@@ -256,7 +277,7 @@ if __name__ == "__main__":
             "features",
         ]
     )
-    data_filtered.to_pickle(os.path.join("checkpoints", "crf", "speech_acts.p"))
+    save_utterances(data_filtered, os.path.join("checkpoints", "crf", "speech_acts.parquet"))
 
     data_test["pred_OK"] = data_test.apply(
         lambda x: (x.speech_act_predicted == x[SPEECH_ACT]), axis=1
@@ -304,6 +325,7 @@ if __name__ == "__main__":
     pickle.dump(pd.DataFrame(cr_adult).T, open(classification_scores_adult_path, "wb"))
 
     confusion_matrix = confusion_matrix.T
+    speech_act_descriptions = get_speech_act_descriptions()
     for label in np.unique(data_test[SPEECH_ACT]):
         confusions = confusion_matrix[confusion_matrix[label] > 0.05].index.values
         confusions = np.delete(confusions, np.where(confusions == label))
@@ -315,12 +337,12 @@ if __name__ == "__main__":
         #     if label_category == confused_label_category:
         #         genuine_confusions.append(confusion)
 
-        if len(confusions) > 0 and label in SPEECH_ACT_DESCRIPTIONS.Description:
+        if len(confusions) > 0 and label in speech_act_descriptions.Description:
             print(
-                f"{label} ({SPEECH_ACT_DESCRIPTIONS.Description[label]}) is confused with:"
+                f"{label} ({speech_act_descriptions.Description[label]}) is confused with:"
             )
             for confusion in confusions:
-                print(confusion, SPEECH_ACT_DESCRIPTIONS.Description[confusion])
+                print(confusion, speech_act_descriptions.Description[confusion])
             print("")
 
     if args.col_ages is not None:
@@ -1,8 +1,6 @@
 import os
 import argparse
-import pickle
 from collections import Counter
-from typing import Union, Tuple
 
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -16,19 +14,32 @@ from sklearn.metrics import (
 )
 import numpy as np
 import pycrfsuite
-from tqdm import tqdm
 
-from preprocess import SPEECH_ACT
+from crf_tagger import (
+    FeatureVocabs,
+    load_feature_columns,
+    get_cached_features_from_data,
+    crf_predict,
+)
+from feature_cache import FeatureCache
+from token_corpus import TokenCorpus
 from utils import (
+    SPEECH_ACT,
     SPEECH_ACT_UNINTELLIGIBLE,
     SPEECH_ACT_NO_FUNCTION,
     make_train_test_splits,
-    PUNCTUATION,
     UNKNOWN,
     PATH_NEW_ENGLAND_UTTERANCES,
-    CHILD,
 )
 
+# Parameters of the pycrfsuite.Trainer
+CRF_TRAINER_PARAMS = {
+    "c1": 1,  # coefficient for L1 penalty
+    "c2": 1e-3,  # coefficient for L2 penalty
+    "max_iterations": 50,  # stop earlier
+    "feature.possible_transitions": True,  # include transitions that are possible, but not observed
+}
+
 
 def parse_args():
     argparser = argparse.ArgumentParser(description="Train a CRF and test it.",)
@@ -88,6 +99,12 @@ def parse_args():
         action="store_true",
         help="Whether to display training iterations output.",
     )
+    argparser.add_argument(
+        "--feature-cache",
+        type=str,
+        default=None,
+        help="Directory to cache computed features in (e.g. ~/data/speech_acts/feature_cache/)",
+    )
 
     args = argparser.parse_args()
 
@@ -95,140 +112,6 @@ def parse_args():
 
 
 #### Features functions
-def add_feature_columns(
-    data: pd.DataFrame, use_past: bool = False, check_repetition: bool = False,
-):
-    """Function adding features to the data:
-    * turn_length
-    * tags (if necessary): extract interchange/illocutionary from general tag
-    * repeated_words:
-    * number of repeated words
-    * ratio of words that were repeated from previous sentence over sentence length
-    """
-    data = data.sort_values(["transcript_file", "utterance_id"])
-
-    data["tokens"] = data.tokens
-
-    data["turn_length"] = data.tokens.apply(len)
-
-    data["prev_file"] = data.transcript_file.shift(
-        1, fill_value=data.transcript_file.iloc[0]
-    )
-
-    data["prev_speaker_code"] = data["speaker_code"].shift(1)
-    data.loc[data.transcript_file != data.prev_file, "prev_speaker_code"] = None
-
-    # repetition features
-    if check_repetition or use_past:
-        data["prev_tokens"] = data.tokens.shift(1)
-        data.loc[data.transcript_file != data.prev_file, "prev_tokens"] = None
-        data["prev_tokens"] = data["prev_tokens"].fillna("").apply(list)
-
-    if check_repetition:
-        data["repeated_words"] = data.apply(
-            lambda x: [
-                w
-                for w in x.tokens
-                if w in x.prev_tokens and w not in PUNCTUATION.values()
-            ]
-            if (x.prev_speaker_code != x.speaker_code)
-            else [],
-            axis=1,
-        )
-        data["nb_repwords"] = data.repeated_words.apply(len)
-        data["ratio_repwords"] = data.nb_repwords / data.turn_length
-
-    # remove helper columns
-    data = data.drop(columns=["prev_file"])
-
-    # return Dataframe
-    return data
-
-
-def get_features_from_row(
-    features: dict,
-    tokens: list,
-    speaker: str,
-    prev_speaker: str,
-    ln: int,
-    use_bi_grams,
-    **kwargs,
-):
-    """Replacing input list tokens with feature index
-
-
-    Input:
-    -------
-    features: `dict`
-            dictionary of all features used, by type: {'words':Counter(), ...}
-
-    spoken_tokens: `list`
-            data sentence
-
-    speaker: `str`
-            MOT/CHI
-
-    ln: `int`
-            sentence length
-
-    Kwargs:
-    --------
-    prev_tokens: `list`
-
-    repetitions: `Tuple[list, float, float]`
-            contains the list of repeated words, number of words repeated, ratio of repeated words over sequence
-
-    Output:
-    -------
-    feat_glob: `dict`
-            dictionary of same shape as feature, but only containing features relevant to data line
-    """
-    feat_glob = {}
-
-    feat_glob["words"] = Counter(
-        [w if w in features["words"].keys() else UNKNOWN for w in tokens]
-    )
-
-    feat_glob["speaker_code"] = 1 if speaker == CHILD else 0
-    feat_glob["speaker_changed"] = 1 if speaker != prev_speaker else 0
-
-    feat_glob["length"] = {
-        k: 1
-        for k in features["length_bins"].keys()
-        if float(k.split("-")[1]) > ln >= float(k.split("-")[0])
-    }
-
-    if use_bi_grams:
-        bi_grams = [
-            "-".join(n_gram)
-            for n_gram in get_n_grams(tokens, 2)
-            if n_gram in features["bigrams"].keys()
-        ]
-        feat_glob["bigrams"] = Counter(bi_grams)
-
-    if ("repetitions" in kwargs) and (kwargs["repetitions"] is not None):
-        (rep_words, ratio_rep) = kwargs["repetitions"]
-        feat_glob["repeated_words"] = Counter(
-            [w for w in rep_words if (w in features["words"].keys())]
-        )
-        feat_glob["rep_ratio"] = {
-            k: 1
-            for k in features["rep_ratio_bins"].keys()
-            if float(k.split("-")[1]) >= ratio_rep >= float(k.split("-")[0])
-        }
-    if ("prev_tokens" in kwargs) and (kwargs["prev_tokens"] is not None):
-        feat_glob["prev_tokens"] = Counter(
-            [w for w in kwargs["prev_tokens"] if (w in features["words"].keys())]
-        )
-
-    if ("pos_tags" in kwargs) and (kwargs["pos_tags"] is not None):
-        feat_glob["pos"] = Counter(
-            [w for w in kwargs["pos_tags"] if (w in features["pos"].keys())]
-        )
-
-    return feat_glob
-
-
 def get_n_grams(utterance, n):
     # Cut off punctuation
     utterance = utterance[:-1]
@@ -237,6 +120,9 @@ def get_n_grams(utterance, n):
 
 
 def get_n_grams_counter(utterances, n):
+    """Counter of the n-grams of the utterances (lists of tokens, or a TokenCorpus)"""
+    if isinstance(utterances, TokenCorpus):
+        return utterances.n_grams_counter(n)
     counter = Counter()
     for utterance in utterances:
         n_grams = get_n_grams(utterance, n)
@@ -252,7 +138,7 @@ def generate_features_vocabs(
     use_pos: bool,
     num_bins_length: int = 5,
     num_bins_rep=3,
-) -> dict:
+) -> FeatureVocabs:
     """Analyse data according to arguments passed and generate features_idx dictionary. Printing log data to console."""
     feature_vocabs = {}
     print("\nTag counts: ")
@@ -347,7 +233,7 @@ def generate_features_vocabs(
         )
         print(list(feature_vocabs["pos"].keys()))
 
-    return feature_vocabs
+    return FeatureVocabs(feature_vocabs)
 
 
 ### REPORT
@@ -363,52 +249,6 @@ def plot_training(trainer, file_name):
         plt.savefig(file_name + "/" + col + ".png")
 
 
-def crf_predict(
-    tagger: pycrfsuite.Tagger,
-    data: pd.DataFrame,
-    mode: str = "raw",
-    exclude_labels: list = ["NOL", "NAT", "NEE"],
-) -> Union[list, Tuple[list, pd.DataFrame]]:
-    """Return predictions for the test data, grouped by file. 3 modes for return:
-            * Return raw predictions (raw)
-            * Return predictions with only valid tags (exclude_ool)
-
-    Predictions are returned unflattened
-
-    https://python-crfsuite.readthedocs.io/en/latest/pycrfsuite.html
-    """
-    grouped_data = data.groupby(by=["transcript_file"], sort=False).agg(
-        {"features": lambda x: [y for y in x]}
-    )["features"]
-
-    if mode not in ["raw", "exclude_ool"]:
-        raise ValueError(
-            f"mode must be one of raw|exclude_ool|rt_proba; currently {mode}"
-        )
-    if mode == "raw":
-        y_pred = [tagger.tag(xseq) for xseq in tqdm(grouped_data)]
-    else:
-        labels = tagger.labels()
-
-        y_pred = []
-        for fi, xseq in enumerate(grouped_data):
-            tagger.set(xseq)
-            file_proba = pd.DataFrame(
-                {
-                    label: [tagger.marginal(label, i) for i in range(len(xseq))]
-                    for label in labels
-                }
-            )
-            y_pred.append(
-                file_proba[[col for col in file_proba.columns if col not in exclude_labels]]
-                .idxmax(axis=1)
-                .tolist()
-            )
-            file_proba["transcript_file"] = fi
-
-    return [y for x in y_pred for y in x]  # flatten
-
-
 def bio_classification_report(y_true, y_pred):
     """
     Classification report for a list of BIO-encoded sequences.
@@ -457,13 +297,19 @@ def train(
     cut_train_set=1.0,
     nb_occurrences=5,
     verbose=False,
+    feature_cache_dir=None,
 ):
     print("### Loading data:".upper())
 
-    data = pd.read_pickle(data_file)
+    feature_cache = (
+        FeatureCache(feature_cache_dir) if feature_cache_dir is not None else None
+    )
 
-    data = add_feature_columns(
-        data, check_repetition=use_repetitions, use_past=use_past
+    data = load_feature_columns(
+        data_file,
+        check_repetition=use_repetitions,
+        use_past=use_past,
+        feature_cache=feature_cache,
     )
 
     data_train, data_test = make_train_test_splits(data, test_ratio)
@@ -485,21 +331,15 @@ def train(
 
     # creating crf features set for train
     data_train = data_train.assign(
-        features=data_train.apply(
-            lambda x: get_features_from_row(
-                feature_vocabs,
-                x.tokens,
-                x.speaker_code,
-                x.prev_speaker_code,
-                x.turn_length,
-                use_bi_grams=use_bi_grams,
-                repetitions=None
-                if not use_repetitions
-                else (x.repeated_words, x.ratio_repwords),
-                prev_tokens=None if not use_past else x.prev_tokens,
-                pos_tags=None if not use_pos else x.pos,
-            ),
-            axis=1,
+        features=get_cached_features_from_data(
+            feature_cache,
+            data_file,
+            data_train,
+            feature_vocabs,
+            use_bi_grams=use_bi_grams,
+            use_repetitions=use_repetitions,
+            use_past=use_past,
+            use_pos=use_pos,
         )
     )
 
@@ -518,14 +358,7 @@ def train(
         trainer.append(file_data["features"], file_data[SPEECH_ACT])  # X_train, y_train
 
     # Parameters
-    trainer.set_params(
-        {
-            "c1": 1,  # coefficient for L1 penalty
-            "c2": 1e-3,  # coefficient for L2 penalty
-            "max_iterations": 50,  # stop earlier
-            "feature.possible_transitions": True,  # include transitions that are possible, but not observed
-        }
-    )
+    trainer.set_params(CRF_TRAINER_PARAMS)
 
     # Location for weight save
     checkpoint_path = "checkpoints/crf/"
@@ -540,29 +373,22 @@ def train(
         plot_training(trainer, checkpoint_path)
 
     # dumping features
-    with open(os.path.join(checkpoint_path, "feature_vocabs.p"), "wb") as pickle_file:
-        pickle.dump(feature_vocabs, pickle_file)
+    feature_vocabs.save(os.path.join(checkpoint_path, "feature_vocabs.p"))
 
     # Calculate test accuracy
     tagger = pycrfsuite.Tagger()
     tagger.open(os.path.join(checkpoint_path, "model.pycrfsuite"))
 
     data_test = data_test.assign(
-        features=data_test.apply(
-            lambda x: get_features_from_row(
-                feature_vocabs,
-                x.tokens,
-                x["speaker_code"],
-                x["prev_speaker_code"],
-                x.turn_length,
-                use_bi_grams=use_bi_grams,
-                repetitions=None
-                if not use_repetitions
-                else (x.repeated_words, x.ratio_repwords),
-                prev_tokens=None if not use_past else x.prev_tokens,
-                pos_tags=None if not use_pos else x.pos,
-            ),
-            axis=1,
+        features=get_cached_features_from_data(
+            feature_cache,
+            data_file,
+            data_test,
+            feature_vocabs,
+            use_bi_grams=use_bi_grams,
+            use_repetitions=use_repetitions,
+            use_past=use_past,
+            use_pos=use_pos,
         )
     )
 
@@ -595,4 +421,5 @@ if __name__ == "__main__":
         args.cut_train_set,
         args.nb_occurrences,
         args.verbose,
+        args.feature_cache,
     )
@@ -0,0 +1,323 @@
+"""Storage of utterance data frames as partitioned Parquet datasets.
+
+Datasets are directories (e.g. `new_england_preprocessed.parquet/`) partitioned by corpus and age
+(`corpus=NewEngland/age=14/part-0.parquet`), tokens and POS tags are stored as list columns. Loading supports column
+projection and predicate pushdown, so that only the needed columns and partitions are read, e.g.:
+
+    load_utterances(
+        PATH_NEW_ENGLAND_UTTERANCES,
+        columns=["transcript_file", "tokens", "speech_act"],
+        filters=[("speaker_code", "==", CHILD), ("age", "in", [14, 20, 32])],
+    )
+
+Pickled data frames (`.p`) and CSVs (`.csv`) are still supported for reading and writing, filters are then applied
+after loading the whole file. When a Parquet dataset does not exist but a pickle or CSV with the same name does (e.g.
+`new_england_preprocessed.p` from before the Parquet store), the latter is loaded instead. Such files can be converted
+once with:
+
+    python data_store.py data/new_england_preprocessed.p data/new_england_preprocessed.parquet
+"""
+
+import argparse
+import gc
+import os
+import operator
+import shutil
+from ast import literal_eval
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+
+# Columns used to partition datasets (if present in the data)
+PARTITION_COLUMNS = ["corpus", "age", "age_months"]
+
+LIST_COLUMNS = ["tokens", "pos"]
+
+HIVE_NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+# Key of the schema metadata storing the types of the partition columns
+PARTITION_SCHEMA_KEY = b"partition_schema"
+
+# Position of each row in the data frame that was stored, used to restore the order of the rows when loading
+ROW_COLUMN = "__row"
+
+FILTER_OPERATORS = {
+    "==": operator.eq,
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": lambda column, values: column.isin(values),
+    "not in": lambda column, values: ~column.isin(values),
+}
+
+
+def is_parquet(path: str) -> bool:
+    return os.path.isdir(path) or path.rstrip(os.sep).endswith(".parquet")
+
+
+def _filter_data(data: pd.DataFrame, filters: list) -> pd.DataFrame:
+    """Apply filters in the format of pyarrow (see `load_utterances`) to a data frame"""
+    if not filters:
+        return data
+    if not isinstance(filters[0], list):
+        filters = [filters]
+
+    mask = pd.Series(False, index=data.index)
+    for conjunction in filters:
+        conjunction_mask = pd.Series(True, index=data.index)
+        for column, op, value in conjunction:
+            conjunction_mask &= FILTER_OPERATORS[op](data[column], value)
+        mask |= conjunction_mask
+    return data[mask]
+
+
+def _load_legacy(path: str, columns: list = None, filters: list = None) -> pd.DataFrame:
+    if path.endswith(".csv"):
+        data = pd.read_csv(
+            path, converters={column: literal_eval for column in LIST_COLUMNS}
+        )
+    else:
+        data = pd.read_pickle(path)
+
+    data = _filter_data(data, filters)
+    if columns is not None:
+        data = data[columns]
+    return data
+
+
+def legacy_path(path: str):
+    """Pickle or CSV with the name of a Parquet dataset (e.g. `utterances.p` for `utterances.parquet`), if one exists"""
+    base = path.rstrip(os.sep)
+    if base.endswith(".parquet"):
+        base = base[: -len(".parquet")]
+    for extension in [".p", ".csv"]:
+        if os.path.isfile(base + extension):
+            return base + extension
+    return None
+
+
+def _to_lists(column) -> list:
+    """Convert a list column to Python lists (faster than to_pylist(), by slicing a flat list of all values)"""
+    import pyarrow as pa
+
+    lists = []
+    # Creating many lists would repeatedly trigger the garbage collector, which would then take most of the time
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for chunk in column.chunks:
+            values = chunk.values
+            if chunk.null_count > 0 or values.null_count > 0:
+                lists.extend(chunk.to_pylist())
+                continue
+            if pa.types.is_dictionary(values.type):
+                # Each distinct value is only converted once
+                values = np.array(values.dictionary.to_pylist(), dtype=object)[
+                    values.indices.to_numpy()
+                ]
+            else:
+                values = values.to_numpy(zero_copy_only=False)
+            values = values.tolist()
+            offsets = chunk.offsets.to_numpy().tolist()
+            lists.extend(values[start:end] for start, end in zip(offsets, offsets[1:]))
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return lists
+
+
+def load_utterances(path: str, columns: list = None, filters: list = None) -> pd.DataFrame:
+    """Load a data frame of utterances.
+
+    Args:
+        path: Parquet dataset (directory or `.parquet` file), pickled data frame or CSV
+        columns: columns to load (default: all)
+        filters: rows to load, as a list of (column, op, value) tuples that all need to be satisfied, or a list of
+            such lists of which one needs to be satisfied. op is one of ==, !=, <, <=, >, >=, in, not in. For Parquet
+            datasets, filters on partition columns skip whole partitions and other filters are applied while reading.
+
+    Returns:
+        The utterances, in the order in which they were stored, with tokens and POS tags as lists.
+    """
+    if not is_parquet(path):
+        return _load_legacy(path, columns, filters)
+    if not os.path.exists(path) and legacy_path(path) is not None:
+        print(
+            f"{path} does not exist, loading {legacy_path(path)} instead (convert it with: "
+            f"python data_store.py {legacy_path(path)} {path})"
+        )
+        return _load_legacy(legacy_path(path), columns, filters)
+
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    # Tokens and POS tags are read dictionary-encoded, as they have small vocabularies
+    file_format = ds.ParquetFileFormat(
+        read_options=ds.ParquetReadOptions(
+            dictionary_columns=[
+                f"{column}.list.{element}" for column in LIST_COLUMNS for element in ["element", "item"]
+            ]
+        )
+    )
+    dataset = ds.dataset(path, format=file_format, partitioning="hive")
+    metadata = dataset.schema.metadata or {}
+    if PARTITION_SCHEMA_KEY in metadata:
+        # Types of the partition columns as stored (instead of inferring them from the directory names)
+        partition_schema = pa.ipc.read_schema(pa.py_buffer(metadata[PARTITION_SCHEMA_KEY]))
+        dataset = ds.dataset(
+            dataset.files,
+            format=file_format,
+            partitioning=ds.partitioning(partition_schema, flavor="hive"),
+            partition_base_dir=path,
+        )
+    pandas_metadata = dataset.schema.pandas_metadata or {}
+    read_columns = None
+    if columns is not None:
+        index_columns = [
+            column for column in pandas_metadata.get("index_columns", []) if isinstance(column, str)
+        ]
+        read_columns = list(columns) + index_columns
+        if ROW_COLUMN in dataset.schema.names:
+            read_columns.append(ROW_COLUMN)
+    table = dataset.to_table(
+        columns=read_columns,
+        filter=pq.filters_to_expression(filters) if filters else None,
+    )
+
+    # List columns are converted with `_to_lists`, others (e.g. POS tags stored as strings) with to_pandas()
+    list_columns = [
+        column
+        for column in LIST_COLUMNS
+        if column in table.column_names
+        and (
+            pa.types.is_list(table.schema.field(column).type)
+            or pa.types.is_large_list(table.schema.field(column).type)
+        )
+    ]
+    data = table.select(
+        [column for column in table.column_names if column not in list_columns]
+    ).to_pandas()
+    for column in list_columns:
+        data[column] = _to_lists(table.column(column))
+
+    if ROW_COLUMN in data.columns:
+        data = data.sort_values(ROW_COLUMN, kind="stable").drop(columns=ROW_COLUMN)
+
+    # Restore the order of the columns of the stored data frame
+    stored_columns = [column["name"] for column in pandas_metadata.get("columns", [])]
+    order = [column for column in stored_columns if column in data.columns]
+    order += [column for column in data.columns if column not in order]
+    if columns is not None:
+        order = list(columns)
+    return data[order]
+
+
+def _partition_value(value) -> str:
+    if pd.isna(value):
+        return HIVE_NULL_PARTITION
+    return quote(str(value), safe="")
+
+
+def _remove_dataset(path: str):
+    """Remove a stored dataset, making sure that it does not contain other files"""
+    for root, _, files in os.walk(path):
+        for file in files:
+            if not file.endswith(".parquet"):
+                raise FileExistsError(
+                    f"{path} contains files that are not part of a Parquet dataset: {os.path.join(root, file)}"
+                )
+    shutil.rmtree(path)
+
+
+def save_utterances(
+    data: pd.DataFrame, path: str, partition_cols: list = None, append: bool = False
+):
+    """Store a data frame of utterances.
+
+    Args:
+        data: the utterances
+        path: Parquet dataset directory (a path ending in `.p` or `.csv` stores a pickle or CSV instead)
+        partition_cols: columns to partition the dataset by (default: the `PARTITION_COLUMNS` contained in data)
+        append: add the utterances to an existing dataset instead of replacing it
+    """
+    if not is_parquet(path):
+        if path.endswith(".csv"):
+            append = append and os.path.exists(path)
+            data.to_csv(path, index=False, mode="a" if append else "w", header=not append)
+        elif append:
+            raise ValueError("Appending is only supported for Parquet datasets and CSVs")
+        else:
+            data.to_pickle(path)
+        return
+
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    if partition_cols is None:
+        partition_cols = [column for column in PARTITION_COLUMNS if column in data.columns]
+
+    first_row = 0
+    if os.path.exists(path):
+        if append:
+            first_row = ds.dataset(path, format="parquet", partitioning="hive").count_rows()
+        else:
+            _remove_dataset(path)
+
+    table = pa.Table.from_pandas(data, preserve_index=True)
+    table = table.append_column(
+        ROW_COLUMN, pa.array(np.arange(first_row, first_row + len(data), dtype=np.int64))
+    )
+    partition_schema = pa.schema([table.schema.field(column) for column in partition_cols])
+    table = table.replace_schema_metadata(
+        {**table.schema.metadata, PARTITION_SCHEMA_KEY: partition_schema.serialize().to_pybytes()}
+    )
+
+    file_columns = [column for column in table.column_names if column not in partition_cols]
+
+    # Hive partitioning: one directory per value of each partition column (e.g. corpus=NewEngland/age=14/).
+    # (pyarrow.dataset.write_dataset is avoided, as it can make the interpreter abort on exit)
+    partitions = {(): np.arange(len(data))}
+    if partition_cols:
+        partitions = data.groupby(partition_cols, dropna=False, sort=False).indices
+    for values, rows in partitions.items():
+        if not isinstance(values, tuple):
+            values = (values,)
+        partition_dir = os.path.join(
+            path,
+            *[
+                f"{column}={_partition_value(value)}"
+                for column, value in zip(partition_cols, values)
+            ],
+        )
+        os.makedirs(partition_dir, exist_ok=True)
+        pq.write_table(
+            table.take(rows).select(file_columns),
+            os.path.join(partition_dir, f"part-{first_row}.parquet"),
+        )
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser(
+        description="Convert a pickled data frame or CSV of utterances to a Parquet dataset"
+    )
+    argparser.add_argument("input", type=str, help="pickled data frame (.p) or CSV")
+    argparser.add_argument("output", type=str, help="Parquet dataset (path ending in .parquet)")
+
+    args = argparser.parse_args()
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not is_parquet(args.output):
+        raise ValueError("The output path needs to end in .parquet")
+    data = load_utterances(args.input)
+    save_utterances(data, args.output)
+    print(f"Converted {len(data)} utterances to {args.output}")
@@ -0,0 +1,36 @@
+"""Hashes of data files and utterances, used to detect changes (e.g. by the feature cache and by preprocess.py).
+
+Only depends on pandas, so that it can be imported without the dependencies of the CRF."""
+
+import os
+import hashlib
+
+import pandas as pd
+
+
+def dataset_files(path: str) -> list:
+    """Files of a data file or of a dataset directory (e.g. Parquet), in a deterministic order"""
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(
+        os.path.join(root, file) for root, _, files in os.walk(path) for file in files
+    )
+
+
+def file_digest(path: str) -> str:
+    """Hash of the contents of a file (or of all files of a dataset directory)"""
+    digest = hashlib.sha256()
+    for file_path in dataset_files(path):
+        digest.update(os.path.relpath(file_path, path).encode())
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def rows_digest(data: pd.DataFrame) -> str:
+    """Hash identifying the utterances contained in the data (and their order)"""
+    row_hashes = pd.util.hash_pandas_object(
+        data[["transcript_file", "utterance_id"]], index=False
+    )
+    return hashlib.sha256(row_hashes.to_numpy().tobytes()).hexdigest()
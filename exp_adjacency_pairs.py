@@ -9,6 +9,7 @@ import dash_html_components as html
 from dash.dependencies import Input, Output
 import plotly.graph_objects as go
 
+from data_store import load_utterances
 from utils import SOURCE_SNOW, SOURCE_CRF, SPEECH_ACT, CHILD, ADULT, SPEECH_ACT_DESCRIPTIONS, \
     PATH_NEW_ENGLAND_UTTERANCES_ANNOTATED, PATH_NEW_ENGLAND_UTTERANCES
 
@@ -304,7 +305,7 @@ app.layout = html.Div(
 )
 def update_graph(dataset, source, target, age_months, percentage):
     # Load data
-    data = pd.read_pickle(ds_list[dataset])
+    data = load_utterances(ds_list[dataset])
     match_age = [14, 20, 32]
     data["age_months"] = data.age_months.apply(
         lambda age: min(match_age, key=lambda x: abs(x - age))
@@ -1,5 +1,3 @@
-import pickle
-
 import matplotlib.pyplot as plt
 
 import seaborn as sns
@@ -8,11 +6,12 @@ from scipy.stats import ttest_rel, ttest_ind, pearsonr
 
 from age_of_acquisition import MAX_AGE, calc_ages_of_acquisition, COMPREHENSION_SPEECH_ACTS_ENOUGH_DATA_2_OCCURRENCES
 from exp_reproduce_snow import AGE_OF_ACQUISITION_SPEECH_ACTS_ENOUGH_DATA
+from data_store import load_utterances
 from utils import TARGET_PRODUCTION, age_bin, AGES, SOURCE_SNOW, \
     TARGET_COMPREHENSION, PATH_NEW_ENGLAND_UTTERANCES
 
 if __name__ == "__main__":
-    data = pickle.load(open(PATH_NEW_ENGLAND_UTTERANCES, "rb"))
+    data = load_utterances(PATH_NEW_ENGLAND_UTTERANCES)
 
     # map ages to corresponding bins
     data["age_months"] = data["age_months"].apply(age_bin)
@@ -1,14 +1,13 @@
 from crf_annotate import calculate_frequencies
 import matplotlib.pyplot as plt
 
-import pandas as pd
-
+from data_store import load_utterances
 from utils import SPEECH_ACT, PATH_NEW_ENGLAND_UTTERANCES
 
 if __name__ == "__main__":
     print("Loading data...")
     # Calculate overall adult speech act frequencies
-    data = pd.read_pickle(PATH_NEW_ENGLAND_UTTERANCES)
+    data = load_utterances(PATH_NEW_ENGLAND_UTTERANCES, columns=[SPEECH_ACT])
 
     frequencies = calculate_frequencies(data[SPEECH_ACT])
     frequencies = dict(frequencies.most_common())
@@ -1,5 +1,3 @@
-import pickle
-
 import matplotlib.pyplot as plt
 
 import pandas as pd
@@ -9,6 +7,7 @@ from scipy.stats import spearmanr, entropy
 from scipy.spatial.distance import jensenshannon
 
 from age_of_acquisition import calc_ages_of_acquisition, COMPREHENSION_SPEECH_ACTS_ENOUGH_DATA_2_OCCURRENCES, MAX_AGE
+from data_store import load_utterances
 from utils import age_bin, calculate_frequencies, SOURCE_CRF, SOURCE_SNOW, TARGET_PRODUCTION, TARGET_COMPREHENSION, \
     AGES, load_whole_childes_data, SPEECH_ACT, CHILD, PATH_NEW_ENGLAND_UTTERANCES_ANNOTATED, AGES_LONG
 
@@ -465,7 +464,7 @@ def convert_to_ranks(ages_of_acquisition):
 
 if __name__ == "__main__":
     print("Loading data...")
-    data = pickle.load(open(PATH_NEW_ENGLAND_UTTERANCES_ANNOTATED, "rb"))
+    data = load_utterances(PATH_NEW_ENGLAND_UTTERANCES_ANNOTATED)
 
     # map ages to corresponding bins
     data["age_months"] = data["age_months"].apply(age_bin)
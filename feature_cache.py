@@ -0,0 +1,175 @@
+"""Content-addressed on-disk cache for feature columns and CRF feature sequences."""
+
+import os
+import hashlib
+import pickle
+import tempfile
+import zipfile
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+import pycrfsuite
+
+from digests import dataset_files, file_digest
+
+# Increase to invalidate all cache entries (e.g. when the computation of features changes)
+FEATURE_CACHE_VERSION = 1
+
+DEFAULT_MAX_SIZE = 10 * 1024 ** 3  # 10 GB
+
+# Errors raised when reading an entry that is corrupted (e.g. truncated by a full disk)
+CORRUPTED_ENTRY_ERRORS = (
+    EOFError,
+    KeyError,
+    ValueError,
+    OSError,
+    pickle.UnpicklingError,
+    zipfile.BadZipFile,
+)
+
+
+class FeatureCache:
+    """Cache of computed features, stored in files named after the hash of their key.
+
+    Keys are tuples that need to identify the input of the computation, e.g. ("crf_features", digest of the data file,
+    rows_digest(data), feature_vocabs.digest(), use_bi_grams, ...). When the total size of the cache exceeds max_size,
+    the least recently used entries are removed.
+    """
+
+    def __init__(self, cache_dir: str, max_size: int = DEFAULT_MAX_SIZE):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_size = max_size
+        self.file_digests = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def file_digest(self, path: str) -> str:
+        """Hash of the contents of a file, only recomputed if the file was modified"""
+        file_id = (os.path.abspath(path),) + tuple(
+            (file_path, stat.st_size, stat.st_mtime_ns)
+            for file_path, stat in ((f, os.stat(f)) for f in dataset_files(path))
+        )
+        if file_id not in self.file_digests:
+            self.file_digests[file_id] = file_digest(path)
+        return self.file_digests[file_id]
+
+    def path(self, key: tuple, extension: str) -> str:
+        digest = hashlib.sha256(repr((FEATURE_CACHE_VERSION,) + key).encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest + extension)
+
+    def data_frame(self, key: tuple, compute: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+        """Return the cached data frame for the key, or compute and cache it"""
+        path = self.path(key, ".p")
+        data = self.load(path, pd.read_pickle)
+        if data is None:
+            data = compute()
+            self.store(path, lambda f: data.to_pickle(f))
+        return data
+
+    def features(self, key: tuple, compute: Callable[[], list]) -> list:
+        """Return the cached CRF features for the key, or compute and cache them.
+
+        Features are returned flattened as by pycrfsuite (e.g. {"words:ball": 1.0, "speaker_code": 1.0, ...}), which
+        is equivalent for training and tagging.
+        """
+        path = self.path(key, ".npz")
+        features = self.load(path, load_features)
+        if features is None:
+            encoded = encode_features(pycrfsuite.ItemSequence(compute()).items())
+            self.store(path, lambda f: np.savez(f, **encoded))
+            # Not read back from the file, which other processes could already have evicted
+            features = decode_features(encoded)
+        return features
+
+    def load(self, path: str, read: Callable):
+        """Read a cache entry, returns None if it is missing (e.g. evicted by another process sharing the cache
+        directory) or can not be read (corrupted entries are removed)"""
+        try:
+            # Mark as recently used
+            os.utime(path)
+            return read(path)
+        except FileNotFoundError:
+            return None
+        except CORRUPTED_ENTRY_ERRORS:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+    def store(self, path: str, save: Callable):
+        # Write to a temporary file first, so that interrupted writes never leave corrupted entries
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                save(f)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict(keep=path)
+
+    def evict(self, keep: str = None):
+        """Remove least recently used entries until the cache is smaller than max_size, except the entry at `keep`
+        (e.g. the one that was just written, even if it is larger than max_size)"""
+        # Other processes sharing the cache directory can remove entries at any time: skip the ones that are gone
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_file() or entry.name.endswith(".tmp") or entry.path == keep:
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        total_size = sum(size for _, size, _ in entries)
+        if keep is not None:
+            try:
+                total_size += os.stat(keep).st_size
+            except FileNotFoundError:
+                pass
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            total_size -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def encode_features(items: list) -> dict:
+    """Columnar form of flattened features: attribute ids and values of all utterances, with offsets. Much smaller
+    than the dicts to store or to send to other processes."""
+    attribute_index = {}
+    attribute_ids = [
+        attribute_index.setdefault(attr, len(attribute_index))
+        for item in items
+        for attr in item
+    ]
+    return {
+        "attributes": np.array(list(attribute_index), dtype=str),
+        "attribute_ids": np.array(attribute_ids, dtype=np.int32),
+        "values": np.array([v for item in items for v in item.values()], dtype=float),
+        "offsets": np.cumsum([0] + [len(item) for item in items], dtype=np.int64),
+    }
+
+
+def decode_features(encoded) -> list:
+    """Flattened features from their columnar form (see `encode_features`)"""
+    attributes = encoded["attributes"].tolist()
+    attribute_ids = encoded["attribute_ids"].tolist()
+    values = encoded["values"].tolist()
+    offsets = encoded["offsets"].tolist()
+
+    names = [attributes[i] for i in attribute_ids]
+    return [
+        dict(zip(names[start:end], values[start:end]))
+        for start, end in zip(offsets[:-1], offsets[1:])
+    ]
+
+
+def load_features(path: str) -> list:
+    with np.load(path) as stored:
+        return decode_features(stored)
@@ -12,7 +12,7 @@ import seaborn as sns
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 
-from nn_dataset import SpeechActsTestDataset
+from nn_dataset import BucketBatchSampler, SpeechActsTestDataset, collate_test_transcripts
 from nn_models import preprend_speaker_token
 from utils import PADDING, SPEAKER_CHILD
 
@@ -53,9 +53,16 @@ def annotate(args):
 
     dataset_loader = DataLoader(
         dataset,
-        batch_size=args.batch_size,
-        shuffle=False,
-        num_workers=0,
+        batch_sampler=BucketBatchSampler(
+            dataset,
+            args.max_tokens,
+            args.batch_size,
+            shuffle=False,
+            seed=args.seed,
+        ),
+        num_workers=args.num_workers,
+        pin_memory=device.type == "cuda",
+        collate_fn=collate_test_transcripts,
     )
 
     print("Data samples: ", len(dataset))
@@ -66,23 +73,30 @@ def annotate(args):
         all_predicted_labels = []
         speaker_is_child = []
         with torch.no_grad():
-            for batch_id, (input_samples, sequence_lengths) in tqdm(
+            for batch_id, (utterances, utterance_lengths, sequence_lengths) in tqdm(
                 enumerate(data_loader), total=len(data_loader)
             ):
 
                 # Perform forward pass of the model
-                predicted_labels = model.forward_decode(input_samples)
-                predicted_labels = torch.tensor(predicted_labels).to(device)
-
-                speaker_is_child += [
-                    True if x[0] == vocab.stoi[SPEAKER_CHILD] else False
-                    for x in input_samples
+                utterances = utterances.to(device, non_blocking=True)
+                predicted_labels = model.forward_decode(
+                    utterances, utterance_lengths, sequence_lengths
+                )
+                predicted_labels = [
+                    label for labels in predicted_labels for label in labels
                 ]
-                all_predicted_labels += predicted_labels.tolist()
+
+                # The first token of each utterance is the speaker token
+                speaker_is_child += (utterances[0] == vocab.stoi[SPEAKER_CHILD]).tolist()
+                all_predicted_labels += predicted_labels
 
                 if args.verbose:
+                    samples = [
+                        utterances[:length, i]
+                        for i, length in enumerate(utterance_lengths.tolist())
+                    ]
                     for i, (sample, predicted) in enumerate(
-                        zip(input_samples, predicted_labels)
+                        zip(samples, predicted_labels)
                     ):
                         print(
                             f"{get_words(sample, vocab)} Predicted: {label_vocab.inverse[int(predicted)]}"
@@ -152,9 +166,24 @@ if __name__ == "__main__":
     parser.add_argument(
         "--compare", type=str, required=True, help="Path to frequencies to compare to"
     )
-    # TODO fix: works only with batch size 1 at the moment
     parser.add_argument(
-        "--batch-size", type=int, default=1, metavar="N", help="batch size"
+        "--batch-size",
+        type=int,
+        default=32,
+        metavar="N",
+        help="maximum number of transcripts per batch",
+    )
+    parser.add_argument(
+        "--max-tokens",
+        type=int,
+        default=20000,
+        help="maximum number of (padded) tokens per batch, batches contain transcripts of similar lengths",
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=2,
+        help="number of processes preparing the batches (0 to prepare them in the main process)",
     )
     parser.add_argument("--seed", type=int, default=1111, help="random seed")
 
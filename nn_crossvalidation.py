@@ -6,16 +6,21 @@ import pickle
 
 import numpy as np
 
-import pandas as pd
-
 import torch
 from sklearn.model_selection import train_test_split, KFold
 from torch import nn, optim
 from torch.utils.data import DataLoader
 
-from nn_dataset import SpeechActsDataset
+from nn_dataset import BucketBatchSampler, SpeechActsDataset, collate_transcripts, unpad
 from nn_models import SpeechActLSTM, SpeechActBERTLSTM, build_vocabulary
-from nn_train import prepare_data
+from nn_train import (
+    LR_SCALINGS,
+    backward_windows,
+    check_window_args,
+    learning_rate,
+    prepare_data,
+)
+from data_store import load_utterances
 from utils import (
     dataset_labels,
     TRAIN_TEST_SPLIT_RANDOM_STATE,
@@ -34,7 +39,7 @@ def train(args):
     print("Device: ", device)
 
     # Load data
-    data = pd.read_pickle(args.data)
+    data = load_utterances(args.data)
 
     # Split data
     kf = KFold(n_splits=args.num_splits, random_state=TRAIN_TEST_SPLIT_RANDOM_STATE)
@@ -78,21 +83,42 @@ def train(args):
 
         train_loader = DataLoader(
             dataset_train,
-            batch_size=args.batch_size,
-            shuffle=True,
-            num_workers=0,
+            batch_sampler=BucketBatchSampler(
+                dataset_train,
+                args.max_tokens,
+                args.batch_size,
+                shuffle=True,
+                seed=args.seed,
+            ),
+            num_workers=args.num_workers,
+            pin_memory=device.type == "cuda",
+            collate_fn=collate_transcripts,
         )
         valid_loader = DataLoader(
             dataset_val,
-            batch_size=args.batch_size,
-            shuffle=True,
-            num_workers=0,
+            batch_sampler=BucketBatchSampler(
+                dataset_val,
+                args.max_tokens,
+                args.batch_size,
+                shuffle=False,
+                seed=args.seed,
+            ),
+            num_workers=args.num_workers,
+            pin_memory=device.type == "cuda",
+            collate_fn=collate_transcripts,
         )
         test_loader = DataLoader(
             dataset_test,
-            batch_size=args.batch_size,
-            shuffle=True,
-            num_workers=0,
+            batch_sampler=BucketBatchSampler(
+                dataset_test,
+                args.max_tokens,
+                args.batch_size,
+                shuffle=False,
+                seed=args.seed,
+            ),
+            num_workers=args.num_workers,
+            pin_memory=device.type == "cuda",
+            collate_fn=collate_transcripts,
         )
         print("Loaded data.")
 
@@ -120,27 +146,41 @@ def train(args):
 
         model.to(device)
 
-        optimizer = optim.Adam(model.parameters(), lr=args.lr)
+        optimizer = optim.Adam(model.parameters(), lr=learning_rate(args))
 
         def train_epoch(data_loader, epoch):
             model.train()
             total_loss = 0.0
 
-            for batch_id, (input_samples, targets, sequence_lengths, ages) in enumerate(
-                data_loader
-            ):
+            for batch_id, (
+                utterances,
+                utterance_lengths,
+                targets,
+                sequence_lengths,
+                ages,
+            ) in enumerate(data_loader):
                 # Move data to GPU
-                targets = torch.tensor(targets).to(device)
+                utterances = utterances.to(device, non_blocking=True)
+                targets = targets.to(device, non_blocking=True)
 
                 # Clear gradients
                 optimizer.zero_grad()
 
-                # Perform forward pass of the model
-                loss = model(input_samples, targets)
+                # Perform forward and backward pass of the model
+                if args.window_size:
+                    loss = backward_windows(
+                        model,
+                        (utterances, utterance_lengths, targets, sequence_lengths),
+                        args.window_size,
+                        args.window_overlap,
+                    )
+                else:
+                    loss = model(utterances, utterance_lengths, sequence_lengths, targets)
+                    loss.backward()
+                    loss = loss.item()
 
                 # Calculate loss
-                total_loss += loss.item()
-                loss.backward()
+                total_loss += loss
 
                 # Clip gradients
                 torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
@@ -149,7 +189,7 @@ def train(args):
                 optimizer.step()
 
                 if batch_id % args.log_interval == 0 and batch_id != 0:
-                    cur_loss = total_loss / (args.log_interval * args.batch_size)
+                    cur_loss = total_loss / args.log_interval
                     current_learning_rate = optimizer.param_groups[0]["lr"]
                     print(
                         "| epoch {:3d} | {:5d}/{:5d} batches | lr {:02.6f} | loss {:5.5f}".format(
@@ -173,21 +213,27 @@ def train(args):
             num_correct = 0
             with torch.no_grad():
                 for batch_id, (
-                    input_samples,
+                    utterances,
+                    utterance_lengths,
                     targets,
                     sequence_lengths,
                     ages,
                 ) in enumerate(data_loader):
                     # Move data to GPU
-                    targets = torch.tensor(targets).to(device)
+                    utterances = utterances.to(device, non_blocking=True)
+                    targets = unpad(targets, sequence_lengths).to(device)
 
                     # Perform forward pass of the model
-                    predicted_labels = model.forward_decode(input_samples)
-                    predicted_labels = torch.tensor(predicted_labels).to(device)
+                    predicted_labels = model.forward_decode(
+                        utterances, utterance_lengths, sequence_lengths
+                    )
+                    predicted_labels = torch.tensor(
+                        [label for labels in predicted_labels for label in labels]
+                    ).to(device)
 
                     # Compare predicted labels to ground truth
                     num_correct += int(torch.sum(predicted_labels == targets))
-                    num_samples += len(input_samples)
+                    num_samples += len(targets)
 
             return total_loss / num_samples, num_correct / num_samples
 
@@ -204,6 +250,12 @@ def train(args):
                         epoch, val_loss, val_accuracy
                     )
                 )
+                efficiency = train_loader.batch_sampler.efficiency
+                print(
+                    "| padding efficiency | tokens {:5.2f} | utterances {:5.2f}".format(
+                        efficiency["tokens"], efficiency["utterances"]
+                    )
+                )
                 print("-" * 89)
                 # Save the model if the validation loss is the best we've seen so far.
                 if not best_val_acc or val_accuracy > best_val_acc:
@@ -295,12 +347,42 @@ if __name__ == "__main__":
     parser.add_argument(
         "--lr", type=float, default=0.0001, help="initial learning rate"
     )
+    parser.add_argument(
+        "--lr-scaling",
+        choices=LR_SCALINGS,
+        default="none",
+        help="scaling of the learning rate with the number of transcripts per update (--lr is the learning rate for "
+        "a single transcript)",
+    )
     parser.add_argument("--clip", type=float, default=0.25, help="gradient clipping")
     parser.add_argument("--epochs", type=int, default=50, help="upper epoch limit")
 
-    # TODO fix: works only with batch size one at the moment (equalling 1 transcript)
     parser.add_argument(
-        "--batch-size", type=int, default=1, metavar="N", help="batch size"
+        "--batch-size",
+        type=int,
+        default=32,
+        metavar="N",
+        help="maximum number of transcripts per batch",
+    )
+    parser.add_argument(
+        "--max-tokens",
+        type=int,
+        default=20000,
+        help="maximum number of (padded) tokens per batch, batches contain transcripts of similar lengths",
+    )
+    parser.add_argument(
+        "--window-size",
+        type=int,
+        default=None,
+        help="train on windows of this number of utterances of the transcripts, carrying the state of the "
+        "utterance-level LSTM over from one window to the next (default: whole transcripts)",
+    )
+    parser.add_argument(
+        "--window-overlap",
+        type=int,
+        default=0,
+        help="number of utterances shared by consecutive windows (with --window-size, smaller than the size of the "
+        "windows)",
     )
     parser.add_argument(
         "--dropout",
@@ -308,6 +390,12 @@ if __name__ == "__main__":
         default=0.2,
         help="dropout applied to layers (0 = no dropout)",
     )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=2,
+        help="number of processes preparing the batches (0 to prepare them in the main process)",
+    )
     parser.add_argument("--seed", type=int, default=1111, help="random seed")
     parser.add_argument(
         "--log-interval", type=int, default=30, metavar="N", help="report interval"
@@ -318,4 +406,5 @@ if __name__ == "__main__":
     )
 
     args = parser.parse_args()
+    check_window_args(parser, args)
     train(args)
@@ -1,18 +1,76 @@
-from torch.utils.data import Dataset
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler
+
+# Index of the padding token in the vocabularies (first special token, see nn_models.build_vocabulary)
+PADDING_INDEX = 0
 
 
 class SpeechActsDataset(Dataset):
+    """Transcripts of a data frame grouped by transcript (see nn_train.prepare_data), encoded once as flat tensors.
+
+    The tokens of all utterances are stored in a single int64 tensor, with the offsets of the utterances in
+    `utterance_offsets` and the offsets of the transcripts (in utterances) in `transcript_offsets`. Items are views
+    of these tensors.
+    """
+
     def __init__(self, dataframe):
         self.len = len(dataframe)
-        self.data = dataframe
+
+        utterance_lengths = [
+            len(utterance)
+            for transcript in dataframe.utterances
+            for utterance in transcript
+        ]
+        sequence_lengths = [len(transcript) for transcript in dataframe.utterances]
+        self.tokens = torch.from_numpy(
+            np.fromiter(
+                (
+                    token
+                    for transcript in dataframe.utterances
+                    for utterance in transcript
+                    for token in utterance
+                ),
+                dtype=np.int64,
+                count=sum(utterance_lengths),
+            )
+        )
+        self.utterance_lengths = torch.tensor(utterance_lengths, dtype=torch.int64)
+        self.utterance_offsets = torch.from_numpy(
+            np.concatenate([[0], np.cumsum(utterance_lengths, dtype=np.int64)])
+        )
+        self.transcript_offsets = torch.from_numpy(
+            np.concatenate([[0], np.cumsum(sequence_lengths, dtype=np.int64)])
+        )
+
+        if "labels" in dataframe.columns:
+            self.labels = torch.tensor(
+                [label for labels in dataframe.labels for label in labels],
+                dtype=torch.int64,
+            )
+        if "age_months" in dataframe.columns:
+            self.ages = dataframe.age_months.tolist()
+        else:
+            self.ages = [None] * self.len
+
+    def transcript(self, index):
+        """Tokens of the utterances of the transcript, and the length of each utterance"""
+        first_utterance = self.transcript_offsets[index]
+        end_utterance = self.transcript_offsets[index + 1]
+        tokens = self.tokens[
+            self.utterance_offsets[first_utterance] : self.utterance_offsets[
+                end_utterance
+            ]
+        ]
+        return tokens, self.utterance_lengths[first_utterance:end_utterance]
 
     def __getitem__(self, index):
-        utterances = self.data.utterances[index]
-        labels = self.data.labels[index]
-        sequence_length = len(utterances)
-        age = self.data.age_months[index]
+        tokens, utterance_lengths = self.transcript(index)
+        labels = self.labels[
+            self.transcript_offsets[index] : self.transcript_offsets[index + 1]
+        ]
 
-        return utterances, labels, sequence_length, age
+        return tokens, utterance_lengths, labels, self.ages[index]
 
     def __len__(self):
         return self.len
@@ -20,7 +78,221 @@ class SpeechActsDataset(Dataset):
 
 class SpeechActsTestDataset(SpeechActsDataset):
     def __getitem__(self, index):
-        utterances = self.data.utterances.iloc[index]
-        sequence_length = len(utterances)
+        return self.transcript(index)
+
+
+class BucketBatchSampler(Sampler):
+    """Batches of transcripts of similar lengths, with a budget of padded tokens per batch.
+
+    Transcripts are sorted by number of utterances (then by length of their longest utterance) and split into buckets
+    of `bucket_size` transcripts (by default twice the maximum batch size, so that shuffling within buckets keeps
+    transcripts of similar lengths together). Batches are filled with the transcripts of a bucket as long as the
+    padded utterances tensor of the batch (longest utterance x number of utterances, see `collate_transcripts`) stays
+    within `max_tokens` (a transcript that exceeds it on its own forms a batch). For training (`shuffle`), transcripts
+    are shuffled within their bucket and batches are shuffled, with a different order in each epoch; otherwise the
+    batches are always the same, from the shortest to the longest transcripts.
+    """
+
+    def __init__(
+        self,
+        dataset: SpeechActsDataset,
+        max_tokens: int,
+        max_batch_size: int = None,
+        shuffle: bool = False,
+        bucket_size: int = None,
+        seed: int = None,
+    ):
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        if bucket_size is None:
+            bucket_size = 2 * max_batch_size if max_batch_size else 100
+        self.bucket_size = bucket_size
+        self.random = np.random.RandomState(seed)
+
+        transcript_offsets = dataset.transcript_offsets.numpy()
+        utterance_lengths = dataset.utterance_lengths.numpy()
+        self.sequence_lengths = np.diff(transcript_offsets)
+        self.max_utterance_lengths = np.maximum.reduceat(
+            utterance_lengths, transcript_offsets[:-1]
+        )
+        self.nb_tokens = np.diff(dataset.utterance_offsets.numpy()[transcript_offsets])
+
+        self.sorted_indices = np.lexsort(
+            (self.max_utterance_lengths, self.sequence_lengths)
+        )
+        self.batches = self.make_batches()
+        self.efficiency = None
+        self.iterated = False
+
+    def make_batches(self):
+        batches = []
+        for start in range(0, len(self.sorted_indices), self.bucket_size):
+            bucket = self.sorted_indices[start : start + self.bucket_size]
+            if self.shuffle:
+                bucket = self.random.permutation(bucket)
+
+            batch = []
+            max_utterance_length = nb_utterances = 0
+            for index in bucket.tolist():
+                padded_tokens = max(
+                    max_utterance_length, self.max_utterance_lengths[index]
+                ) * (nb_utterances + self.sequence_lengths[index])
+                if batch and (
+                    padded_tokens > self.max_tokens
+                    or len(batch) == self.max_batch_size
+                ):
+                    batches.append(batch)
+                    batch = []
+                    max_utterance_length = nb_utterances = 0
+                batch.append(index)
+                max_utterance_length = max(
+                    max_utterance_length, self.max_utterance_lengths[index]
+                )
+                nb_utterances += self.sequence_lengths[index]
+            if batch:
+                batches.append(batch)
+
+        if self.shuffle:
+            self.random.shuffle(batches)
+        return batches
+
+    def padding_efficiency(self, batches):
+        """Ratio of tokens and utterances in the padded tensors of the batches that are not padding"""
+        nb_tokens = nb_padded_tokens = nb_utterances = nb_padded_utterances = 0
+        for batch in batches:
+            sequence_lengths = self.sequence_lengths[batch]
+            nb_tokens += self.nb_tokens[batch].sum()
+            nb_padded_tokens += (
+                self.max_utterance_lengths[batch].max() * sequence_lengths.sum()
+            )
+            nb_utterances += sequence_lengths.sum()
+            nb_padded_utterances += sequence_lengths.max() * len(batch)
+        return {
+            "tokens": float(nb_tokens / nb_padded_tokens),
+            "utterances": float(nb_utterances / nb_padded_utterances),
+        }
+
+    def __iter__(self):
+        if self.shuffle and self.iterated:
+            # New batches for each epoch after the first, made when the epoch starts, so that len() is the number of
+            # batches of the epoch being iterated
+            self.batches = self.make_batches()
+        self.iterated = True
+        self.efficiency = self.padding_efficiency(self.batches)
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def pad_flat(values, lengths, max_length=None):
+    """Pad the sequences of a flat tensor (concatenated sequences of the given lengths) to shape
+    (max length, nb sequences), allocating the padded tensor once"""
+    if max_length is None:
+        max_length = int(lengths.max())
+    padded = values.new_full((max_length, len(lengths)) + values.shape[1:], PADDING_INDEX)
+
+    # Position of each value within its sequence
+    sequence_starts = torch.cumsum(lengths, 0) - lengths
+    columns = torch.repeat_interleave(torch.arange(len(lengths)), lengths)
+    rows = torch.arange(len(values)) - torch.repeat_interleave(sequence_starts, lengths)
+    padded[rows, columns] = values
+    return padded
+
+
+def sort_transcripts(batch):
+    """Batch items sorted by number of utterances, longest first"""
+    return sorted(batch, key=lambda item: len(item[1]), reverse=True)
+
+
+def collate_transcripts(batch):
+    """Collate a batch of transcripts of SpeechActsDataset, sorted by number of utterances (longest first).
+
+    Returns:
+        utterances: token indices of all utterances of the batch, of shape (max utterance length, nb utterances)
+        utterance_lengths: number of tokens of each utterance
+        targets: labels, padded to (max transcript length, batch size)
+        sequence_lengths: number of utterances of each transcript
+        ages: age of the child of each transcript
+    """
+    tokens, utterance_lengths, labels, ages = zip(*sort_transcripts(batch))
+    sequence_lengths = torch.tensor([len(l) for l in labels], dtype=torch.int64)
+    utterance_lengths = torch.cat(utterance_lengths)
+    return (
+        pad_flat(torch.cat(tokens), utterance_lengths),
+        utterance_lengths,
+        pad_flat(torch.cat(labels), sequence_lengths),
+        sequence_lengths,
+        list(ages),
+    )
+
+
+def collate_test_transcripts(batch):
+    """Collate a batch of transcripts of SpeechActsTestDataset (see `collate_transcripts`, without targets and ages)"""
+    tokens, utterance_lengths = zip(*sort_transcripts(batch))
+    sequence_lengths = torch.tensor([len(l) for l in utterance_lengths], dtype=torch.int64)
+    utterance_lengths = torch.cat(utterance_lengths)
+    return (
+        pad_flat(torch.cat(tokens), utterance_lengths),
+        utterance_lengths,
+        sequence_lengths,
+    )
+
+
+def unpad(padded, sequence_lengths):
+    """Concatenate the sequences of a padded tensor of shape (max length, batch size, ...)"""
+    return torch.cat(
+        [padded[:length, i] for i, length in enumerate(sequence_lengths.tolist())]
+    )
+
+
+def transcript_windows(
+    utterances,
+    utterance_lengths,
+    targets,
+    sequence_lengths,
+    window_size,
+    overlap=0,
+):
+    """Split a batch of transcripts (see `collate_transcripts`) into windows of `window_size` utterances, starting
+    every `window_size - overlap` utterances.
+
+    Each window contains the transcripts that have utterances in it, which are the first ones of the batch, as
+    transcripts are sorted by length.
+
+    Yields:
+        utterances, utterance_lengths, targets and sequence_lengths of the window, as in `collate_transcripts`
+    """
+    if not 0 <= overlap < window_size:
+        raise ValueError(
+            f"Overlap of windows must be smaller than their size: {overlap}, {window_size}"
+        )
+    stride = window_size - overlap
+    first_utterances = torch.cumsum(sequence_lengths, 0) - sequence_lengths
+    max_sequence_length = int(sequence_lengths.max())
+
+    start = 0
+    while True:
+        window_lengths = (sequence_lengths - start).clamp(0, window_size)
+        window_lengths = window_lengths[window_lengths > 0]
+        columns = torch.cat(
+            [
+                torch.arange(first, first + length)
+                for first, length in zip(
+                    (first_utterances[: len(window_lengths)] + start).tolist(),
+                    window_lengths.tolist(),
+                )
+            ]
+        )
+        window_utterance_lengths = utterance_lengths[columns]
+        yield (
+            utterances[: int(window_utterance_lengths.max()), columns.to(utterances.device)],
+            window_utterance_lengths,
+            targets[start : start + int(window_lengths[0]), : len(window_lengths)],
+            window_lengths,
+        )
 
-        return utterances, sequence_length
+        if start + window_size >= max_sequence_length:
+            break
+        start += stride
@@ -4,11 +4,12 @@ import torch
 import torch.nn as nn
 from torch import cuda
 from torch.nn.modules.rnn import LSTM
-from torch.nn.utils.rnn import pack_padded_sequence, pad_sequence
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence, pad_sequence
 from torchcrf import CRF
 from torchtext import vocab
 from transformers import DistilBertModel
 
+from nn_dataset import unpad
 from utils import PADDING, SPEAKER_CHILD, SPEAKER_ADULT, UNKNOWN
 
 device = "cuda" if cuda.is_available() else "cpu"
@@ -46,7 +47,155 @@ def preprend_speaker_token(tokens, speaker):
 
 
 
-class SpeechActLSTM(nn.Module):
+def sequence_mask(sequence_lengths, max_length):
+    """Mask of the elements of a padded batch, of shape (max length, batch size)"""
+    positions = torch.arange(max_length, device=sequence_lengths.device)
+    return positions.unsqueeze(1) < sequence_lengths.unsqueeze(0)
+
+
+def group_utterances(utterance_representations, sequence_lengths):
+    """Pad the representations of the utterances of all transcripts to (max transcript length, batch size, ...)"""
+    return pad_sequence(
+        torch.split(utterance_representations, sequence_lengths.tolist())
+    )
+
+
+def run_lstm(lstm, inputs, sequence_lengths, hidden, carry_length=None):
+    """Run an LSTM over padded inputs of shape (max length, batch size, ...).
+
+    Returns:
+        outputs: padded outputs of the LSTM
+        hidden: hidden state of the LSTM after the first `carry_length` elements of each sequence (after all elements
+        if None), to be carried over to the next window of the sequences (see `SpeechActCRFModel.forward_window`)
+    """
+    total_length = inputs.size(0)
+    if carry_length is None or carry_length >= total_length:
+        packed_inputs = pack_padded_sequence(
+            inputs, sequence_lengths.cpu(), enforce_sorted=False
+        )
+        outputs, hidden = lstm(packed_inputs, hidden)
+        outputs, _ = pad_packed_sequence(outputs, total_length=total_length)
+        return outputs, hidden
+
+    outputs, carried_hidden = run_lstm(
+        lstm, inputs[:carry_length], sequence_lengths.clamp(max=carry_length), hidden
+    )
+
+    # Continue with the sequences that are longer than carry_length
+    outputs_rest = outputs.new_zeros(
+        (total_length - carry_length,) + outputs.shape[1:]
+    )
+    remaining_lengths = sequence_lengths - carry_length
+    remaining = torch.nonzero(remaining_lengths > 0).squeeze(1)
+    if len(remaining) > 0:
+        remaining = remaining.to(inputs.device)
+        outputs_rest[:, remaining], _ = run_lstm(
+            lstm,
+            inputs[carry_length:, remaining],
+            remaining_lengths[remaining.cpu()],
+            tuple(h[:, remaining] for h in carried_hidden),
+        )
+
+    return torch.cat([outputs, outputs_rest]), carried_hidden
+
+
+class SpeechActCRFModel(nn.Module):
+    """Utterance-level LSTM and CRF over the representations of the utterances of transcripts.
+
+    Subclasses define `lstm_utterance`, `decoder`, `crf` and `n_hidden_units_utterance_lstm`, and compute the
+    representations of the utterances with `utterance_representations(utterances, utterance_lengths)`, which takes the
+    padded utterances of a batch (see nn_dataset.collate_transcripts) and returns a tensor of shape
+    (nb utterances, ...).
+    """
+
+    def forward_nn(
+        self,
+        utterances,
+        utterance_lengths,
+        sequence_lengths,
+        hidden=None,
+        carry_length=None,
+    ):
+        """Emission scores of the utterances of a batch of transcripts, of shape
+        (max transcript length, batch size, nb labels), and the hidden state of the utterance-level LSTM (see
+        `run_lstm`)"""
+        utterance_representations = group_utterances(
+            self.utterance_representations(utterances, utterance_lengths),
+            sequence_lengths,
+        )
+        if hidden is None:
+            hidden = self.init_hidden(
+                1, len(sequence_lengths), self.n_hidden_units_utterance_lstm
+            )
+        output_utterance_level, hidden = run_lstm(
+            self.lstm_utterance,
+            utterance_representations,
+            sequence_lengths,
+            hidden,
+            carry_length,
+        )
+
+        return self.decoder(output_utterance_level), hidden
+
+    def crf_loss(self, outputs, targets, sequence_lengths):
+        # The CRF sums scores over whole sequences: keep it in float32 with bfloat16 autocast
+        outputs = outputs.float()
+        mask = sequence_mask(sequence_lengths.to(outputs.device), outputs.size(0))
+
+        log_likelihood = self.crf.forward(
+            outputs, targets, mask=mask, reduction="token_mean"
+        )
+
+        return -log_likelihood
+
+    def forward(self, utterances, utterance_lengths, sequence_lengths, targets):
+        outputs, _ = self.forward_nn(utterances, utterance_lengths, sequence_lengths)
+
+        return self.crf_loss(outputs, targets, sequence_lengths)
+
+    def forward_window(
+        self,
+        utterances,
+        utterance_lengths,
+        sequence_lengths,
+        targets,
+        hidden=None,
+        carry_length=None,
+    ):
+        """Loss on a window of the transcripts (see nn_dataset.transcript_windows), starting from the hidden state of
+        the utterance-level LSTM carried over from the previous window.
+
+        Returns:
+            loss: CRF loss of the window
+            hidden: hidden state of the utterance-level LSTM after `carry_length` utterances of the window, to start
+            the next window from (detached, so that gradients do not flow back to the previous windows)
+        """
+        if hidden is not None:
+            # Transcripts are sorted by length: the ones that are left are the first ones of the previous window
+            hidden = tuple(h[:, : len(sequence_lengths)] for h in hidden)
+        outputs, hidden = self.forward_nn(
+            utterances, utterance_lengths, sequence_lengths, hidden, carry_length
+        )
+        loss = self.crf_loss(outputs, targets, sequence_lengths)
+
+        return loss, tuple(h.detach() for h in hidden)
+
+    def forward_decode(self, utterances, utterance_lengths, sequence_lengths):
+        """Most likely labels of the utterances of each transcript of the batch"""
+        outputs, _ = self.forward_nn(utterances, utterance_lengths, sequence_lengths)
+        mask = sequence_mask(sequence_lengths.to(outputs.device), outputs.size(0))
+
+        return self.crf.decode(outputs.float(), mask=mask)
+
+    def init_hidden(self, n_layers, batch_size, n_hidden_units):
+        parameters_input = next(self.parameters())
+        return (
+            parameters_input.new_zeros(n_layers, batch_size, n_hidden_units),
+            parameters_input.new_zeros(n_layers, batch_size, n_hidden_units),
+        )
+
+
+class SpeechActLSTM(SpeechActCRFModel):
     def __init__(
         self,
         vocab_size,
@@ -80,89 +229,19 @@ class SpeechActLSTM(nn.Module):
         self.n_hidden_units_words_lstm = n_hidden_units_words_lstm
         self.n_layers_words_lstm = n_layers_words_lstm
 
-    def forward(self, input, targets):
-        sequence_lengths = [len(i) for i in input]
-        padded_inputs = pad_sequence([torch.LongTensor(i).to(device) for i in input])
-
-        emb = self.embeddings(padded_inputs)
-        batch_size = emb.size(1)
-        hidden = self.init_hidden(
-            self.n_layers_words_lstm, batch_size, self.n_hidden_units_words_lstm
-        )
-
-        packed_emb = pack_padded_sequence(emb, sequence_lengths, enforce_sorted=False)
-        output, hidden = self.lstm_words(packed_emb, hidden)
-        output, _ = nn.utils.rnn.pad_packed_sequence(output)
-
-        # Take last output for each sample (which depends on the sequence length)
-        indices = [s - 1 for s in sequence_lengths]
-        utterance_representations = output[indices, range(batch_size)]
-
-        hidden_utterance_lstm = self.init_hidden(
-            1, 1, self.n_hidden_units_utterance_lstm
-        )
-
-        utterance_representations = utterance_representations.unsqueeze(
-            1
-        )  # add batch size dimension
-        output_utterance_level, hidden_utterance_lstm = self.lstm_utterance(
-            utterance_representations, hidden_utterance_lstm
-        )
-
-        outputs = self.decoder(output_utterance_level.squeeze(1))
-
-        decoded = outputs.unsqueeze(1)
-        targets = targets.unsqueeze(1)
-
-        log_likelihood = self.crf.forward(decoded, targets, reduction="token_mean")
-
-        loss = -log_likelihood
-
-        return loss
-
-    def forward_decode(self, input):
-        sequence_lengths = [len(i) for i in input]
-        padded_inputs = pad_sequence([torch.LongTensor(i).to(device) for i in input])
-
-        emb = self.embeddings(padded_inputs)
-        batch_size = emb.size(1)
+    def utterance_representations(self, utterances, utterance_lengths):
+        # Word level: all utterances of the batch at once
+        emb = self.embeddings(utterances)
         hidden = self.init_hidden(
-            self.n_layers_words_lstm, batch_size, self.n_hidden_units_words_lstm
-        )
-
-        packed_emb = pack_padded_sequence(emb, sequence_lengths, enforce_sorted=False)
-        output, hidden = self.lstm_words(packed_emb, hidden)
-        output, _ = nn.utils.rnn.pad_packed_sequence(output)
-
-        # Take last output for each sample (which depends on the sequence length)
-        indices = [s - 1 for s in sequence_lengths]
-        utterance_representations = output[indices, range(batch_size)]
-
-        hidden_utterance_lstm = self.init_hidden(
-            1, 1, self.n_hidden_units_utterance_lstm
+            self.n_layers_words_lstm, emb.size(1), self.n_hidden_units_words_lstm
         )
-
-        utterance_representations = utterance_representations.unsqueeze(
-            1
-        )  # add batch size dimension
-        output_utterance_level, hidden_utterance_lstm = self.lstm_utterance(
-            utterance_representations, hidden_utterance_lstm
+        packed_emb = pack_padded_sequence(
+            emb, utterance_lengths.cpu(), enforce_sorted=False
         )
+        _, (last_hidden, _) = self.lstm_words(packed_emb, hidden)
 
-        outputs = self.decoder(output_utterance_level.squeeze(1))
-
-        decoded = outputs.unsqueeze(1)
-
-        labels = self.crf.decode(decoded)
-
-        return labels[0]
-
-    def init_hidden(self, n_layers, batch_size, n_hidden_units):
-        parameters_input = next(self.parameters())
-        return (
-            parameters_input.new_zeros(n_layers, batch_size, n_hidden_units),
-            parameters_input.new_zeros(n_layers, batch_size, n_hidden_units),
-        )
+        # Last output for each utterance (which depends on the utterance length)
+        return last_hidden[-1]
 
 
 class SpeechActDistilBERT(torch.nn.Module):
@@ -182,20 +261,13 @@ class SpeechActDistilBERT(torch.nn.Module):
             for param in self.bert.parameters():
                 param.requires_grad = False
 
-    def gen_attention_masks(self, sequence_lengths, max_len):
-        return torch.tensor(
-            [int(s) * [1] + (max_len - int(s)) * [0] for s in sequence_lengths]
-        ).to(device)
-
-    def forward(self, input, targets):
-        # The input should be padded, so all samples should have the same length
-        sequence_lengths = [len(i) for i in input]
-        padded_inputs = pad_sequence(
-            [torch.LongTensor(i).to(device) for i in input], batch_first=True
-        )
-
-        max_len = max(sequence_lengths)
-        attention_masks = self.gen_attention_masks(sequence_lengths, max_len)
+    def forward_nn(self, utterances, utterance_lengths):
+        """Logits of all utterances of the batch"""
+        # BERT expects the batch dimension first
+        padded_inputs = utterances.t()
+        attention_masks = sequence_mask(
+            utterance_lengths.to(padded_inputs.device), padded_inputs.size(1)
+        ).t().long()
         output = self.bert(input_ids=padded_inputs, attention_mask=attention_masks)
         hidden_state = output.last_hidden_state
         pooler = hidden_state[:, 0]
@@ -205,34 +277,25 @@ class SpeechActDistilBERT(torch.nn.Module):
         out = self.dropout(pooler)
 
         out = self.classifier(out)
+        return out
 
-        loss = self.criterion(out, targets)
-        return loss
-
-    def forward_decode(self, input):
-        # The input should be padded, so all samples should have the same length
-        sequence_lengths = [len(i) for i in input]
-        padded_inputs = pad_sequence(
-            [torch.LongTensor(i).to(device) for i in input], batch_first=True
-        )
-
-        max_len = max(sequence_lengths)
-        attention_masks = self.gen_attention_masks(sequence_lengths, max_len)
-        output = self.bert(input_ids=padded_inputs, attention_mask=attention_masks)
-        hidden_state = output.last_hidden_state
-        pooler = hidden_state[:, 0]
-        pooler = self.pre_classifier(pooler)
-        pooler = torch.nn.ReLU()(pooler)
+    def forward(self, utterances, utterance_lengths, sequence_lengths, targets):
+        out = self.forward_nn(utterances, utterance_lengths)
 
-        out = self.dropout(pooler)
+        loss = self.criterion(out, unpad(targets, sequence_lengths))
+        return loss
 
-        out = self.classifier(out)
+    def forward_decode(self, utterances, utterance_lengths, sequence_lengths):
+        out = self.forward_nn(utterances, utterance_lengths)
 
         predicted_labels = torch.argmax(out, dim=1)
-        return predicted_labels
+        return [
+            labels.tolist()
+            for labels in torch.split(predicted_labels, sequence_lengths.tolist())
+        ]
 
 
-class SpeechActBERTLSTM(nn.Module):
+class SpeechActBERTLSTM(SpeechActCRFModel):
     N_UNITS_BERT_OUT = 768
 
     def __init__(
@@ -267,63 +330,15 @@ class SpeechActBERTLSTM(nn.Module):
             for param in self.bert.parameters():
                 param.requires_grad = False
 
-    def gen_attention_masks(self, sequence_lengths, max_len):
-        return torch.tensor(
-            [int(s) * [1] + (max_len - int(s)) * [0] for s in sequence_lengths]
-        ).to(device)
-
-    def forward_nn(self, input):
-        sequence_lengths = [len(i) for i in input]
-        padded_inputs = pad_sequence(
-            [torch.LongTensor(i).to(device) for i in input], batch_first=True
-        )
-
-        max_len = max(sequence_lengths)
-        attention_masks = self.gen_attention_masks(sequence_lengths, max_len)
+    def utterance_representations(self, utterances, utterance_lengths):
+        # BERT expects the batch dimension first
+        padded_inputs = utterances.t()
+        attention_masks = sequence_mask(
+            utterance_lengths.to(padded_inputs.device), padded_inputs.size(1)
+        ).t().long()
         out_bert = self.bert(input_ids=padded_inputs, attention_mask=attention_masks)
         out_bert = out_bert.last_hidden_state
         out_bert = out_bert[:, 0]
 
         utterance_embedding = self.utterance_embedding(out_bert)
-        utterance_embedding = self.dropout(utterance_embedding)
-
-        hidden_utterance_lstm = self.init_hidden(
-            1, 1, self.n_hidden_units_utterance_lstm
-        )
-
-        utterance_representations = utterance_embedding.unsqueeze(
-            1
-        )  # add batch size dimension
-        output_utterance_level, hidden_utterance_lstm = self.lstm_utterance(
-            utterance_representations, hidden_utterance_lstm
-        )
-
-        outputs = self.decoder(output_utterance_level.squeeze(1))
-
-        outputs = outputs.unsqueeze(1)
-        return outputs
-
-    def forward(self, inputs, targets):
-        outputs = self.forward_nn(inputs)
-
-        targets = targets.unsqueeze(1)
-
-        log_likelihood = self.crf.forward(outputs, targets, reduction="token_mean")
-
-        loss = -log_likelihood
-
-        return loss
-
-    def forward_decode(self, input):
-        outputs = self.forward_nn(input)
-
-        labels = self.crf.decode(outputs)
-
-        return labels[0]
-
-    def init_hidden(self, n_layers, batch_size, n_hidden_units):
-        parameters_input = next(self.parameters())
-        return (
-            parameters_input.new_zeros(n_layers, batch_size, n_hidden_units),
-            parameters_input.new_zeros(n_layers, batch_size, n_hidden_units),
-        )
+        return self.dropout(utterance_embedding)
@@ -14,9 +14,10 @@ from torch.utils.data import DataLoader
 
 import matplotlib.pyplot as plt
 
-from nn_dataset import SpeechActsDataset
+from nn_dataset import BucketBatchSampler, SpeechActsDataset, collate_transcripts, unpad
 from nn_models import get_words
 from nn_train import prepare_data
+from data_store import load_utterances
 from utils import make_train_test_splits, PATH_NEW_ENGLAND_UTTERANCES
 from utils import SPEECH_ACT_DESCRIPTIONS, SPEAKER_CHILD
 
@@ -30,7 +31,7 @@ def test(args):
     print("Device: ", device)
 
     print("Loading data..")
-    data = pd.read_pickle(args.data)
+    data = load_utterances(args.data)
 
     vocab = pickle.load(open(os.path.join(args.model, "vocab.p"), "rb"))
     label_vocab = pickle.load(open(os.path.join(args.model, "vocab_labels.p"), "rb"))
@@ -43,9 +44,16 @@ def test(args):
 
     test_loader = DataLoader(
         dataset_test,
-        batch_size=args.batch_size,
-        shuffle=True,
-        num_workers=0,
+        batch_sampler=BucketBatchSampler(
+            dataset_test,
+            args.max_tokens,
+            args.batch_size,
+            shuffle=False,
+            seed=args.seed,
+        ),
+        num_workers=args.num_workers,
+        pin_memory=device.type == "cuda",
+        collate_fn=collate_transcripts,
     )
 
     print("Test samples: ", len(dataset_test))
@@ -58,27 +66,39 @@ def test(args):
         all_ages = []
         speaker_is_child = []
         with torch.no_grad():
-            for batch_id, (input_samples, targets, sequence_lengths, age) in enumerate(
-                data_loader
-            ):
+            for batch_id, (
+                utterances,
+                utterance_lengths,
+                targets,
+                sequence_lengths,
+                ages,
+            ) in enumerate(data_loader):
                 # Move data to GPU
-                targets = torch.tensor(targets).to(device)
+                targets = unpad(targets, sequence_lengths).to(device)
 
                 # Perform forward pass of the model
-                predicted_labels = model.forward_decode(input_samples)
-                predicted_labels = torch.tensor(predicted_labels).to(device)
-
-                speaker_is_child += [
-                    True if x[0] == vocab.stoi[SPEAKER_CHILD] else False
-                    for x in input_samples
-                ]
+                utterances = utterances.to(device, non_blocking=True)
+                predicted_labels = model.forward_decode(
+                    utterances, utterance_lengths, sequence_lengths
+                )
+                predicted_labels = torch.tensor(
+                    [label for labels in predicted_labels for label in labels]
+                ).to(device)
+
+                # The first token of each utterance is the speaker token
+                speaker_is_child += (utterances[0] == vocab.stoi[SPEAKER_CHILD]).tolist()
                 all_true_labels += targets.tolist()
                 all_predicted_labels += predicted_labels.tolist()
-                all_ages += [age] * len(input_samples)
+                for age, sequence_length in zip(ages, sequence_lengths.tolist()):
+                    all_ages += [age] * sequence_length
 
                 if args.verbose:
+                    samples = [
+                        utterances[:length, i]
+                        for i, length in enumerate(utterance_lengths.tolist())
+                    ]
                     for i, (sample, label, predicted) in enumerate(
-                        zip(input_samples, targets, predicted_labels)
+                        zip(samples, targets, predicted_labels)
                     ):
                         if (
                             label_vocab.inverse[int(predicted)]
@@ -223,9 +243,24 @@ if __name__ == "__main__":
         default=0.2,
         help="Ratio of dataset to be used to testing",
     )
-    # TODO fix: works only with batch size one at the moment
     parser.add_argument(
-        "--batch-size", type=int, default=1, metavar="N", help="batch size"
+        "--batch-size",
+        type=int,
+        default=32,
+        metavar="N",
+        help="maximum number of transcripts per batch",
+    )
+    parser.add_argument(
+        "--max-tokens",
+        type=int,
+        default=20000,
+        help="maximum number of (padded) tokens per batch, batches contain transcripts of similar lengths",
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=2,
+        help="number of processes preparing the batches (0 to prepare them in the main process)",
     )
     parser.add_argument("--seed", type=int, default=1111, help="random seed")
     parser.add_argument(
@@ -1,20 +1,26 @@
 """Training routine for LSTM and Transformer"""
 
 import argparse
+import contextlib
 import os
 import pickle
 
-import pandas as pd
-
 import torch
 from sklearn.model_selection import train_test_split
 from torch import nn, optim
 from torch.utils.data import DataLoader
 
-from nn_dataset import SpeechActsDataset
+from nn_dataset import (
+    BucketBatchSampler,
+    SpeechActsDataset,
+    collate_transcripts,
+    transcript_windows,
+    unpad,
+)
 from nn_models import SpeechActLSTM, SpeechActBERTLSTM
 from nn_utils import build_vocabulary
 from preprocess import SPEECH_ACT
+from data_store import load_utterances
 from utils import (
     dataset_labels,
     preprend_speaker_token,
@@ -53,12 +59,206 @@ def prepare_data(data, vocab, label_vocab):
     return data_grouped
 
 
+LR_SCALINGS = ["none", "sqrt", "linear"]
+
+
+def learning_rate(args) -> float:
+    """Learning rate of the optimizer: `args.lr`, or with `args.lr_scaling` sqrt or linear, `args.lr` as the learning rate
+    for one transcript per update, scaled with the number of transcripts per update (batch size x accumulation steps).
+
+    The loss is averaged over the utterances of a batch, so without scaling an epoch makes fewer updates of the same
+    size with larger batches, and reaches a lower accuracy after the same number of epochs."""
+    transcripts_per_update = args.batch_size * getattr(args, "accumulation_steps", 1)
+    if args.lr_scaling == "sqrt":
+        return args.lr * transcripts_per_update ** 0.5
+    if args.lr_scaling == "linear":
+        return args.lr * transcripts_per_update
+    return args.lr
+
+
+def autocast(enabled):
+    """Context in which the operations run in bfloat16 where possible (if enabled)"""
+    if not enabled:
+        return contextlib.nullcontext()
+    return torch.autocast(device.type, dtype=torch.bfloat16)
+
+
+def set_num_threads(args):
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    if args.num_interop_threads:
+        # Has to be set before any inter-op parallel work is started
+        torch.set_num_interop_threads(args.num_interop_threads)
+    print(
+        f"Threads: {torch.get_num_threads()} intra-op, {torch.get_num_interop_threads()} inter-op"
+    )
+
+
+def compile_model(model):
+    """Model compiled with torch.compile (PyTorch >= 2.0), the model itself if not available.
+
+    The model is compiled for dynamic shapes, as the padded tensors of bucketed batches have a different shape in
+    almost every batch, which would otherwise trigger a recompilation for each new shape."""
+    if not hasattr(torch, "compile"):
+        print("torch.compile is not available, the model is not compiled")
+        return model
+    return torch.compile(model, dynamic=True)
+
+
+def check_window_args(parser, args):
+    """Exit with a usage error if the window options are invalid (see nn_dataset.transcript_windows), before the data
+    is loaded"""
+    if args.window_size is None:
+        return
+    if args.window_size < 1:
+        parser.error("--window-size must be at least 1")
+    if not 0 <= args.window_overlap < args.window_size:
+        parser.error("--window-overlap must be at least 0 and smaller than --window-size")
+
+
+def backward_windows(model, batch, window_size, overlap, weight=1.0, bf16=False):
+    """Backpropagate the loss of a batch of transcripts window by window (truncated backpropagation through time, see
+    nn_dataset.transcript_windows), so that the memory needed does not depend on the length of the transcripts.
+
+    Returns:
+        the loss of the batch: mean of the losses of the windows, weighted by their number of utterances
+    """
+    windows = list(transcript_windows(*batch, window_size, overlap))
+    nb_utterances = sum(int(window[-1].sum()) for window in windows)
+
+    batch_loss = 0.0
+    hidden = None
+    for utterances, utterance_lengths, targets, sequence_lengths in windows:
+        with autocast(bf16):
+            loss, hidden = model.forward_window(
+                utterances,
+                utterance_lengths,
+                sequence_lengths,
+                targets,
+                hidden=hidden,
+                carry_length=window_size - overlap,
+            )
+        window_weight = int(sequence_lengths.sum()) / nb_utterances
+        (loss * window_weight * weight).backward()
+        batch_loss += loss.item() * window_weight
+
+    return batch_loss
+
+
+def train_epoch(model, optimizer, data_loader, epoch, args, forward=None):
+    """Train the model for an epoch. `forward` is the function computing the loss of a batch (e.g. the compiled model),
+    the model itself by default.
+
+    The gradients of `args.accumulation_steps` batches are accumulated before each update of the parameters."""
+    if forward is None:
+        forward = model
+    model.train()
+    total_loss = 0.0
+
+    # Clear gradients
+    optimizer.zero_grad()
+
+    for batch_id, (
+        utterances,
+        utterance_lengths,
+        targets,
+        sequence_lengths,
+        ages,
+    ) in enumerate(data_loader):
+        # Move data to GPU
+        utterances = utterances.to(device, non_blocking=True)
+        targets = targets.to(device, non_blocking=True)
+
+        # Perform forward and backward pass of the model
+        if args.window_size:
+            loss = backward_windows(
+                model,
+                (utterances, utterance_lengths, targets, sequence_lengths),
+                args.window_size,
+                args.window_overlap,
+                weight=1 / args.accumulation_steps,
+                bf16=args.bf16,
+            )
+        else:
+            with autocast(args.bf16):
+                loss = forward(utterances, utterance_lengths, sequence_lengths, targets)
+            (loss / args.accumulation_steps).backward()
+            loss = loss.item()
+
+        # Calculate loss
+        total_loss += loss
+
+        if (
+            (batch_id + 1) % args.accumulation_steps == 0
+            or batch_id + 1 == len(data_loader)
+            or args.dry_run
+        ):
+            # Clip gradients
+            torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
+
+            # Update parameter weights
+            optimizer.step()
+            optimizer.zero_grad()
+
+        if batch_id % args.log_interval == 0 and batch_id != 0:
+            cur_loss = total_loss / args.log_interval
+            current_learning_rate = optimizer.param_groups[0]["lr"]
+            print(
+                "| epoch {:3d} | {:5d}/{:5d} batches | lr {:02.6f} | loss {:5.5f}".format(
+                    epoch,
+                    batch_id,
+                    len(data_loader),
+                    current_learning_rate,
+                    cur_loss,
+                )
+            )
+            total_loss = 0
+
+        if args.dry_run:
+            break
+
+
+def evaluate(model, data_loader, args):
+    # Turn on evaluation mode which disables dropout.
+    model.eval()
+    total_loss = 0.0
+    num_samples = 0
+    num_correct = 0
+    with torch.no_grad():
+        for batch_id, (
+            utterances,
+            utterance_lengths,
+            targets,
+            sequence_lengths,
+            ages,
+        ) in enumerate(data_loader):
+            # Move data to GPU
+            utterances = utterances.to(device, non_blocking=True)
+            targets = unpad(targets, sequence_lengths).to(device)
+
+            # Perform forward pass of the model
+            with autocast(args.bf16):
+                predicted_labels = model.forward_decode(
+                    utterances, utterance_lengths, sequence_lengths
+                )
+            predicted_labels = torch.tensor(
+                [label for labels in predicted_labels for label in labels]
+            ).to(device)
+
+            # Compare predicted labels to ground truth
+            num_correct += int(torch.sum(predicted_labels == targets))
+            num_samples += len(targets)
+
+    return total_loss / num_samples, num_correct / num_samples
+
+
 def train(args):
     print("Start training with args: ", args)
     print("Device: ", device)
+    set_num_threads(args)
 
     # Load data
-    data = pd.read_pickle(args.data)
+    data = load_utterances(args.data)
 
     data_train, data_test = make_train_test_splits(data, args.test_ratio)
 
@@ -87,21 +287,42 @@ def train(args):
 
     train_loader = DataLoader(
         dataset_train,
-        batch_size=args.batch_size,
-        shuffle=True,
-        num_workers=0,
+        batch_sampler=BucketBatchSampler(
+            dataset_train,
+            args.max_tokens,
+            args.batch_size,
+            shuffle=True,
+            seed=args.seed,
+        ),
+        num_workers=args.num_workers,
+        pin_memory=device.type == "cuda",
+        collate_fn=collate_transcripts,
     )
     valid_loader = DataLoader(
         dataset_val,
-        batch_size=args.batch_size,
-        shuffle=True,
-        num_workers=0,
+        batch_sampler=BucketBatchSampler(
+            dataset_val,
+            args.max_tokens,
+            args.batch_size,
+            shuffle=False,
+            seed=args.seed,
+        ),
+        num_workers=args.num_workers,
+        pin_memory=device.type == "cuda",
+        collate_fn=collate_transcripts,
     )
     test_loader = DataLoader(
         dataset_test,
-        batch_size=args.batch_size,
-        shuffle=True,
-        num_workers=0,
+        batch_sampler=BucketBatchSampler(
+            dataset_test,
+            args.max_tokens,
+            args.batch_size,
+            shuffle=False,
+            seed=args.seed,
+        ),
+        num_workers=args.num_workers,
+        pin_memory=device.type == "cuda",
+        collate_fn=collate_transcripts,
     )
     print("Loaded data.")
 
@@ -129,87 +350,29 @@ def train(args):
 
     model.to(device)
 
-    optimizer = optim.Adam(model.parameters(), lr=args.lr)
-
-    def train_epoch(data_loader, epoch):
-        model.train()
-        total_loss = 0.0
+    optimizer = optim.Adam(model.parameters(), lr=learning_rate(args))
 
-        for batch_id, (input_samples, targets, sequence_lengths, ages) in enumerate(
-            data_loader
-        ):
-            # Move data to GPU
-            targets = torch.tensor(targets).to(device)
-
-            # Clear gradients
-            optimizer.zero_grad()
-
-            # Perform forward pass of the model
-            loss = model(input_samples, targets)
-
-            # Calculate loss
-            total_loss += loss.item()
-            loss.backward()
-
-            # Clip gradients
-            torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
-
-            # Update parameter weights
-            optimizer.step()
-
-            if batch_id % args.log_interval == 0 and batch_id != 0:
-                cur_loss = total_loss / (args.log_interval * args.batch_size)
-                current_learning_rate = optimizer.param_groups[0]["lr"]
-                print(
-                    "| epoch {:3d} | {:5d}/{:5d} batches | lr {:02.6f} | loss {:5.5f}".format(
-                        epoch,
-                        batch_id,
-                        len(data_loader),
-                        current_learning_rate,
-                        cur_loss,
-                    )
-                )
-                total_loss = 0
-
-            if args.dry_run:
-                break
-
-    def evaluate(data_loader):
-        # Turn on evaluation mode which disables dropout.
-        model.eval()
-        total_loss = 0.0
-        num_samples = 0
-        num_correct = 0
-        with torch.no_grad():
-            for batch_id, (input_samples, targets, sequence_lengths, ages) in enumerate(
-                data_loader
-            ):
-                # Move data to GPU
-                targets = torch.tensor(targets).to(device)
-
-                # Perform forward pass of the model
-                predicted_labels = model.forward_decode(input_samples)
-                predicted_labels = torch.tensor(predicted_labels).to(device)
-
-                # Compare predicted labels to ground truth
-                num_correct += int(torch.sum(predicted_labels == targets))
-                num_samples += len(input_samples)
-
-        return total_loss / num_samples, num_correct / num_samples
+    forward = compile_model(model) if args.compile else model
 
     # Loop over epochs.
     best_val_acc = None
 
     try:
         for epoch in range(1, args.epochs + 1):
-            train_epoch(train_loader, epoch)
-            val_loss, val_accuracy = evaluate(valid_loader)
+            train_epoch(model, optimizer, train_loader, epoch, args, forward)
+            val_loss, val_accuracy = evaluate(model, valid_loader, args)
             print("-" * 89)
             print(
                 "| end of epoch {:3d} | valid loss {:5.5f} | valid acc {:5.2f} ".format(
                     epoch, val_loss, val_accuracy
                 )
             )
+            efficiency = train_loader.batch_sampler.efficiency
+            print(
+                "| padding efficiency | tokens {:5.2f} | utterances {:5.2f}".format(
+                    efficiency["tokens"], efficiency["utterances"]
+                )
+            )
             print("-" * 89)
             # Save the model if the validation loss is the best we've seen so far.
             if not best_val_acc or val_accuracy > best_val_acc:
@@ -226,7 +389,7 @@ def train(args):
         model = torch.load(f)
 
     # Run on test data.
-    test_loss, test_accuracy = evaluate(test_loader)
+    test_loss, test_accuracy = evaluate(model, test_loader, args)
     print("=" * 89)
     print(
         "| End of training | test loss {:5.2f} | test acc {:5.2f}".format(
@@ -294,11 +457,71 @@ if __name__ == "__main__":
     parser.add_argument(
         "--lr", type=float, default=0.0001, help="initial learning rate"
     )
+    parser.add_argument(
+        "--lr-scaling",
+        choices=LR_SCALINGS,
+        default="none",
+        help="scaling of the learning rate with the number of transcripts per update (--lr is the learning rate for "
+        "a single transcript)",
+    )
     parser.add_argument("--clip", type=float, default=0.25, help="gradient clipping")
     parser.add_argument("--epochs", type=int, default=50, help="upper epoch limit")
-    # TODO fix: works only with batch size 1 at the moment (equalling 1 transcript)
     parser.add_argument(
-        "--batch-size", type=int, default=1, metavar="N", help="batch size"
+        "--batch-size",
+        type=int,
+        default=32,
+        metavar="N",
+        help="maximum number of transcripts per batch",
+    )
+    parser.add_argument(
+        "--max-tokens",
+        type=int,
+        default=20000,
+        help="maximum number of (padded) tokens per batch, batches contain transcripts of similar lengths",
+    )
+    parser.add_argument(
+        "--window-size",
+        type=int,
+        default=None,
+        help="train on windows of this number of utterances of the transcripts, carrying the state of the "
+        "utterance-level LSTM over from one window to the next (default: whole transcripts)",
+    )
+    parser.add_argument(
+        "--window-overlap",
+        type=int,
+        default=0,
+        help="number of utterances shared by consecutive windows (with --window-size, smaller than the size of the "
+        "windows)",
+    )
+    parser.add_argument(
+        "--accumulation-steps",
+        type=int,
+        default=1,
+        metavar="N",
+        help="accumulate the gradients of N batches before each update of the parameters",
+    )
+    parser.add_argument(
+        "--bf16",
+        action="store_true",
+        help="run the forward pass with bfloat16 autocast (on CPU or GPU)",
+    )
+    parser.add_argument(
+        "--num-threads",
+        type=int,
+        default=None,
+        help="number of threads used for intra-op parallelism (default: PyTorch's default)",
+    )
+    parser.add_argument(
+        "--num-interop-threads",
+        type=int,
+        default=None,
+        help="number of threads used for inter-op parallelism (default: PyTorch's default)",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="compile the model with torch.compile for dynamic shapes (PyTorch >= 2.0), check with "
+        "bench_nn_training.py that it speeds up training on your hardware",
     )
     parser.add_argument(
         "--dropout",
@@ -306,6 +529,12 @@ if __name__ == "__main__":
         default=0.2,
         help="dropout applied to layers (0 = no dropout)",
     )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=2,
+        help="number of processes preparing the batches (0 to prepare them in the main process)",
+    )
     parser.add_argument("--seed", type=int, default=1111, help="random seed")
     parser.add_argument(
         "--log-interval", type=int, default=30, metavar="N", help="report interval"
@@ -316,4 +545,5 @@ if __name__ == "__main__":
     )
 
     args = parser.parse_args()
+    check_window_args(parser, args)
     train(args)
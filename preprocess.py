@@ -1,19 +1,33 @@
 import argparse
+import hashlib
+import json
+import multiprocessing
 import os
 
 import pandas as pd
 import pylangacq
 
+from data_store import is_parquet, load_utterances, save_utterances
+from digests import file_digest
 from utils import (
     PATH_NEW_ENGLAND_UTTERANCES,
     SPEECH_ACT,
     CHILD,
-    SPEECH_ACT_DESCRIPTIONS,
+    get_speech_act_descriptions,
     POS_PUNCTUATION,
 )
 
 CODING_ERRORS = {"AS": "SA", "CTP": "CT", "00": "OO"}
 
+# Number of utterances preprocessed before they are written to the output
+CHUNK_SIZE = 200000
+
+# Increase to re-parse all files (e.g. when the conversion of utterances changes)
+PREPROCESSING_VERSION = 1
+
+# Preprocessed utterances of each CHAT file, and manifest of the files
+PATH_PREPROCESSED_SHARDS = os.path.expanduser("~/data/speech_acts/data/preprocessed_shards/")
+
 
 def get_speech_act(utt):
     if "%spa" not in utt.tiers:
@@ -31,7 +45,7 @@ def get_speech_act(utt):
         tag = tag.split(":")[1].upper()
         if tag in CODING_ERRORS.keys():
             tag = CODING_ERRORS[tag]
-        if tag not in SPEECH_ACT_DESCRIPTIONS.index:
+        if tag not in get_speech_act_descriptions().index:
             print("Unknown speech act:", tag)
         return tag
     else:
@@ -105,29 +119,187 @@ def preprocess_utterances(corpus, transcripts):
 
         all_utts.append(utts_transcript)
 
+    if len(all_utts) == 0:
+        return None
+
     utterances = pd.concat(all_utts, ignore_index=True)
 
     return utterances
 
 
-def preprocess_transcripts(args):
-    all_utterances = []
-    for corpus in args.corpora:
-        print(f"Reading transcripts of {corpus} corpus.. ", end="")
-        transcripts = pylangacq.read_chat(
-            os.path.expanduser(f"~/data/CHILDES/{corpus}/"),
+def find_transcript_files(corpus):
+    """Paths of the CHAT files of a corpus, sorted"""
+    corpus_dir = os.path.expanduser(f"~/data/CHILDES/{corpus}/")
+    file_paths = []
+    for root, _, files in os.walk(corpus_dir):
+        file_paths.extend(
+            os.path.join(root, file) for file in files if file.endswith(".cha")
         )
-        print("done.")
-
-        print(f"Preprocessing utterances.. ", end="")
-        utterances_corpus = preprocess_utterances(corpus, transcripts)
-        print("done.")
+    return sorted(file_paths)
+
+
+def preprocess_file(task):
+    """Parse a CHAT file and preprocess its utterances (None if the transcript is skipped)"""
+    corpus, file_path = task
+    transcripts = pylangacq.read_chat(file_path)
+    return preprocess_utterances(corpus, transcripts)
+
+
+def preprocess_shard(task):
+    """Preprocess a CHAT file and store its utterances in a shard, returns the manifest entry of the file"""
+    corpus, file_path, shard_path = task
+    stat = os.stat(file_path)
+    entry = {
+        "corpus": corpus,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "sha256": file_digest(file_path),
+        "shard": None,
+    }
+    utterances = preprocess_file((corpus, file_path))
+    if utterances is not None:
+        save_utterances(utterances, shard_path)
+        entry["shard"] = os.path.basename(shard_path)
+    return file_path, entry
+
+
+class PreprocessingManifest:
+    """Record of the preprocessed CHAT files, stored along with their shards in `shard_dir/manifest.json`.
+
+    For each file: corpus, size, modification time, content hash and shard (pickled data frame of its preprocessed
+    utterances, before dropping untagged utterances; None if the transcript is skipped). All shards are invalidated
+    when PREPROCESSING_VERSION or CODING_ERRORS change.
+    """
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        self.path = os.path.join(shard_dir, "manifest.json")
+        self.settings = {"version": PREPROCESSING_VERSION, "coding_errors": CODING_ERRORS}
+        self.files = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                stored = json.load(f)
+            if stored["settings"] == self.settings:
+                self.files = stored["files"]
+
+    def shard_path(self, file_path):
+        name = hashlib.sha256(file_path.encode()).hexdigest()[:32]
+        return os.path.join(self.shard_dir, f"{name}.p")
+
+    def is_up_to_date(self, corpus, file_path):
+        entry = self.files.get(file_path)
+        if entry is None or entry["corpus"] != corpus:
+            return False
+        stat = os.stat(file_path)
+        if entry["size"] != stat.st_size:
+            return False
+        if entry["mtime"] != stat.st_mtime_ns:
+            # Modified time changed (e.g. file copied again), the shard is only valid if the contents are the same
+            if file_digest(file_path) != entry["sha256"]:
+                return False
+            entry["mtime"] = stat.st_mtime_ns
+        return True
+
+    def load_shard(self, file_path):
+        shard = self.files[file_path]["shard"]
+        if shard is None:
+            return None
+        return load_utterances(os.path.join(self.shard_dir, shard))
+
+    def remove(self, file_path):
+        shard = self.files.pop(file_path)["shard"]
+        if shard is not None and os.path.exists(os.path.join(self.shard_dir, shard)):
+            os.remove(os.path.join(self.shard_dir, shard))
+
+    def save(self):
+        os.makedirs(self.shard_dir, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"settings": self.settings, "files": self.files}, f)
+        os.replace(tmp_path, self.path)
+
+
+def concat_chunk(utterances, first_row):
+    chunk = pd.concat(utterances, ignore_index=True)
+    chunk.index += first_row
+    return chunk
+
+
+def drop_untagged(data):
+    data = data.dropna(subset=[SPEECH_ACT])
+    return data[~data[SPEECH_ACT].isin(["NOL", "NAT", "NEE"])]
+
+
+def update_shards(args, manifest, tasks):
+    """Preprocess the CHAT files that are new or changed since the last run, remove shards of deleted files"""
+    to_parse = [
+        (corpus, file_path, manifest.shard_path(file_path))
+        for corpus, file_path in tasks
+        if args.reparse or not manifest.is_up_to_date(corpus, file_path)
+    ]
+    file_paths = {file_path for _, file_path in tasks}
+    deleted = [
+        file_path
+        for file_path, entry in manifest.files.items()
+        if entry["corpus"] in args.corpora and file_path not in file_paths
+    ]
+    print(
+        f"{len(tasks)} transcripts of {', '.join(args.corpora)}: {len(to_parse)} new or changed, "
+        f"{len(deleted)} deleted."
+    )
 
-        all_utterances.append(utterances_corpus)
+    for file_path in deleted:
+        manifest.remove(file_path)
+
+    os.makedirs(manifest.shard_dir, exist_ok=True)
+    try:
+        if args.workers > 1:
+            with multiprocessing.Pool(args.workers) as pool:
+                for file_path, entry in pool.imap_unordered(
+                    preprocess_shard, to_parse, chunksize=4
+                ):
+                    manifest.files[file_path] = entry
+        else:
+            for task in to_parse:
+                file_path, entry = preprocess_shard(task)
+                manifest.files[file_path] = entry
+    finally:
+        # Keep the files preprocessed so far if interrupted
+        manifest.save()
 
-    all_utterances = pd.concat(all_utterances, ignore_index=True)
 
-    return all_utterances
+def preprocess_transcripts(args):
+    """Preprocess the CHAT files of the corpora, in parallel with args.workers processes.
+
+    Only files that are new or changed since the last run are parsed (see `PreprocessingManifest`), the utterances of
+    the other files are read from their shards. Yields data frames of (at least CHUNK_SIZE) utterances, in the order of
+    the corpora and of the files within each corpus, whatever the order in which the workers finish. Rows are indexed
+    by their position among all utterances.
+    """
+    tasks = [
+        (corpus, file_path)
+        for corpus in args.corpora
+        for file_path in find_transcript_files(corpus)
+    ]
+    manifest = PreprocessingManifest(args.shard_dir)
+    update_shards(args, manifest, tasks)
+
+    first_row = 0
+    buffer = []
+    nb_buffered = 0
+    for _, file_path in tasks:
+        utterances = manifest.load_shard(file_path)
+        if utterances is None:
+            continue
+        buffer.append(utterances)
+        nb_buffered += len(utterances)
+        if nb_buffered >= CHUNK_SIZE:
+            yield concat_chunk(buffer, first_row)
+            first_row += nb_buffered
+            buffer = []
+            nb_buffered = 0
+    if buffer:
+        yield concat_chunk(buffer, first_row)
 
 
 def parse_args():
@@ -143,6 +315,23 @@ def parse_args():
         action="store_true",
         help="Drop utterances that have not been annotated",
     )
+    argparser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes preprocessing transcript files in parallel",
+    )
+    argparser.add_argument(
+        "--shard-dir",
+        type=str,
+        default=PATH_PREPROCESSED_SHARDS,
+        help="Directory storing the preprocessed utterances of each CHAT file, only new or changed files are parsed",
+    )
+    argparser.add_argument(
+        "--reparse",
+        action="store_true",
+        help="Parse all CHAT files, even if they did not change since the last run",
+    )
 
     args = argparser.parse_args()
 
@@ -152,15 +341,21 @@ def parse_args():
 if __name__ == "__main__":
     args = parse_args()
 
-    data = preprocess_transcripts(args)
+    os.makedirs(os.path.dirname(args.output_path), exist_ok=True)
 
+    chunks = preprocess_transcripts(args)
     if args.drop_untagged:
-        data.dropna(subset=[SPEECH_ACT], inplace=True)
-        data.drop(
-            data[data[SPEECH_ACT].isin(["NOL", "NAT", "NEE"])].index, inplace=True
-        )
-
-    print(f"Preprocessed {len(data)} utterances.")
+        chunks = (drop_untagged(chunk) for chunk in chunks)
+
+    if is_parquet(args.output_path) or args.output_path.endswith(".csv"):
+        # Each chunk is appended to the output as soon as it is preprocessed
+        nb_utterances = 0
+        for i, chunk in enumerate(chunks):
+            save_utterances(chunk, args.output_path, append=i > 0)
+            nb_utterances += len(chunk)
+    else:
+        data = pd.concat(chunks)
+        nb_utterances = len(data)
+        save_utterances(data, args.output_path)
 
-    os.makedirs(os.path.dirname(args.output_path), exist_ok=True)
-    data.to_pickle(args.output_path)
+    print(f"Preprocessed {nb_utterances} utterances.")
@@ -1,15 +1,18 @@
 """Load and store transcripts of children from childes-db."""
 
-import math
-
-from childespy.childespy import get_transcripts, get_corpora, get_utterances
+import argparse
+import multiprocessing
+import os
 
 import nltk
 
 from tqdm import tqdm
 
+import numpy as np
 import pandas as pd
 
+from childes_db import LiveChildesDB, MirrorChildesDB, QueryCache, load_corpus_tables
+from data_store import save_utterances
 from utils import PATH_CHILDES_UTTERANCES
 
 DB_ARGS = None
@@ -20,6 +23,11 @@ DB_ARGS = None
 #     "db_name": "childes-db-version-0.1.2",
 # }
 
+# Number of utterances tokenized per task of the process pool
+TOKENIZE_BATCH_SIZE = 10000
+
+PATH_CHILDES_DB_CACHE = os.path.expanduser("~/data/speech_acts/data/childes_db_cache/")
+
 TYPES_QUESTION = {
     "question",
     "interruption question",
@@ -52,62 +60,155 @@ def add_punctuation(tokens, utterance_type):
     return tokens
 
 
-def load_utts():
-    data = []
-    corpora = get_corpora(db_args=DB_ARGS)
+def tokenize(batch):
+    """Tokenize a batch of utterances, given as (gloss, utterance type) pairs"""
+    return [
+        add_punctuation(nltk.word_tokenize(gloss), utterance_type)
+        for gloss, utterance_type in batch
+    ]
+
+
+def preprocess_corpus(corpus_name, transcripts, utts, map_batches):
+    """Utterances of the transcripts of a corpus, in the order of the transcripts and of the utterances within each
+    transcript"""
+    # Make sure we know the age of the child
+    transcripts = transcripts[transcripts["target_child_age"].notna()]
+    transcript_ranks = pd.Series(
+        np.arange(len(transcripts)), index=transcripts["transcript_id"].to_numpy()
+    )
+    transcript_ranks = transcript_ranks[~transcript_ranks.index.duplicated()]
+    ages = pd.Series(
+        np.round(transcripts["target_child_age"].to_numpy()).astype(int),
+        index=transcripts["transcript_id"].to_numpy(),
+    )
+    ages = ages[~ages.index.duplicated()]
+
+    # Make sure we have an utterance
+    utts = utts[
+        utts["transcript_id"].isin(transcript_ranks.index)
+        & utts["gloss"].notna()
+        & (utts["gloss"] != "")
+    ]
+    # Group the utterances by transcript with a single sort
+    utts = utts.assign(
+        transcript_rank=utts["transcript_id"].map(transcript_ranks)
+    ).sort_values(by=["transcript_rank", "utterance_order"], kind="stable")
+
+    glosses = list(zip(utts["gloss"].tolist(), utts["type"].tolist()))
+    batches = [
+        glosses[start:start + TOKENIZE_BATCH_SIZE]
+        for start in range(0, len(glosses), TOKENIZE_BATCH_SIZE)
+    ]
+    tokens = [
+        tokenized
+        for batch in tqdm(map_batches(tokenize, batches), total=len(batches))
+        for tokenized in batch
+    ]
+
+    return pd.DataFrame(
+        {
+            "file_id": utts["transcript_id"].to_numpy(),
+            "corpus": corpus_name,
+            "child_id": utts["target_child_id"].to_numpy(),
+            "age_months": utts["transcript_id"].map(ages).to_numpy(),
+            "tokens": tokens,
+            # POS tags are stored by childes-db as space-separated strings
+            "pos": [
+                pos.split() if isinstance(pos, str) else []
+                for pos in utts["part_of_speech"].tolist()
+            ],
+            "speaker": utts["speaker_role"].to_numpy(),
+        }
+    )
+
+
+def load_utts(workers=1, db=None, cache=None):
+    """Utterances of the North American corpora, yields a data frame for each corpus. Rows are indexed by their position
+    among the utterances of all corpora.
+
+    db: `childes_db.MirrorChildesDB` or `childes_db.LiveChildesDB` (default: live childes-db with DB_ARGS)
+    cache: `childes_db.QueryCache` storing the query results of each corpus
+    """
+    if db is None:
+        db = LiveChildesDB(DB_ARGS)
+    corpora = db.corpora()
 
     # Filter for North American corpora
     corpora = corpora[corpora["collection_name"].isin(["Eng-NA"])]
-    for _, corpus in corpora.iterrows():
-        print(corpus)
-
-        transcripts = get_transcripts(corpus=corpus["corpus_name"], db_args=DB_ARGS)
-        utts = get_utterances(
-            corpus=corpus["corpus_name"], language="eng", db_args=DB_ARGS
-        )
-
-        for _, transcript in tqdm(transcripts.iterrows(), total=transcripts.shape[0]):
-
-            # Make sure we know the age of the child
-            if not math.isnan(transcript["target_child_age"]):
-
-                # Filter utterances for current transcript
-                utts_transcript = utts.loc[
-                    (utts["transcript_id"] == transcript["transcript_id"])
-                ]
-
-                if len(utts_transcript) > 0:
-                    utts_transcript = utts_transcript.sort_values(
-                        by=["utterance_order"]
-                    )
-                    for _, utt in utts_transcript.iterrows():
-
-                        # Make sure we have an utterance
-                        if utt["gloss"]:
-
-                            # Tokenize utterances
-                            tokenized_utterance = nltk.word_tokenize(utt["gloss"])
-                            tokenized_utterance = add_punctuation(
-                                tokenized_utterance, utt["type"]
-                            )
-                            data.append(
-                                {
-                                    "file_id": transcript["transcript_id"],
-                                    "child_id": utt["target_child_id"],
-                                    "age_months": round(transcript["target_child_age"]),
-                                    "tokens": tokenized_utterance,
-                                    "pos": utt["part_of_speech"],
-                                    "speaker": utt["speaker_role"],
-                                }
-                            )
-    return pd.DataFrame(data)
 
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    map_batches = pool.imap if pool is not None else map
+    try:
+        first_row = 0
+        for corpus_name, transcripts, utts in load_corpus_tables(
+            db, corpora["corpus_name"].tolist(), language="eng", cache=cache
+        ):
+            data = preprocess_corpus(corpus_name, transcripts, utts, map_batches)
+            data.index += first_row
+            first_row += len(data)
+            yield data
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        "--output-path", "-o", type=str, default=PATH_CHILDES_UTTERANCES
+    )
+    argparser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes tokenizing utterances in parallel",
+    )
+    argparser.add_argument(
+        "--db",
+        type=str,
+        default=None,
+        help="Local SQLite or DuckDB (.duckdb) mirror of childes-db (default: query the childes-db server with "
+        "childespy)",
+    )
+    argparser.add_argument(
+        "--db-version",
+        type=str,
+        default=None,
+        help="Version of the database, identifies cached query results (default: name of the database in DB_ARGS, or "
+        "name, size and modification time of the mirror)",
+    )
+    argparser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=PATH_CHILDES_DB_CACHE,
+        help="Directory to cache query results of each corpus",
+    )
+    argparser.add_argument(
+        "--no-cache", action="store_true", help="Do not read or store cached query results",
+    )
+
+    args = argparser.parse_args()
+
+    return args
 
-if __name__ == "__main__":
 
-    # Loading data
-    data = load_utts()
+if __name__ == "__main__":
+    args = parse_args()
 
-    # Store utterances for future re-use
-    data.rename(columns={'child_age': 'age_months'}, inplace=True)
-    data.to_pickle(PATH_CHILDES_UTTERANCES)
+    if args.db is not None:
+        db = MirrorChildesDB(args.db, version=args.db_version)
+    else:
+        db = LiveChildesDB(DB_ARGS)
+    version = args.db_version or db.version
+    cache = None
+    if not args.no_cache:
+        if version is None:
+            print("Query results are not cached, as the version of childes-db is unknown (see --db-version)")
+        else:
+            cache = QueryCache(args.cache_dir, version)
+
+    # Loading data, the utterances of each corpus are appended to the stored utterances
+    for i, data in enumerate(load_utts(args.workers, db, cache)):
+        data.rename(columns={'child_age': 'age_months'}, inplace=True)
+        save_utterances(data, args.output_path, append=i > 0)
@@ -1,5 +1,6 @@
 import pandas as pd
 
+from data_store import load_utterances
 from utils import SOURCE_SNOW, SOURCE_CRF, load_whole_childes_data, age_bin, PATH_NEW_ENGLAND_UTTERANCES_ANNOTATED
 from exp_adjacency_pairs import get_adj_pairs_frac_data
 from utils import AGES, ADULT, CHILD
@@ -49,7 +50,7 @@ def get_contingency_data(data, age, data_source):
 def create_file_with_all_possible_adjacency_pairs_for_annotation():
     adj_data_all = pd.DataFrame()
 
-    data = pd.read_pickle(PATH_NEW_ENGLAND_UTTERANCES_ANNOTATED)
+    data = load_utterances(PATH_NEW_ENGLAND_UTTERANCES_ANNOTATED)
 
     # map ages to corresponding bins
     data["age_months"] = data["age_months"].apply(age_bin)
@@ -0,0 +1,311 @@
+"""Compact representation of tokenized utterances for analyses of large corpora (e.g. the whole CHILDES data).
+
+All strings (tokens, POS tags, speaker codes, speech acts, transcript files) are replaced by integer ids of a global
+string interner. Tokens and POS tags of all utterances are stored in flat int32 arrays, the tokens of utterance i
+being tokens[token_offsets[i]:token_offsets[i + 1]]. Utterances are ordered by transcript (and utterance id), the
+utterances of transcript j being transcript_offsets[j]:transcript_offsets[j + 1].
+
+The arrays are saved as .npy files in a directory and memory-mapped when loading, so that counts of tokens, n-grams and
+speech acts are computed on the arrays without reading them into memory or converting them to Python objects:
+
+    corpus = TokenCorpus.load("~/data/speech_acts/data/childes_corpus/")
+    corpus.n_grams_counter(2).most_common(10)
+
+Usage to create a corpus: python token_corpus.py --data PATH_TO_UTTERANCES --out DIRECTORY
+"""
+
+import os
+import argparse
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from data_store import load_utterances
+from utils import PUNCTUATION_TOKENS, SPEECH_ACT
+
+# Id of missing values (e.g. utterances without speech act)
+MISSING = -1
+
+# Arrays of the corpus: (name, dtype), by number of entries
+TOKEN_ARRAYS = [("tokens", np.int32)]
+POS_ARRAYS = [("pos", np.int32)]
+UTTERANCE_ARRAYS = [("speaker_codes", np.int32), ("speech_acts", np.int32), ("ages", np.float32)]
+TRANSCRIPT_ARRAYS = [("transcript_files", np.int32)]
+OFFSET_ARRAYS = [("token_offsets", np.int64), ("pos_offsets", np.int64), ("transcript_offsets", np.int64)]
+
+
+class StringInterner:
+    """Assigns consecutive integer ids to strings"""
+
+    def __init__(self, strings: list = ()):
+        self.strings = list(strings)
+        self.ids = {string: i for i, string in enumerate(self.strings)}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def intern(self, string: str) -> int:
+        try:
+            return self.ids[string]
+        except KeyError:
+            self.ids[string] = len(self.strings)
+            self.strings.append(string)
+            return self.ids[string]
+
+    def intern_all(self, strings) -> np.ndarray:
+        """Ids of a sequence of strings (None for missing values), interning each distinct string only once"""
+        # Missing values get the code -1, i.e. the last entry of the lookup table
+        codes, uniques = pd.factorize(pd.Series(strings, dtype=object))
+        lookup = np.array(
+            [self.intern(str(string)) for string in uniques] + [MISSING], dtype=np.int32
+        )
+        return lookup[codes]
+
+    def get(self, string: str) -> int:
+        return self.ids.get(string, MISSING)
+
+    def save(self, directory: str):
+        """Store the strings as utf-8 bytes and offsets"""
+        encoded = [string.encode() for string in self.strings]
+        np.save(
+            os.path.join(directory, "strings.npy"),
+            np.frombuffer(b"".join(encoded), dtype=np.uint8),
+        )
+        np.save(
+            os.path.join(directory, "string_offsets.npy"),
+            np.cumsum([0] + [len(string) for string in encoded], dtype=np.int64),
+        )
+
+    @classmethod
+    def load(cls, directory: str):
+        data = np.load(os.path.join(directory, "strings.npy")).tobytes()
+        offsets = np.load(os.path.join(directory, "string_offsets.npy")).tolist()
+        return cls(
+            [data[start:end].decode() for start, end in zip(offsets[:-1], offsets[1:])]
+        )
+
+
+def _encode_lists(lists: list, interner: StringInterner) -> tuple:
+    """Flat array of the ids of all strings of the lists (None is treated as empty list), and offsets of the lists"""
+    lists = [values if values is not None else [] for values in lists]
+    lengths = np.fromiter(map(len, lists), dtype=np.int64, count=len(lists))
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    flat = [value for values in lists for value in values]
+    return interner.intern_all(flat), offsets
+
+
+class TokenCorpus:
+    """Integer-encoded utterances, see module docstring.
+
+    Attributes are numpy arrays (np.memmap when loaded with mmap=True):
+        tokens, pos: ids of the tokens and POS tags of all utterances
+        token_offsets, pos_offsets: start of the tokens/POS tags of each utterance (length: nb utterances + 1)
+        speaker_codes, speech_acts: ids of the speaker code and speech act of each utterance (MISSING if unknown)
+        ages: age of the child (in months) at each utterance
+        transcript_offsets: first utterance of each transcript (length: nb transcripts + 1)
+        transcript_files: id of each transcript file
+    """
+
+    ARRAYS = TOKEN_ARRAYS + POS_ARRAYS + UTTERANCE_ARRAYS + TRANSCRIPT_ARRAYS + OFFSET_ARRAYS
+
+    def __init__(self, interner: StringInterner, arrays: dict):
+        self.interner = interner
+        for name, _ in self.ARRAYS:
+            setattr(self, name, arrays[name])
+
+    @classmethod
+    def from_data(cls, data: pd.DataFrame, interner: StringInterner = None):
+        """Encode the utterances of a data frame (with the columns of preprocess.py)"""
+        if interner is None:
+            interner = StringInterner()
+        # Same order as in add_feature_columns
+        data = data.sort_values(["transcript_file", "utterance_id"])
+
+        tokens, token_offsets = _encode_lists(data.tokens.tolist(), interner)
+        pos, pos_offsets = _encode_lists(data.pos.tolist(), interner)
+
+        transcript_files = data.transcript_file.to_numpy()
+        transcript_starts = np.flatnonzero(
+            np.r_[True, transcript_files[1:] != transcript_files[:-1]]
+        )
+
+        arrays = {
+            "tokens": tokens,
+            "token_offsets": token_offsets,
+            "pos": pos,
+            "pos_offsets": pos_offsets,
+            "speaker_codes": interner.intern_all(data.speaker_code.tolist()),
+            "speech_acts": interner.intern_all(data[SPEECH_ACT].tolist())
+            if SPEECH_ACT in data.columns
+            else np.full(len(data), MISSING, dtype=np.int32),
+            "ages": data.age.to_numpy(dtype=np.float32)
+            if "age" in data.columns
+            else np.full(len(data), np.nan, dtype=np.float32),
+            "transcript_offsets": np.r_[transcript_starts, len(data)].astype(np.int64),
+            "transcript_files": interner.intern_all(transcript_files[transcript_starts].tolist()),
+        }
+        return cls(interner, {name: arrays[name].astype(dtype) for name, dtype in cls.ARRAYS})
+
+    def save(self, directory: str):
+        directory = os.path.expanduser(directory)
+        os.makedirs(directory, exist_ok=True)
+        self.interner.save(directory)
+        for name, _ in self.ARRAYS:
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True):
+        """Load a corpus stored with `save`, with mmap=True the arrays are memory-mapped (read-only)"""
+        directory = os.path.expanduser(directory)
+        arrays = {
+            name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r" if mmap else None)
+            for name, _ in cls.ARRAYS
+        }
+        return cls(StringInterner.load(directory), arrays)
+
+    def __len__(self):
+        """Number of utterances"""
+        return len(self.token_offsets) - 1
+
+    @property
+    def nb_transcripts(self) -> int:
+        return len(self.transcript_offsets) - 1
+
+    @property
+    def strings(self) -> list:
+        return self.interner.strings
+
+    def nbytes(self) -> int:
+        """Size of the arrays and strings of the corpus"""
+        return sum(getattr(self, name).nbytes for name, _ in self.ARRAYS) + sum(
+            len(string.encode()) for string in self.strings
+        )
+
+    def decode(self, ids) -> list:
+        return [self.strings[i] if i != MISSING else None for i in np.asarray(ids).tolist()]
+
+    def utterance_tokens(self, i: int) -> np.ndarray:
+        """Token ids of an utterance (a view of the tokens array)"""
+        return self.tokens[self.token_offsets[i]:self.token_offsets[i + 1]]
+
+    def turn_lengths(self) -> np.ndarray:
+        return np.diff(self.token_offsets)
+
+    def token_utterances(self) -> np.ndarray:
+        """Index of the utterance of each token"""
+        return np.repeat(np.arange(len(self)), self.turn_lengths())
+
+    def utterance_transcripts(self) -> np.ndarray:
+        """Index of the transcript of each utterance"""
+        return np.repeat(np.arange(self.nb_transcripts), np.diff(self.transcript_offsets))
+
+    def counter(self, ids: np.ndarray) -> Counter:
+        """Counter of the strings of the ids (MISSING ids are ignored)"""
+        counts = np.bincount(ids[ids != MISSING], minlength=len(self.strings))
+        present = np.flatnonzero(counts)
+        return Counter(dict(zip(self.decode(present), counts[present].tolist())))
+
+    def frequencies(self, ids: np.ndarray) -> Counter:
+        """Relative frequencies of the strings of the ids, as by utils.calculate_frequencies, e.g. of the speech acts of
+        children: corpus.frequencies(corpus.speech_acts[corpus.speaker_codes == corpus.interner.get(CHILD)])"""
+        frequencies = self.counter(ids)
+        for string in frequencies:
+            frequencies[string] /= len(ids)
+        return frequencies
+
+    def n_gram_positions(self, n: int, cut_last: bool = True) -> np.ndarray:
+        """Flat index of the first token of each n-gram within an utterance, by default without the last token of each
+        utterance (the final punctuation), as by crf_train.get_n_grams"""
+        ends = np.repeat(self.token_offsets[1:], self.turn_lengths())
+        if cut_last:
+            ends = ends - 1
+        return np.flatnonzero(np.arange(len(self.tokens)) + n <= ends)
+
+    def n_gram_counts(self, n: int, cut_last: bool = True) -> tuple:
+        """Distinct n-grams (array of token ids, of shape (nb n-grams, n)) and their number of occurrences"""
+        positions = self.n_gram_positions(n, cut_last)
+        n_grams = np.stack([self.tokens[positions + k] for k in range(n)], axis=1)
+        if len(self.strings) ** n < np.iinfo(np.int64).max:
+            # Sort n-grams as single integers
+            keys = np.zeros(len(n_grams), dtype=np.int64)
+            for k in range(n):
+                keys = keys * len(self.strings) + n_grams[:, k]
+            _, first, counts = np.unique(keys, return_index=True, return_counts=True)
+            return n_grams[first], counts
+        return np.unique(n_grams, axis=0, return_counts=True)
+
+    def n_grams_counter(self, n: int, cut_last: bool = True) -> Counter:
+        """Same as crf_train.get_n_grams_counter on the tokens of all utterances"""
+        n_grams, counts = self.n_gram_counts(n, cut_last)
+        strings = self.strings
+        return Counter(
+            {
+                tuple(strings[i] for i in n_gram): count
+                for n_gram, count in zip(n_grams.tolist(), counts.tolist())
+            }
+        )
+
+    def previous_speaker_codes(self) -> np.ndarray:
+        """Speaker code of the previous utterance of the same transcript (MISSING for the first utterances)"""
+        prev = np.r_[MISSING, self.speaker_codes[:-1]].astype(np.int32)
+        prev[self.transcript_offsets[:-1]] = MISSING
+        return prev
+
+    def repeated_tokens(self) -> np.ndarray:
+        """Mask of the tokens that are repeated from the previous utterance of the transcript, by another speaker
+        (punctuation excluded), as computed by crf_tagger.add_feature_columns"""
+        utterance_idx = self.token_utterances()
+        tokens = np.asarray(self.tokens, dtype=np.int64)
+        nb_strings = max(len(self.strings), 1)
+
+        first_utterance = np.zeros(len(self), dtype=bool)
+        first_utterance[self.transcript_offsets[:-1]] = True
+        speaker_changed = self.speaker_codes != self.previous_speaker_codes()
+        speaker_changed[first_utterance] = True
+
+        keys = utterance_idx * nb_strings + tokens
+        next_utterance_idx = utterance_idx + 1
+        follows = next_utterance_idx < len(self)
+        follows[follows] = ~first_utterance[next_utterance_idx[follows]]
+        prev_keys = next_utterance_idx[follows] * nb_strings + tokens[follows]
+
+        is_punctuation = np.zeros(nb_strings, dtype=bool)
+        is_punctuation[[self.interner.get(t) for t in PUNCTUATION_TOKENS if t in self.interner.ids]] = True
+
+        return (
+            np.isin(keys, prev_keys)
+            & ~is_punctuation[tokens]
+            & speaker_changed[utterance_idx]
+        )
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser(description="Create an integer-encoded token corpus.")
+    argparser.add_argument(
+        "--data",
+        type=str,
+        required=True,
+        help="Path to the utterances (Parquet dataset, pickle or CSV)",
+    )
+    argparser.add_argument(
+        "--out", type=str, required=True, help="Directory to store the corpus"
+    )
+
+    args = argparser.parse_args()
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(args)
+
+    data = load_utterances(args.data)
+    corpus = TokenCorpus.from_data(data)
+    corpus.save(args.out)
+    print(
+        f"Stored {len(corpus)} utterances of {corpus.nb_transcripts} transcripts ({len(corpus.tokens)} tokens, "
+        f"{len(corpus.strings)} distinct strings): {corpus.nbytes() / 1024 ** 2:.1f} MB"
+    )
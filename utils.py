@@ -1,14 +1,15 @@
 import os
-import pickle
 
 from collections import Counter
+from functools import lru_cache
 import pandas as pd
-from sklearn.model_selection import train_test_split
 import re
 from bidict import (
     bidict,
 )
 
+from data_store import load_utterances
+
 SPEECH_ACT = "speech_act"
 
 CHILD = "CHI"
@@ -23,9 +24,24 @@ SOURCE_CRF = "CRF"
 TARGET_PRODUCTION = "production"
 TARGET_COMPREHENSION = "comprehension"
 
-SPEECH_ACT_DESCRIPTIONS = pd.read_csv(
-    "illocutionary_force_codes.csv", sep=" ", header=0, keep_default_na=False
-).set_index("Code").sort_index()
+PATH_SPEECH_ACT_DESCRIPTIONS = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "illocutionary_force_codes.csv"
+)
+
+
+@lru_cache(maxsize=None)
+def get_speech_act_descriptions() -> pd.DataFrame:
+    """Table of the speech act codes with their description, read on first use"""
+    return pd.read_csv(
+        PATH_SPEECH_ACT_DESCRIPTIONS, sep=" ", header=0, keep_default_na=False
+    ).set_index("Code").sort_index()
+
+
+def __getattr__(name):
+    # SPEECH_ACT_DESCRIPTIONS used to be read at import time, it is now loaded when it is first accessed
+    if name == "SPEECH_ACT_DESCRIPTIONS":
+        return get_speech_act_descriptions()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 PUNCTUATION = {
     "p": ".",
@@ -46,6 +62,8 @@ PUNCTUATION = {
     "other_4": "+/.",
 }
 
+PUNCTUATION_TOKENS = frozenset(PUNCTUATION.values())
+
 POS_PUNCTUATION = [".", "?", "...", "!", "+/", "+/?", "" "...?", ",", "-", "+\"/.", "+...", "++/.", "+/."]
 
 
@@ -240,16 +258,25 @@ TRANSCRIPTS_NEW_ENGLAND = [
     3757,
 ]
 
-PATH_CHILDES_UTTERANCES = os.path.expanduser("~/data/speech_acts/data/childes_utterances.p")
-PATH_CHILDES_UTTERANCES_ANNOTATED = os.path.expanduser("~/data/speech_acts/data/childes_utterances_annotated.csv")
+# Parquet datasets (see data_store.py)
+PATH_CHILDES_UTTERANCES = os.path.expanduser("~/data/speech_acts/data/childes_utterances.parquet")
+PATH_CHILDES_UTTERANCES_ANNOTATED = os.path.expanduser(
+    "~/data/speech_acts/data/childes_utterances_annotated.parquet"
+)
 
-PATH_NEW_ENGLAND_UTTERANCES = os.path.expanduser("~/data/speech_acts/data/new_england_preprocessed.p")
-PATH_NEW_ENGLAND_UTTERANCES_ANNOTATED = os.path.expanduser("~/data/speech_acts/data/new_england_reproduced_crf.p")
+PATH_NEW_ENGLAND_UTTERANCES = os.path.expanduser("~/data/speech_acts/data/new_england_preprocessed.parquet")
+PATH_NEW_ENGLAND_UTTERANCES_ANNOTATED = os.path.expanduser(
+    "~/data/speech_acts/data/new_england_reproduced_crf.parquet"
+)
 
 
 def load_whole_childes_data():
     # We need the New England data to calculate min number of utterances per age group
-    data = pickle.load(open(PATH_NEW_ENGLAND_UTTERANCES_ANNOTATED, "rb"))
+    data = load_utterances(
+        PATH_NEW_ENGLAND_UTTERANCES_ANNOTATED,
+        columns=["transcript_file", "utterance_id", "age_months"],
+        filters=[("speaker", "==", CHILD)],
+    )
 
     # map ages to corresponding bins
     data["age_months"] = data["age_months"].apply(age_bin)
@@ -257,7 +284,7 @@ def load_whole_childes_data():
     # calculate minimum number of utterances for each age group
     min_num_utterances = {}
     for age in AGES:
-        data_age = data[(data.age_months == age) & (data.speaker == CHILD)]
+        data_age = data[data.age_months == age]
         lengths = data_age.groupby(by=["transcript_file"]).agg(
             length=("utterance_id", lambda x: len(x))
         )
@@ -265,13 +292,13 @@ def load_whole_childes_data():
     print("Min num utterances: ", min_num_utterances)
 
     # Load annotated data for whole CHILDES
-    data_whole_childes = pd.read_csv(PATH_CHILDES_UTTERANCES_ANNOTATED)
-    data_whole_childes.set_index("index", drop=True, inplace=True)
-
-    # Filter out New England corpus transcripts
-    data_whole_childes = data_whole_childes[
-        ~data_whole_childes.transcript_file.isin(TRANSCRIPTS_NEW_ENGLAND)
-    ]
+    # (without the New England corpus transcripts)
+    data_whole_childes = load_utterances(
+        PATH_CHILDES_UTTERANCES_ANNOTATED,
+        filters=[("transcript_file", "not in", TRANSCRIPTS_NEW_ENGLAND)],
+    )
+    if "index" in data_whole_childes.columns:
+        data_whole_childes.set_index("index", drop=True, inplace=True)
 
     # Filter for children's utterances
     data_whole_childes_children = data_whole_childes[data_whole_childes.speaker == CHILD]
@@ -298,6 +325,8 @@ def load_whole_childes_data():
 
 
 def make_train_test_splits(data, test_split_ratio):
+    from sklearn.model_selection import train_test_split
+
     data_train_ids, data_test_ids = train_test_split(
         data["transcript_file"].unique(),
         test_size=test_split_ratio,
@@ -383,7 +412,7 @@ def dataset_labels(add_empty_labels: bool = False) -> bidict:
     b: `bidict`
         dictionary `{label: index}` to be used to transform data
     """
-    labels = SPEECH_ACT_DESCRIPTIONS.index.to_list()
+    labels = get_speech_act_descriptions().index.to_list()
     if add_empty_labels:
         labels.append("NOL")  # No label for this sentence
         labels.append("NAT")  # Not a valid tag